@@ -1,21 +1,450 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import random
+import threading
+import time
 from abc import ABCMeta, abstractmethod
-import pickle
+from collections import deque
+from typing import AsyncIterator, Dict, Optional
 
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Shared HTTP connection pool settings for the LLM clients. Connections are kept
+# alive between requests so concurrent /chat turns reuse warm sessions
+# instead of opening a new connection per LLM call.
+LLM_MAX_CONNECTIONS = int(os.getenv("A2I2_LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("A2I2_LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("A2I2_LLM_KEEPALIVE_EXPIRY", "30"))
+
+BACKENDS = ("openai", "ollama", "fake")
+DEFAULT_MODELS = {"openai": "gpt-4o-mini", "ollama": "llama3.2:latest", "fake": "fake"}
+
+
+def llm_pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+    )
+
+
+class CircuitOpenError(RuntimeError):
+    """The backend failed repeatedly and calls are being refused until it cools down."""
 
-PROMPT = """
-<you should define this prompt>
-"""
 
 class GeneratorModel(object, metaclass=ABCMeta):
-    def __init__(self, model_file):
-        self.model_file = model_file
+    """One LLM backend: a single prompt in, the completion text out.
+
+    Implementations make exactly one attempt per call, bounded by ``timeout``
+    seconds; retries, deadlines and the circuit breaker live in ResilientGenerator.
+    """
+    name = "generator"
+
+    def __init__(self, model: str):
+        self.model = model
+
+    @abstractmethod
+    def generate(self, prompt: str, json_mode: bool = False, timeout: Optional[float] = None) -> str:
+        pass
 
     @abstractmethod
-    def load_model(self):
-        # this method will be necessary if you're using Huggingface `generate`,
-        # but it is not necessary for Ollama.
-        pass 
+    async def agenerate(self, prompt: str, json_mode: bool = False, timeout: Optional[float] = None) -> str:
+        pass
 
     @abstractmethod
-    def query(self, retrieved_documents, question):
-        pass
\ No newline at end of file
+    def astream(self, prompt: str, timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """Async iterator over the completion text as it arrives."""
+        pass
+
+    async def aclose(self):
+        """Release pooled connections."""
+        pass
+
+
+class OpenAIGenerator(GeneratorModel):
+    """OpenAI chat completions; needs OPENAI_API_KEY."""
+    name = "openai"
+
+    def __init__(self, model: str = DEFAULT_MODELS["openai"], timeout: float = 60.0, api_key: Optional[str] = None):
+        super().__init__(model)
+        from openai import OpenAI, AsyncOpenAI
+        # IMPORTANT: Never hardcode API keys! Always use environment variables
+        api_key = api_key or os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError(
+                "OPENAI_API_KEY not found. Please create a .env file in the project root "
+                "with the line: OPENAI_API_KEY=your_api_key_here"
+            )
+        # The clients' own retries are off; ResilientGenerator retries with backoff instead
+        self.client = OpenAI(api_key=api_key, max_retries=0,
+                             http_client=httpx.Client(limits=llm_pool_limits(), timeout=timeout))
+        self.async_client = AsyncOpenAI(api_key=api_key, max_retries=0,
+                                        http_client=httpx.AsyncClient(limits=llm_pool_limits(), timeout=timeout))
+
+    def _request(self, prompt: str, json_mode: bool, timeout: Optional[float]) -> dict:
+        """Chat completion arguments shared by the sync, async and streaming calls."""
+        request = dict(
+            model=self.model,
+            messages=[{
+                'role': 'user',
+                'content': prompt,
+            }],
+            temperature=0.7,
+            max_tokens=500
+        )
+        if json_mode:
+            # Structured classifier output: ask for a JSON object and keep it deterministic
+            request["response_format"] = {"type": "json_object"}
+            request["temperature"] = 0
+        if timeout is not None:
+            request["timeout"] = timeout
+        return request
+
+    def generate(self, prompt, json_mode=False, timeout=None):
+        response = self.client.chat.completions.create(**self._request(prompt, json_mode, timeout))
+        return response.choices[0].message.content.strip()
+
+    async def agenerate(self, prompt, json_mode=False, timeout=None):
+        response = await self.async_client.chat.completions.create(**self._request(prompt, json_mode, timeout))
+        return response.choices[0].message.content.strip()
+
+    async def astream(self, prompt, timeout=None):
+        stream = await self.async_client.chat.completions.create(stream=True, **self._request(prompt, False, timeout))
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def aclose(self):
+        await self.async_client.close()
+
+
+class OllamaGenerator(GeneratorModel):
+    """Local model served by Ollama (OLLAMA_HOST); the ollama package is imported on first use."""
+    name = "ollama"
+
+    def __init__(self, model: str = DEFAULT_MODELS["ollama"], timeout: float = 120.0, host: Optional[str] = None):
+        super().__init__(model)
+        self.timeout = timeout
+        self.host = host
+        self._client = None
+        self._async_client = None
+        self._executor = None
+
+    def _clients(self):
+        if self._client is None:
+            import ollama
+            self._client = ollama.Client(host=self.host, limits=llm_pool_limits(), timeout=self.timeout)
+            self._async_client = ollama.AsyncClient(host=self.host, limits=llm_pool_limits(), timeout=self.timeout)
+            # The sync client's timeout is fixed when it is created, so shorter per-call
+            # timeouts are enforced by waiting on the call from a worker thread
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=LLM_MAX_CONNECTIONS, thread_name_prefix="ollama"
+            )
+        return self._client, self._async_client
+
+    @staticmethod
+    def _messages(prompt: str):
+        return [{
+            'role': 'user',
+            'content': prompt,
+        }]
+
+    def generate(self, prompt, json_mode=False, timeout=None):
+        client, _ = self._clients()
+        future = self._executor.submit(
+            client.chat, model=self.model, messages=self._messages(prompt), format='json' if json_mode else ''
+        )
+        try:
+            response = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # An abandoned call still ends at the client's own timeout
+            future.cancel()
+            raise TimeoutError(f"Ollama call timed out after {timeout:.1f}s")
+        return response['message']['content'].strip()
+
+    async def agenerate(self, prompt, json_mode=False, timeout=None):
+        _, client = self._clients()
+        call = client.chat(model=self.model, messages=self._messages(prompt), format='json' if json_mode else '')
+        response = await asyncio.wait_for(call, timeout) if timeout is not None else await call
+        return response['message']['content'].strip()
+
+    async def astream(self, prompt, timeout=None):
+        _, client = self._clients()
+        async for part in await client.chat(model=self.model, messages=self._messages(prompt), stream=True):
+            if part['message']['content']:
+                yield part['message']['content']
+
+    async def aclose(self):
+        http_client = getattr(self._async_client, "_client", None)
+        if http_client is not None:
+            await http_client.aclose()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+class FakeGenerator(GeneratorModel):
+    """Canned answers without any model, for development and tests (A2I2_LLM_BACKEND=fake).
+
+    Replies with ``reply`` (A2I2_FAKE_REPLY), and with an empty JSON object in
+    JSON mode, so every classifier flag reads False. The last ``keep_prompts``
+    prompts are kept for inspection.
+    """
+    name = "fake"
+
+    def __init__(self, model: str = DEFAULT_MODELS["fake"], reply: Optional[str] = None, keep_prompts: int = 100):
+        super().__init__(model)
+        self.reply = reply or os.getenv("A2I2_FAKE_REPLY", "Okay, I hear you.")
+        self.prompts = deque(maxlen=keep_prompts)
+
+    def generate(self, prompt, json_mode=False, timeout=None):
+        self.prompts.append(prompt)
+        return "{}" if json_mode else self.reply
+
+    async def agenerate(self, prompt, json_mode=False, timeout=None):
+        return self.generate(prompt, json_mode, timeout)
+
+    async def astream(self, prompt, timeout=None):
+        self.prompts.append(prompt)
+        words = self.reply.split(" ")
+        for position, word in enumerate(words):
+            yield word if position == len(words) - 1 else word + " "
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Rate limits, server errors, timeouts and dropped connections are worth another attempt."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError, httpx.TimeoutException, httpx.TransportError)):
+        return True
+    # openai wraps timeouts and connection failures in its own exception types
+    return type(error).__name__ in ("APITimeoutError", "APIConnectionError")
+
+
+class CircuitBreaker:
+    """Refuses calls after ``failure_threshold`` consecutive failures, for ``reset_timeout`` seconds.
+
+    After each cool-down one trial call is let through (half-open); its success
+    closes the breaker, its failure opens it again. A trial that never reports
+    back (e.g. a cancelled request) is replaced by another after the next cool-down.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_at = None
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if self._trial_at is not None else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - max(self._opened_at, self._trial_at or 0.0) >= self.reset_timeout:
+                self._trial_at = now
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_at is not None:
+                self._opened_at = time.monotonic()
+                self._trial_at = None
+            elif self._opened_at is None and self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self.opened += 1
+
+
+class ResilientGenerator:
+    """Wraps a GeneratorModel with a per-call deadline, retries and a circuit breaker.
+
+    Each call gets ``deadline`` seconds in total. Retryable failures (429, 5xx,
+    timeouts, connection errors) are retried up to ``retries`` times with full
+    jitter exponential backoff (random wait up to ``backoff_base * 2**attempt``,
+    capped at ``backoff_max``), as long as the deadline allows. A stream must
+    finish within the deadline too, and is only retried until its first token. Calls that still fail count towards the
+    circuit breaker; while it is open calls raise CircuitOpenError immediately.
+    """
+
+    def __init__(self, backend: GeneratorModel, deadline: float = 30.0, retries: int = 2,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, breaker: Optional[CircuitBreaker] = None):
+        self.backend = backend
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retried = 0
+        self.failures = 0
+
+    @property
+    def name(self) -> str:
+        return self.backend.name
+
+    @property
+    def model(self) -> str:
+        return self.backend.model
+
+    def _start(self) -> float:
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} backend circuit is open after repeated failures")
+        with self._lock:
+            self.calls += 1
+        return time.monotonic() + self.deadline
+
+    def _backoff(self, attempt: int, error: BaseException, deadline: float) -> Optional[float]:
+        """Seconds to wait before the next attempt, or None when the call should give up."""
+        if attempt >= self.retries or not is_retryable(error):
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if time.monotonic() + delay >= deadline:
+            return None
+        with self._lock:
+            self.retried += 1
+        logger.warning(f"{self.name} call failed ({type(error).__name__}: {error}), retrying in {delay:.2f}s")
+        return delay
+
+    def _failed(self, error: BaseException):
+        with self._lock:
+            self.failures += 1
+        if is_retryable(error):
+            self.breaker.failure()
+        else:
+            # The backend answered (e.g. a bad request), so it is up
+            self.breaker.success()
+
+    def generate(self, prompt: str, json_mode: bool = False) -> str:
+        deadline = self._start()
+        attempt = 0
+        while True:
+            try:
+                result = self.backend.generate(prompt, json_mode, timeout=max(0.1, deadline - time.monotonic()))
+            except Exception as e:
+                delay = self._backoff(attempt, e, deadline)
+                if delay is None:
+                    self._failed(e)
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+            return result
+
+    async def agenerate(self, prompt: str, json_mode: bool = False) -> str:
+        deadline = self._start()
+        attempt = 0
+        while True:
+            remaining = max(0.1, deadline - time.monotonic())
+            try:
+                result = await asyncio.wait_for(self.backend.agenerate(prompt, json_mode, timeout=remaining), remaining)
+            except Exception as e:
+                delay = self._backoff(attempt, e, deadline)
+                if delay is None:
+                    self._failed(e)
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+            return result
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        deadline = self._start()
+        attempt = 0
+        while True:
+            started = False
+            stream = self.backend.astream(prompt, timeout=max(0.1, deadline - time.monotonic()))
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError(f"{self.name} stream exceeded its {self.deadline:.0f}s deadline")
+                    try:
+                        token = await asyncio.wait_for(stream.__anext__(), remaining)
+                    except StopAsyncIteration:
+                        break
+                    started = True
+                    yield token
+            except Exception as e:
+                delay = None if started else self._backoff(attempt, e, deadline)
+                if delay is None:
+                    self._failed(e)
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            finally:
+                await stream.aclose()
+            self.breaker.success()
+            return
+
+    async def aclose(self):
+        await self.backend.aclose()
+
+    def stats(self) -> Dict:
+        """Call, retry and breaker counters for the metrics endpoint."""
+        with self._lock:
+            return {
+                "backend": self.name,
+                "model": self.model,
+                "calls": self.calls,
+                "retries": self.retried,
+                "failures": self.failures,
+                "circuit": self.breaker.state,
+                "circuit_opened": self.breaker.opened
+            }
+
+
+def generator_from_env(default_backend: str = "openai") -> ResilientGenerator:
+    """The backend named by A2I2_LLM_BACKEND (openai, ollama or fake), with its resilience settings."""
+    backend = os.getenv("A2I2_LLM_BACKEND", default_backend).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown A2I2_LLM_BACKEND '{backend}', expected one of: {', '.join(BACKENDS)}")
+    if backend == "openai":
+        model = OpenAIGenerator(
+            model=os.getenv("A2I2_LLM_MODEL", DEFAULT_MODELS["openai"]),
+            timeout=float(os.getenv("A2I2_LLM_TIMEOUT", "60"))
+        )
+    elif backend == "ollama":
+        model = OllamaGenerator(
+            model=os.getenv("A2I2_LLM_MODEL", os.getenv("A2I2_OLLAMA_MODEL", DEFAULT_MODELS["ollama"])),
+            timeout=float(os.getenv("A2I2_LLM_TIMEOUT", "120")),
+            host=os.getenv("OLLAMA_HOST")
+        )
+    else:
+        model = FakeGenerator(model=os.getenv("A2I2_LLM_MODEL", DEFAULT_MODELS["fake"]))
+    return ResilientGenerator(
+        model,
+        deadline=float(os.getenv("A2I2_LLM_DEADLINE", "30" if backend == "openai" else "120")),
+        retries=int(os.getenv("A2I2_LLM_RETRIES", "2")),
+        backoff_base=float(os.getenv("A2I2_LLM_BACKOFF_BASE", "0.5")),
+        backoff_max=float(os.getenv("A2I2_LLM_BACKOFF_MAX", "8")),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv("A2I2_LLM_BREAKER_FAILURES", "5")),
+            reset_timeout=float(os.getenv("A2I2_LLM_BREAKER_RESET", "30"))
+        )
+    )
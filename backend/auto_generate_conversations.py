@@ -1,7 +1,7 @@
 import json
 import os
 from pathlib import Path
-from ollama_0220 import simulate_interactive_single_turn, conversation_manager, decision_making
+from ollama_0220 import simulate_interactive_single_turn, conversation_manager, decision_making, context_selector
 
 # Get base directory from environment variable or use default
 BASE_DIR = os.getenv('A2I2_BASE_DIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -95,6 +95,12 @@ def generate_conversation(town_person, persona_data, dialogue_data):
             julie_category = "general"
             julie_context = dialogue_data.get("julie", {}).get("general", [])
         
+        # Keep only the lines closest to the town person's last message
+        last_reply = conversation_manager.last_message(session_id)
+        julie_context, julie_selection = context_selector.select(
+            "julie", julie_category, julie_context, last_reply.content if last_reply else ""
+        )
+        
         # Create Julie's prompt
         if julie_category == "closing":
             julie_prompt_content = f"This conversation is now ending. Generate ONLY a brief goodbye message to {town_person} that clearly ends the conversation. Choose from these closing lines: {julie_context}. Do not ask any questions or continue the conversation."
@@ -105,7 +111,8 @@ def generate_conversation(town_person, persona_data, dialogue_data):
         julie_turn = {
             "speaker": "julie",
             "prompt": f"You are roleplaying as Julie, an emergency evacuation virtual assistant.\nPrevious conversation:\n{history}\n{julie_prompt_content}\nKeep your response in one short sentence. Only generate utterances, no system messages.",
-            "category": julie_category
+            "category": julie_category,
+            "context_selection": julie_selection
         }
         
         try:
@@ -139,14 +146,17 @@ def generate_conversation(town_person, persona_data, dialogue_data):
             # Generate town person's response
             town_person_category = get_town_person_category(message_count, town_person)
             town_person_data = dialogue_data.get(town_person, {})
-            context = town_person_data.get(town_person_category, [])
+            context, selection = context_selector.select(
+                town_person, town_person_category, town_person_data.get(town_person_category, []), julie_response
+            )
             
             prompt_content = f"Generate a response to Julie's persuasive message. Use or adapt lines from this {town_person_category}: {context}."
             
             town_person_turn = {
                 "speaker": town_person,
                 "prompt": f"You are roleplaying as {town_person}, \n{town_person}'s background: {persona_data[town_person]}\nPrevious conversation:\n{history}\n{prompt_content}\nJulie just said: {julie_response}\nPlease generate a response based on this message and keep your response natural and brief. Only generate utterances, no system messages.",
-                "category": town_person_category
+                "category": town_person_category,
+                "context_selection": selection
             }
             
             # Generate town person's response
@@ -173,8 +183,8 @@ def generate_conversation(town_person, persona_data, dialogue_data):
             print(f"{town_person}: {response}")
             
             # Get decision response if we have enough messages
-            updated_history = conversation_manager.get_history(session_id, max_turns=9)
-            if updated_history and len(updated_history.split('\n')) >= 3:
+            if conversation_manager.message_count(session_id) >= 3:
+                updated_history = conversation_manager.get_history(session_id, max_turns=9)
                 decision_response = decision_making(updated_history, town_person)
                 if decision_response:
                     decision_responses.append({
@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ENTRY_POINTS = ["server", "server_local_model", "server_keywords", "auto_generate_conversations"]
+HEAVY_MODULES = ["torch", "faiss", "sentence_transformers", "ollama", "openai", "numpy"]
+
+# Run in a fresh interpreter, so nothing is already imported or cached in memory
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+print(json.dumps({{"seconds": elapsed, "rss_mb": peak_mb,
+                  "heavy": [name for name in {heavy} if name in sys.modules]}}))
+"""
+
+
+def measure(module: str) -> dict:
+    """Import ``module`` in a new Python process and report time, peak RSS and heavy imports."""
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=backend_dir, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()
+        return {"error": error[-1] if error else f"exit code {result.returncode}"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def benchmark(modules, repeat: int) -> dict:
+    report = {}
+    for module in modules:
+        runs = [measure(module) for _ in range(repeat)]
+        failed = [run for run in runs if "error" in run]
+        if failed:
+            report[module] = failed[0]
+            continue
+        report[module] = {
+            "seconds": round(statistics.median(run["seconds"] for run in runs), 3),
+            "rss_mb": round(statistics.median(run["rss_mb"] for run in runs), 1),
+            "heavy_imports": runs[0]["heavy"]
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold-start import time and peak RSS of the backend entry points.")
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS, help="Modules to import (default: all entry points)")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh imports per module; the median is reported")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    report = benchmark(args.modules, args.repeat)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'entry point':<30} {'import s':>9} {'peak RSS MB':>12}  heavy modules loaded")
+        for module, stats in report.items():
+            if "error" in stats:
+                print(f"{module:<30} failed: {stats['error']}")
+                continue
+            heavy = ", ".join(stats["heavy_imports"]) or "-"
+            print(f"{module:<30} {stats['seconds']:>9.3f} {stats['rss_mb']:>12.1f}  {heavy}")
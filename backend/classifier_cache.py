@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+def prompt_version(template: str) -> str:
+    """Short hash of a prompt template, so editing a prompt invalidates its cached answers."""
+    return hashlib.sha1(template.encode("utf-8")).hexdigest()[:12]
+
+
+def normalize_text(text: str) -> str:
+    """Normalize an utterance for cache lookups (case, whitespace, trailing punctuation)."""
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    return text.strip(" .!?,;:'\"")
+
+
+class ClassifierCache:
+    """Cache of classifier answers keyed by (check name, normalized text, model, prompt version).
+
+    Answers live in a bounded in-memory LRU backed by an optional SQLite file,
+    so repeated stock phrases are answered without an LLM call, even after a restart.
+    The file keeps at most ``max_disk_entries`` rows; the oldest writes go first.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_entries: int = 4096, max_disk_entries: int = 100000):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self._disk_rows = 0
+        self._memory: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        if db_path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS classifier_cache ("
+                    "check_name TEXT, text TEXT, model TEXT, prompt_version TEXT, answer TEXT, "
+                    "PRIMARY KEY (check_name, text, model, prompt_version))"
+                )
+                self._db.commit()
+                self._disk_rows = self._db.execute("SELECT COUNT(*) FROM classifier_cache").fetchone()[0]
+                self._prune_disk()
+            except sqlite3.Error as e:
+                logging.warning(f"Classifier cache disk store disabled ({db_path}): {str(e)}")
+                self._db = None
+
+    def get(self, check_name: str, text: str, model: str, version: str) -> Optional[str]:
+        """Return the cached answer, or None on a miss."""
+        key = (check_name, normalize_text(text), model, version)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT answer FROM classifier_cache "
+                    "WHERE check_name=? AND text=? AND model=? AND prompt_version=?",
+                    key
+                ).fetchone()
+                if row is not None:
+                    self._remember(key, row[0])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, check_name: str, text: str, model: str, version: str, answer: str):
+        """Store an answer in memory and on disk."""
+        key = (check_name, normalize_text(text), model, version)
+        with self._lock:
+            self._remember(key, answer)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO classifier_cache VALUES (?, ?, ?, ?, ?)",
+                        key + (answer,)
+                    )
+                    self._disk_rows += 1
+                    self._prune_disk()
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logging.warning(f"Could not persist classifier cache entry: {str(e)}")
+
+    def _prune_disk(self):
+        # Callers hold the lock. A write replaces its row with a new rowid, so rowid order is write order.
+        # Pruning goes 10% below the cap, so it runs once per batch of writes rather than on every one.
+        if self._disk_rows <= self.max_disk_entries:
+            return
+        keep = self.max_disk_entries * 9 // 10
+        self._db.execute(
+            "DELETE FROM classifier_cache WHERE rowid <= "
+            "(SELECT rowid FROM classifier_cache ORDER BY rowid DESC LIMIT 1 OFFSET ?)",
+            (keep,)
+        )
+        self._db.commit()
+        self._disk_rows = self._db.execute("SELECT COUNT(*) FROM classifier_cache").fetchone()[0]
+
+    def _remember(self, key: tuple, answer: str):
+        self._memory[key] = answer
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> Dict:
+        """Hit/miss counters for the metrics endpoint."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "max_entries": self.max_entries,
+            "disk_backed": self._db is not None,
+            "disk_entries": self._disk_rows,
+            "max_disk_entries": self.max_disk_entries
+        }
+
+
+def default_cache_path() -> str:
+    """Location of the on-disk cache: A2I2_CLASSIFIER_CACHE_DB, or results/ under the base dir."""
+    base_dir = os.getenv('A2I2_BASE_DIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return os.getenv("A2I2_CLASSIFIER_CACHE_DB", os.path.join(base_dir, "results", "classifier_cache.sqlite3"))
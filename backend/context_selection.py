@@ -0,0 +1,92 @@
+import os
+import threading
+from typing import Callable, Dict, List, Tuple
+
+DEFAULT_TOP_K = 5
+DEFAULT_TOKEN_BUDGET = 150
+# Rough tokens-per-character ratio of English text for OpenAI/Llama tokenizers
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count; close enough to budget prompt sections without a tokenizer."""
+    return max(1, (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN) if text else 0
+
+
+class ContextSelector:
+    """Picks which example lines of a category go into a turn prompt.
+
+    Lines are ranked against the latest utterance with the dialogue index
+    (semantic or keyword, see semantic_index) and taken best-first until
+    ``top_k`` lines or ``token_budget`` estimated tokens are reached; at least
+    one line is always kept. ``top_k`` of 0 disables selection.
+    """
+
+    def __init__(self, index: Callable, top_k: int = DEFAULT_TOP_K, token_budget: int = DEFAULT_TOKEN_BUDGET):
+        self._index = index
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens_full = 0
+        self.tokens_selected = 0
+
+    def select(self, character: str, category: str, lines: List[str], query: str) -> Tuple[List[str], Dict]:
+        """Return (selected lines in rank order, stats for retrieved_info)."""
+        if self.top_k <= 0 or len(lines) <= 1:
+            return lines, self._record(lines, lines)
+        available = set(lines)
+        ranked = [match["content"] for match in self._index().search(query, character=character, category=category, k=len(lines))
+                  if match["content"] in available]
+        # Lines the index does not know (or does not rank) keep their original order at the end
+        ranked_set = set(ranked)
+        candidates = ranked + [line for line in lines if line not in ranked_set]
+
+        selected = []
+        used = 0
+        for line in candidates:
+            if len(selected) >= self.top_k:
+                break
+            cost = estimate_tokens(line)
+            if selected and used + cost > self.token_budget:
+                continue
+            selected.append(line)
+            used += cost
+        return selected, self._record(lines, selected)
+
+    def _record(self, lines: List[str], selected: List[str]) -> Dict:
+        # The prompt shows the list as written by str(), so that is what is measured
+        full = estimate_tokens(str(lines))
+        kept = estimate_tokens(str(selected))
+        with self._lock:
+            self.requests += 1
+            self.tokens_full += full
+            self.tokens_selected += kept
+        return {
+            "lines_available": len(lines),
+            "lines_selected": len(selected),
+            "tokens_full": full,
+            "tokens_selected": kept,
+            "tokens_saved": full - kept
+        }
+
+    def stats(self) -> Dict:
+        """Totals for the metrics endpoint."""
+        with self._lock:
+            saved = self.tokens_full - self.tokens_selected
+            return {
+                "top_k": self.top_k,
+                "token_budget": self.token_budget,
+                "requests": self.requests,
+                "tokens_saved": saved,
+                "avg_tokens_saved": round(saved / self.requests, 1) if self.requests else 0.0
+            }
+
+
+def context_selector_from_env(index: Callable) -> ContextSelector:
+    """ContextSelector configured by A2I2_CONTEXT_TOP_K and A2I2_CONTEXT_TOKEN_BUDGET."""
+    return ContextSelector(
+        index,
+        top_k=int(os.getenv("A2I2_CONTEXT_TOP_K", str(DEFAULT_TOP_K))),
+        token_budget=int(os.getenv("A2I2_CONTEXT_TOKEN_BUDGET", str(DEFAULT_TOKEN_BUDGET)))
+    )
@@ -0,0 +1,527 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from typing import Dict, Iterator, Optional
+
+from session_store import SessionStore
+
+try:
+    import fcntl
+except ImportError:  # Windows: shared multi-worker sessions are unavailable
+    fcntl = None
+
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Rough per-message cost of the record, timestamp and flags on top of the text itself
+MESSAGE_OVERHEAD_BYTES = 200
+DEFAULT_MAX_MESSAGES = 64
+# Cross-process turn locks are spread over this many lock files by session ID hash
+LOCK_STRIPES = 256
+
+logger = logging.getLogger(__name__)
+
+
+def message_size(speaker: str, content: str) -> int:
+    """Approximate memory held by one stored message."""
+    return len(speaker.encode("utf-8")) + len(content.encode("utf-8")) + MESSAGE_OVERHEAD_BYTES
+
+
+class Message:
+    """One stored utterance. ``flags`` holds its classifier results, filled in once.
+
+    ``seq`` is the message's 1-based position in its session.
+    """
+    __slots__ = ("speaker", "content", "timestamp", "flags", "size", "seq")
+
+    def __init__(self, speaker: str, content: str, flags: Optional[Dict[str, bool]] = None, seq: int = 0):
+        self.speaker = speaker
+        self.content = content
+        self.timestamp = time.time()
+        self.flags = dict(flags) if flags else {}
+        self.size = message_size(speaker, content)
+        self.seq = seq
+
+
+class Session:
+    """A session's most recent messages in a ring buffer, plus its formatted history windows."""
+    __slots__ = ("messages", "total", "nbytes", "last_access", "history_cache", "version")
+
+    def __init__(self, max_messages: int):
+        self.messages = deque(maxlen=max_messages)
+        # Messages ever added, including those that fell out of the ring buffer
+        self.total = 0
+        self.nbytes = 0
+        self.last_access = time.time()
+        # get_history result per window size, valid until the next add_message
+        self.history_cache: Dict[int, str] = {}
+        # Token of the last write to the session store, to detect changes by other workers
+        self.version: Optional[str] = None
+
+
+class SessionLock:
+    """Turn lock for one session.
+
+    ``users`` counts the turns holding or waiting for the lock; a session with
+    users is never evicted, and once the last one leaves the manager forgets the
+    lock if its session is gone (cleared, discarded or evicted meanwhile).
+    """
+
+    def __init__(self, manager: "ConversationManager", session_id: str):
+        self._manager = manager
+        self._session_id = session_id
+        self._lock = asyncio.Lock()
+        self.users = 0
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    async def __aenter__(self):
+        self.users += 1
+        try:
+            await self._acquire()
+        except BaseException:
+            self._leave()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._release()
+        self._leave()
+
+    async def _acquire(self):
+        await self._lock.acquire()
+
+    def _release(self):
+        if self._lock.locked():
+            self._lock.release()
+
+    def _leave(self):
+        self.users -= 1
+        if not self.users:
+            self._manager._forget_lock(self._session_id, self)
+
+
+class SharedSessionLock(SessionLock):
+    """Turn lock for one session that also holds an exclusive file lock.
+
+    The file lock serializes the session's turns across worker processes; on
+    entry the in-memory copy is checked against the store and reloaded if
+    another worker has changed it. Lock files are picked by hashing the session
+    ID into ``LOCK_STRIPES`` files, so unrelated sessions rarely wait on each other.
+    """
+
+    def __init__(self, manager: "ConversationManager", session_id: str):
+        super().__init__(manager, session_id)
+        stripe = zlib.crc32(session_id.encode("utf-8")) % LOCK_STRIPES
+        self._path = os.path.join(manager.lock_dir, f"{stripe:03d}.lock")
+        self._fd: Optional[int] = None
+
+    async def _acquire(self):
+        await self._lock.acquire()
+        try:
+            self._fd = await self._acquire_file_lock()
+            self._manager.refresh(self._session_id)
+        except BaseException:
+            self._release()
+            raise
+
+    async def _acquire_file_lock(self) -> int:
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                # Poll instead of blocking, so the event loop keeps serving other sessions
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.05)
+            except BaseException:
+                os.close(fd)
+                raise
+
+    def _release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        super()._release()
+
+
+class ConversationManager:
+    """In-memory conversation histories, bounded by idle TTL, session count and bytes.
+
+    Sessions are kept in least-recently-used order. ``evict_expired`` (run
+    periodically in the background) drops sessions idle for longer than
+    ``idle_ttl`` seconds; the least recently used sessions are also evicted
+    whenever ``max_sessions`` or ``max_bytes`` is exceeded. ``None`` disables a
+    limit. Sessions with a turn in progress are never evicted. Each session
+    keeps only its last ``max_messages`` messages.
+
+    With a ``store``, every message is also written behind to disk, and a
+    session that is not in memory (after a restart or an eviction) is loaded
+    back the first time it is touched. With ``shared`` (several worker
+    processes on one store), turns also take a cross-process file lock and
+    reload the session if another worker changed it.
+    """
+
+    def __init__(self, idle_ttl: Optional[float] = None, max_sessions: Optional[int] = None,
+                 max_bytes: Optional[int] = None, max_messages: int = DEFAULT_MAX_MESSAGES,
+                 store: Optional[SessionStore] = None, shared: bool = False):
+        self.conversations: "OrderedDict[str, Session]" = OrderedDict()
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.total_bytes = 0
+        self.evictions = {"idle": 0, "lru": 0}
+        self.store = store
+        self.rehydrated = 0
+        self.reloads = 0
+        self.shared = shared
+        self.lock_dir = None
+        if shared:
+            if store is None or fcntl is None:
+                raise ValueError("Shared sessions need a session store and fcntl file locks")
+            self.lock_dir = store.db_path + ".locks"
+            os.makedirs(self.lock_dir, exist_ok=True)
+        # Auto mode adds messages from worker threads, so mutations are guarded
+        self._mutex = threading.RLock()
+        # One lock per session: turns of a session run one at a time, sessions run in parallel
+        self._locks: Dict[str, SessionLock] = {}
+
+    def create_session(self) -> str:
+        """Issue a new, unguessable session ID with an empty history."""
+        session_id = uuid.uuid4().hex
+        with self._mutex:
+            session = self.conversations[session_id] = Session(self.max_messages)
+            self._touch(session_id)
+            self._enforce_limits(keep=session_id)
+            if self.store is not None:
+                # Stored right away, so other workers (and restarts) know the ID before its first message
+                session.version = uuid.uuid4().hex
+                self.store.create(session_id, session.last_access, version=session.version)
+        return session_id
+
+    @staticmethod
+    def is_valid_session_id(session_id: str) -> bool:
+        return isinstance(session_id, str) and bool(SESSION_ID_PATTERN.match(session_id))
+
+    def has_session(self, session_id: str) -> bool:
+        """Whether the session exists, in memory or in the session store."""
+        return self.is_valid_session_id(session_id) and self._session(session_id) is not None
+
+    def session_lock(self, session_id: str) -> SessionLock:
+        """Lock that serializes the turns of one session (across workers when shared).
+
+        Raises KeyError for a session that does not exist, so unknown IDs never get a lock.
+        """
+        with self._mutex:
+            lock = self._locks.get(session_id)
+            if lock is None:
+                if self._session(session_id) is None:
+                    raise KeyError(f"Unknown session ID: {session_id}")
+                lock_class = SharedSessionLock if self.shared else SessionLock
+                lock = self._locks[session_id] = lock_class(self, session_id)
+        return lock
+
+    def refresh(self, session_id: str):
+        """Drop the in-memory copy of a session if the store has a newer version."""
+        if self.store is None:
+            return
+        with self._mutex:
+            session = self.conversations.get(session_id)
+            if session is not None and session.version != self.store.version(session_id):
+                self._drop(session_id)
+                self.reloads += 1
+        
+    def add_message(self, session_id: str, speaker: str, content: str, flags: Optional[Dict[str, bool]] = None):
+        """Add a message to the conversation history."""
+        with self._mutex:
+            session = self._session(session_id)
+            if session is None:
+                session = self.conversations[session_id] = Session(self.max_messages)
+
+            message = Message(speaker, content, flags, seq=session.total + 1)
+            if len(session.messages) == session.messages.maxlen:
+                # The oldest message is about to fall out of the ring buffer
+                dropped = session.messages[0].size
+                session.nbytes -= dropped
+                self.total_bytes -= dropped
+            session.messages.append(message)
+            session.total += 1
+            session.nbytes += message.size
+            self.total_bytes += message.size
+            session.history_cache.clear()
+            self._touch(session_id)
+            self._enforce_limits(keep=session_id)
+            if self.store is not None:
+                session.version = uuid.uuid4().hex
+                self.store.append(session_id, message.seq, speaker, content, message.timestamp, message.flags,
+                                  keep_from=session.messages[0].seq, version=session.version)
+
+    def annotate_message(self, session_id: str, flags: Dict[str, bool], index: int = -1):
+        """Store classifier results on a message (the latest one by default)."""
+        session = self._session(session_id)
+        if session is None or not session.messages:
+            return
+        message = session.messages[index]
+        message.flags.update(flags)
+        if self.store is not None:
+            session.version = uuid.uuid4().hex
+            self.store.update_flags(session_id, message.seq, message.flags, version=session.version)
+
+    def any_message_flagged(self, session_id: str, flag: str, speaker: Optional[str] = None,
+                            max_turns: Optional[int] = None, skip: int = 0) -> bool:
+        """Check whether any stored message was flagged by the classifier.
+
+        Only the last ``max_turns`` messages are considered (all by default), the
+        first ``skip`` of those are ignored, and ``speaker`` restricts the search
+        to one speaker (case-insensitive).
+        """
+        messages = list(self.iter_turns(session_id, max_turns))
+        for msg in messages[skip:]:
+            if speaker is not None and msg.speaker.lower() != speaker.lower():
+                continue
+            if msg.flags.get(flag):
+                return True
+        return False
+        
+    def message_count(self, session_id: str, max_turns: Optional[int] = None) -> int:
+        """Messages added to the session, capped at ``max_turns`` to match a history window."""
+        session = self._session(session_id)
+        if session is None:
+            return 0
+        if max_turns is not None:
+            return min(session.total, max_turns)
+        return session.total
+
+    def last_message(self, session_id: str, speaker: Optional[str] = None) -> Optional[Message]:
+        """The latest message, or the latest one from ``speaker`` (case-insensitive)."""
+        session = self._session(session_id)
+        if session is None:
+            return None
+        for msg in reversed(session.messages):
+            if speaker is None or msg.speaker.lower() == speaker.lower():
+                return msg
+        return None
+
+    def iter_turns(self, session_id: str, max_turns: Optional[int] = None) -> Iterator[Message]:
+        """Iterate over the stored messages (the last ``max_turns`` of them), oldest first."""
+        session = self._session(session_id)
+        if session is None:
+            return iter(())
+        messages = list(session.messages)
+        if max_turns is not None:
+            messages = messages[-max_turns:]
+        return iter(messages)
+
+    def get_history(self, session_id: str, max_turns: int = 7) -> str:
+        """Get the last ``max_turns`` messages as "speaker: content" lines.
+
+        The formatted window is cached until the next message is added, so
+        repeated calls within a turn do not rebuild it.
+        """
+        with self._mutex:
+            session = self._session(session_id)
+            if session is None:
+                logger.debug(f"No conversation found for session ID: {session_id}")
+                return ""
+            self._touch(session_id)
+            history = session.history_cache.get(max_turns)
+            if history is None:
+                start = max(len(session.messages) - max_turns, 0)
+                history = "\n".join(
+                    f"{msg.speaker}: {msg.content}"
+                    for i, msg in enumerate(session.messages) if i >= start
+                )
+                session.history_cache[max_turns] = history
+        return history
+    
+    def clear_session(self, session_id: str):
+        """Clear conversation history for a specific session.
+
+        The session stays issued, with an empty history, so the client keeps using its ID.
+        """
+        with self._mutex:
+            # A session that is only on disk is loaded first, so it is reported as cleared
+            if self._session(session_id) is None:
+                logger.debug(f"No conversation found for session ID: {session_id}")
+                return False
+            session = self._install(session_id, 0, [])
+            if self.store is not None:
+                session.version = uuid.uuid4().hex
+                self.store.delete(session_id)
+                self.store.create(session_id, session.last_access, version=session.version)
+        logger.info(f"Cleared conversation history for session ID: {session_id}")
+        return True
+
+    def export_session(self, session_id: str, max_messages: Optional[int] = None) -> Dict:
+        """The session's last ``max_messages`` messages and classifier flags as plain data.
+
+        The result is ``{"total": n, "messages": [[speaker, content, timestamp, flags], ...]}``,
+        the form ``import_session`` accepts (and the payload of a stateless state token).
+        """
+        with self._mutex:
+            session = self._session(session_id)
+            if session is None:
+                return {"total": 0, "messages": []}
+            messages = list(session.messages)
+            if max_messages is not None:
+                messages = messages[-max_messages:]
+            return {
+                "total": session.total,
+                "messages": [[msg.speaker, msg.content, int(msg.timestamp), msg.flags] for msg in messages]
+            }
+
+    def import_session(self, session_id: str, state: Dict):
+        """Replace a session's contents with data from ``export_session``."""
+        messages = state.get("messages", [])[-self.max_messages:]
+        total = max(int(state.get("total", 0)), len(messages))
+        first = total - len(messages) + 1
+        rows = [(first + i, str(speaker), str(content), float(timestamp), dict(flags or {}))
+                for i, (speaker, content, timestamp, flags) in enumerate(messages)]
+        with self._mutex:
+            self._install(session_id, total, rows)
+
+    def discard_session(self, session_id: str):
+        """Forget a session without logging it as cleared (used for per-request sessions)."""
+        if self.store is not None:
+            self.store.delete(session_id)
+        self._drop(session_id)
+
+    def evict_expired(self, now: Optional[float] = None) -> int:
+        """Drop sessions idle for longer than the TTL, then enforce the size limits.
+
+        Returns the number of sessions evicted.
+        """
+        now = time.time() if now is None else now
+        evicted = 0
+        with self._mutex:
+            if self.idle_ttl is not None:
+                cutoff = now - self.idle_ttl
+                # Sessions are in access order, so the scan stops at the first fresh one
+                for session_id in list(self.conversations):
+                    if self.conversations[session_id].last_access > cutoff:
+                        break
+                    if self._in_use(session_id):
+                        continue
+                    self._drop(session_id)
+                    self.evictions["idle"] += 1
+                    evicted += 1
+            evicted += self._enforce_limits()
+        if self.store is not None:
+            self.store.expire(now)
+        if evicted:
+            logger.info(f"Evicted {evicted} idle or least recently used sessions")
+        return evicted
+
+    def stats(self) -> Dict:
+        """Session counters for the metrics endpoint."""
+        with self._mutex:
+            stats = {
+                "live_sessions": len(self.conversations),
+                "messages": sum(len(session.messages) for session in self.conversations.values()),
+                "approx_bytes": self.total_bytes,
+                "evictions": dict(self.evictions),
+                "idle_ttl": self.idle_ttl,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "rehydrated": self.rehydrated,
+                "reloads": self.reloads,
+                "shared": self.shared
+            }
+        if self.store is not None:
+            stats["store"] = self.store.stats()
+        return stats
+
+    def close(self):
+        """Flush pending writes to the session store."""
+        if self.store is not None:
+            self.store.close()
+
+    def _session(self, session_id: str) -> Optional[Session]:
+        """The in-memory session, loaded back from the store if it is only on disk."""
+        session = self.conversations.get(session_id)
+        if session is not None or self.store is None:
+            return session
+        with self._mutex:
+            session = self.conversations.get(session_id)
+            if session is None:
+                session = self._rehydrate(session_id)
+        return session
+
+    def _rehydrate(self, session_id: str) -> Optional[Session]:
+        stored = self.store.load(session_id, self.max_messages)
+        if stored is None:
+            return None
+        total, version, rows = stored
+        session = self._install(session_id, total, rows)
+        session.version = version
+        self.rehydrated += 1
+        logger.debug(f"Rehydrated session {session_id} with {len(rows)} messages")
+        return session
+
+    def _install(self, session_id: str, total: int, rows) -> Session:
+        """Put a session built from (seq, speaker, content, timestamp, flags) rows in memory."""
+        replaced = self.conversations.pop(session_id, None)
+        if replaced is not None:
+            self.total_bytes -= replaced.nbytes
+        session = Session(self.max_messages)
+        for seq, speaker, content, timestamp, flags in rows:
+            message = Message(speaker, content, flags, seq=seq)
+            message.timestamp = timestamp
+            session.messages.append(message)
+            session.nbytes += message.size
+        session.total = total
+        self.conversations[session_id] = session
+        self.total_bytes += session.nbytes
+        self._touch(session_id)
+        self._enforce_limits(keep=session_id)
+        return session
+
+    def _touch(self, session_id: str):
+        self.conversations.move_to_end(session_id)
+        self.conversations[session_id].last_access = time.time()
+
+    def _in_use(self, session_id: str) -> bool:
+        lock = self._locks.get(session_id)
+        return lock is not None and lock.users > 0
+
+    def _forget_lock(self, session_id: str, lock: SessionLock):
+        """Drop a session's lock after its last turn if the session no longer exists."""
+        with self._mutex:
+            if self._locks.get(session_id) is lock and session_id not in self.conversations:
+                del self._locks[session_id]
+
+    def _over_limits(self) -> bool:
+        return ((self.max_sessions is not None and len(self.conversations) > self.max_sessions) or
+                (self.max_bytes is not None and self.total_bytes > self.max_bytes))
+
+    def _enforce_limits(self, keep: Optional[str] = None) -> int:
+        """Evict least recently used sessions until the count and byte limits hold."""
+        evicted = 0
+        while self._over_limits():
+            victim = next((session_id for session_id in self.conversations
+                           if session_id != keep and not self._in_use(session_id)), None)
+            if victim is None:
+                break
+            self._drop(victim)
+            self.evictions["lru"] += 1
+            evicted += 1
+        return evicted
+
+    def _drop(self, session_id: str) -> bool:
+        with self._mutex:
+            if not self._in_use(session_id):
+                self._locks.pop(session_id, None)
+            session = self.conversations.pop(session_id, None)
+            if session is None:
+                return False
+            self.total_bytes -= session.nbytes
+            return True
@@ -0,0 +1,130 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DegradationController:
+    """Decides whether turns may use the LLM, from the latency and errors of recent calls.
+
+    Every model call is recorded in a rolling window. Once the window holds at
+    least ``min_samples`` calls and its p95 latency exceeds ``p95_threshold``
+    seconds or its error rate reaches ``error_rate_threshold``, the controller
+    is degraded: new turns are answered locally (state machine, keyword checks
+    and category lines) instead. While degraded, turns may go to the model again
+    once ``probe_interval`` seconds have passed since the last probe call; the
+    first model call such a turn makes is the next probe, and a probe that
+    succeeds within the latency threshold switches back to normal. Calls that
+    were already in flight when the controller degraded are not probes.
+    """
+
+    def __init__(self, p95_threshold: float = 8.0, error_rate_threshold: float = 0.5, window: int = 50,
+                 min_samples: int = 5, probe_interval: float = 15.0, enabled: bool = True):
+        self.p95_threshold = p95_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_samples = min_samples
+        self.probe_interval = probe_interval
+        self.enabled = enabled
+        self._calls = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.degraded = False
+        self._degraded_since = 0.0
+        self._last_probe = 0.0
+        self.degraded_turns = 0
+        self.probes = 0
+        self.switches = 0
+
+    def record(self, seconds: float, ok: bool, started: Optional[float] = None):
+        """Add one model call (its duration, and whether it succeeded) to the window.
+
+        ``started`` is the call's ``time.monotonic()`` start, which tells probes
+        apart from calls that began before the controller degraded.
+        """
+        with self._lock:
+            if self.degraded:
+                if started is not None and started < self._degraded_since:
+                    return
+                # Any call started while degraded is a probe of the backend
+                if ok and seconds <= self.p95_threshold:
+                    self.degraded = False
+                    self._calls.clear()
+                    logger.warning(f"LLM backend recovered after {time.monotonic() - self._degraded_since:.0f}s, leaving degraded mode")
+                return
+            self._calls.append((seconds, ok))
+            if not self.enabled or len(self._calls) < self.min_samples:
+                return
+            p95, error_rate = self._window_stats()
+            if p95 > self.p95_threshold or error_rate >= self.error_rate_threshold:
+                self.degraded = True
+                self.switches += 1
+                self._degraded_since = self._last_probe = time.monotonic()
+                logger.warning(f"LLM backend degraded (p95 {p95:.2f}s, error rate {error_rate:.0%}), "
+                               f"answering turns from local templates")
+
+    @contextmanager
+    def track(self):
+        """Time the model call in the ``with`` block and record it; exceptions (not cancellation) count as errors."""
+        start = time.monotonic()
+        with self._lock:
+            if self.degraded:
+                # The probe interval counts from the last call that actually reached the model
+                self._last_probe = start
+                self.probes += 1
+        try:
+            yield
+        except Exception:
+            self.record(time.monotonic() - start, False, started=start)
+            raise
+        self.record(time.monotonic() - start, True, started=start)
+
+    def use_model(self) -> bool:
+        """Whether a new turn should go to the model (always, unless degraded and no probe is due).
+
+        A due probe is only used up once a turn actually calls the model, so turns
+        answered without it (retrieval, response cache) leave it for the next turn.
+        """
+        with self._lock:
+            if not self.degraded or time.monotonic() - self._last_probe >= self.probe_interval:
+                return True
+            self.degraded_turns += 1
+            return False
+
+    def _window_stats(self):
+        # Callers hold the lock
+        latencies = sorted(seconds for seconds, _ in self._calls)
+        p95 = latencies[max(0, math.ceil(0.95 * len(latencies)) - 1)] if latencies else 0.0
+        errors = sum(1 for _, ok in self._calls if not ok)
+        return p95, errors / len(self._calls) if self._calls else 0.0
+
+    def stats(self) -> Dict:
+        """Current mode and window figures for the metrics endpoint."""
+        with self._lock:
+            p95, error_rate = self._window_stats()
+            return {
+                "enabled": self.enabled,
+                "degraded": self.degraded,
+                "p95_seconds": round(p95, 3),
+                "error_rate": round(error_rate, 4),
+                "window_calls": len(self._calls),
+                "degraded_turns": self.degraded_turns,
+                "probes": self.probes,
+                "switches": self.switches
+            }
+
+
+def degradation_from_env() -> DegradationController:
+    """DegradationController configured by the A2I2_DEGRADE_* variables."""
+    return DegradationController(
+        p95_threshold=float(os.getenv("A2I2_DEGRADE_P95", "8")),
+        error_rate_threshold=float(os.getenv("A2I2_DEGRADE_ERROR_RATE", "0.5")),
+        window=int(os.getenv("A2I2_DEGRADE_WINDOW", "50")),
+        min_samples=int(os.getenv("A2I2_DEGRADE_MIN_CALLS", "5")),
+        probe_interval=float(os.getenv("A2I2_DEGRADE_PROBE_INTERVAL", "15")),
+        enabled=os.getenv("A2I2_DEGRADE", "1").lower() not in ("0", "false", "no", "off")
+    )
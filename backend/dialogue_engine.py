@@ -0,0 +1,1574 @@
+from GeneratorModel import ResilientGenerator, generator_from_env
+from conversation import ConversationManager
+from session_store import open_session_store, shared_sessions_enabled
+from log_config import log_dump, should_dump
+from classifier_cache import ClassifierCache, default_cache_path, prompt_version
+from local_classifier import local_classifier_from_env
+from context_selection import context_selector_from_env
+from degradation import degradation_from_env
+from response_cache import response_cache_from_env
+from retrieval_responder import retrieval_responder_from_env
+from semantic_index import DEFAULT_DIALOGUE_FILE, dialogue_lines, open_dialogue_index
+#from em_retriever import *
+import asyncio
+import json
+import re
+import os
+from typing import List, Dict, Optional
+import time
+import random
+import logging
+import sys
+import threading
+import urllib3
+import http.client
+import warnings
+
+# LLM backend, created by use_backend() when an entry module (ollama_0220_openai,
+# ollama_0220) is imported. Calls get a deadline, retries with jittered backoff
+# on 429/5xx and a circuit breaker (see GeneratorModel).
+generator: Optional[ResilientGenerator] = None
+
+def use_backend(default_backend: str) -> ResilientGenerator:
+    """Create the LLM backend named by A2I2_LLM_BACKEND (else ``default_backend``), once per process."""
+    global generator
+    if generator is None:
+        generator = generator_from_env(default_backend)
+    return generator
+
+def local_model_prompts() -> bool:
+    """Whether to use the prompt variants written for the small local model (the ollama backend)."""
+    return generator.name == "ollama"
+
+# Latency and error rate of every model call; when they get too high, turns are answered locally
+degradation = degradation_from_env()
+
+# Disable all HTTP request logging
+os.environ['PYTHONWARNINGS'] = 'ignore'
+urllib3.disable_warnings()
+logging.getLogger('urllib3').setLevel(logging.ERROR)
+logging.getLogger('requests').setLevel(logging.ERROR)
+logging.getLogger('http.client').setLevel(logging.ERROR)
+logging.getLogger('urllib3.connectionpool').setLevel(logging.ERROR)
+logging.getLogger('requests.packages.urllib3').setLevel(logging.ERROR)
+http.client.HTTPConnection.debuglevel = 0
+# Disable all warnings
+warnings.filterwarnings('ignore')
+
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+for module in ['urllib3', 'requests', 'http.client', 'asyncio', 'websockets']:
+    logging.getLogger(module).setLevel(logging.ERROR)
+logger = logging.getLogger(__name__)
+
+prompt_1 = """System: The following conversation is between a Fire Department Agent and a TownPerson {name} who needs to be rescued during a fire emergency. 
+Here is the persona of {name}:
+{persona}
+Use this example as a guide:
+{dialogue}
+Now, generate a single utterance that Agent said to {name} as the start of the conversation.
+
+Format your output as:
+[Name]: Content
+"""
+
+prompt_2 = """System: The following conversation is between a Fire Department Agent and a TownPerson {name} during a fire emergency. 
+
+Here is an introduction of {name}:
+{persona}
+Use this example as a guide:
+{dialogue}
+Based on the conversation history:
+{history} 
+Generate one response for the next turn. The next utterance must be solely from the {speaker},and it should start with mentioning {next_speaker}.  Do not include any additional utterances or explanations.
+
+Format your output as:
+[Name]: Content
+"""
+
+# Add a new prompt template for interactive mode
+prompt_interactive = """System: You are a Fire Department Agent speaking with TownPerson {name} during a fire emergency. 
+
+Here is {name}'s background:
+{persona}
+
+Use this example dialogue as a guide for the tone and style:
+{dialogue}
+
+Current conversation:
+{history}
+
+You are the Fire Department Agent. Generate a single response to {name}'s message. Be direct, professional, and focused on ensuring their safety.
+
+Format your output as a direct response without any name prefix or additional context."""
+
+class DialogueVectorStore:
+    def __init__(self):
+        self.character_responses = {}
+        self.operator_responses = {}
+        self.operator_response_categories = ['greetings', 'progression', 'observations', 'closing', 'emphasize_danger', 'emphasize_value_of_life', 'give_up_persuading']
+        self.character_response_categories = ['greetings', 'response_to_operator_greetings', 'progression', 'observations', 'general', 'closing']
+        self._index = None
+        self._index_lock = threading.Lock()
+
+    def add_dialogues(self, file_path):
+        """Load character responses from JSONL file."""
+        try:
+            with open(file_path, 'r') as file:
+                for line_num, line in enumerate(file, 1):
+                    # Skip empty lines
+                    line = line.strip()
+                    if not line:
+                        continue
+                        
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        logging.warning(f"Skipping invalid JSON at line {line_num}: {str(e)}")
+                        continue
+                    if 'character' not in data:
+                        logging.warning(f"Skipping line {line_num} without a character")
+                        continue
+                    if data['character'] == 'operator':
+                        # Store operator responses
+                        for category in self.operator_response_categories:
+                            if category in data:
+                                if category not in self.operator_responses:
+                                    self.operator_responses[category] = []
+                                self.operator_responses[category].extend(data[category])
+                    # Store character responses (the operator's lines too)
+                    for category in self.character_response_categories:
+                        if category not in data:
+                            data[category] = []
+                    self.character_responses[data['character']] = data
+                        
+            if not self.character_responses:
+                logging.warning("No valid character responses were loaded")
+            else:
+                logging.info(f"Loaded responses for characters: {list(self.character_responses.keys())}")
+                logging.info(f"Loaded operator responses for contexts: {list(self.operator_responses.keys())}")
+                
+        except Exception as e:
+            logging.error(f"Error loading dialogues: {str(e)}")
+            raise
+
+    @property
+    def index(self):
+        """Search index over every loaded line (semantic when available), opened on first search.
+
+        Servers open it ahead of time with ``warm_index`` in a worker thread; the
+        lock keeps concurrent first searches from building it twice.
+        """
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._index = open_dialogue_index(
+                        dialogue_lines(self.character_responses, self.operator_responses)
+                    )
+        return self._index
+
+    def warm_index(self):
+        """Open the search index (and load the encoder) now instead of on the first turn."""
+        started = time.perf_counter()
+        index = self.index
+        logging.info(f"Dialogue index {type(index).__name__} ready in {time.perf_counter() - started:.2f}s")
+
+    def search(self, query: str, character: str = None, k: int = 3, category: str = None) -> List[Dict]:
+        """The ``k`` loaded lines most relevant to ``query``, optionally of one character and category."""
+        return self.index.search(query, character=character, category=category, k=k)
+
+    def get_response(self, character, category):
+        """Get a response for a specific character and category."""
+        if character not in self.character_responses:
+            raise ValueError(f"Character {character} not found")
+        
+        if category not in self.response_categories:
+            raise ValueError(f"Category {category} not valid")
+            
+        responses = self.character_responses[character].get(category, [])
+        return random.choice(responses) if responses else ""
+
+    def get_character_context(self, character):
+        """Get all responses for a character for context."""
+        if character not in self.character_responses:
+            return ""
+        
+        context = []
+        for category in self.response_categories:
+            responses = self.character_responses[character].get(category, [])
+            if responses:
+                context.extend(responses)
+        return " ".join(context)
+
+    def get_operator_response(self, context: str) -> str:
+        """Get a response for the operator/agent based on context."""
+        if context not in self.operator_responses or not self.operator_responses[context]:
+            context = 'general'  # fallback to general responses
+            
+        responses = self.operator_responses.get(context, [])
+        if not responses:
+            return "I understand. Please proceed with evacuation for your safety."
+            
+        return random.choice(responses)
+
+
+# Initialize global instances
+vector_store = DialogueVectorStore()
+# Trims the example lines put into prompts to the ones closest to the latest utterance
+context_selector = context_selector_from_env(lambda: vector_store.index)
+# Replies to near-duplicate operator utterances in the same dialogue state are served without the model
+response_cache = response_cache_from_env(lambda: vector_store.index)
+# Turns whose transition only picks a line from its category are answered from the lines directly
+retrieval_responder = retrieval_responder_from_env(lambda: vector_store.index)
+# Idle sessions expire and the least recently used ones go first when the limits are reached
+conversation_manager = ConversationManager(
+    idle_ttl=float(os.getenv("A2I2_SESSION_TTL", "3600")),
+    max_sessions=int(os.getenv("A2I2_MAX_SESSIONS", "1000")),
+    max_bytes=int(os.getenv("A2I2_SESSION_MAX_BYTES", str(64 * 1024 * 1024))),
+    max_messages=int(os.getenv("A2I2_SESSION_MAX_MESSAGES", "64")),
+    store=open_session_store(),
+    shared=shared_sessions_enabled()
+)
+# Classifier answers are pure functions of their input, so repeated phrases are served from cache
+classifier_cache = ClassifierCache(
+    db_path=default_cache_path() or None,
+    max_entries=int(os.getenv("A2I2_CLASSIFIER_CACHE_SIZE", "4096")),
+    max_disk_entries=int(os.getenv("A2I2_CLASSIFIER_CACHE_DB_SIZE", "100000"))
+)
+# Lexical classifier that answers confident checks on CPU; the LLM only sees the uncertain ones
+local_classifier = local_classifier_from_env()
+
+# Load dialogues if the file exists; it is the server's DIAL_FILE_PATH too, so the index ranks every line the state machine offers
+dialogue_file = DEFAULT_DIALOGUE_FILE
+if os.path.exists(dialogue_file):
+    
+    vector_store.add_dialogues(dialogue_file)
+   
+else:
+    logging.error(f"Warning: Dialogue file not found at {dialogue_file}")
+    logging.error(f"Current working directory: {os.getcwd()}")
+
+
+prompt_rag = """System: You are a Fire Department Agent speaking with TownPerson {name} during a fire emergency.
+
+{name}'s background:
+{persona}
+
+Relevant conversation examples:
+{context}
+
+Current conversation history:
+{history}
+
+Based on {name}'s background and the conversation examples, you are the operator to provide an intial greeting for fire rescue.
+Format your output as a direct response without any name prefix or additional context."""
+
+def send_prompt(prompt: str, json_mode: bool = False) -> str:
+    """Query the configured LLM backend with the given prompt."""
+    try:
+        with degradation.track():
+            return generator.generate(prompt, json_mode)
+    except Exception as e:
+        logging.error(f"Error calling {generator.name} backend: {str(e)}")
+        raise
+
+async def send_prompt_async(prompt: str, json_mode: bool = False) -> str:
+    """Query the LLM backend without blocking the event loop."""
+    try:
+        with degradation.track():
+            return await generator.agenerate(prompt, json_mode)
+    except Exception as e:
+        logging.error(f"Error calling {generator.name} backend: {str(e)}")
+        raise
+
+async def stream_prompt_async(prompt: str):
+    """Yield completion text from the LLM backend as tokens arrive."""
+    try:
+        with degradation.track():
+            async for token in generator.astream(prompt):
+                yield token
+    except Exception as e:
+        logging.error(f"Error streaming from {generator.name} backend: {str(e)}")
+        raise
+
+async def close_async_client():
+    """Release the pooled connections held by the LLM backend."""
+    await generator.aclose()
+
+# A leading speaker label of up to three words, e.g. "Bob:", "Fire Department Agent:" or "[Bob]:"
+SPEAKER_PREFIX = re.compile(r"^\[?[A-Za-z][\w'-]*(?: [A-Za-z][\w'-]*){0,2}\]?\s*:\s*")
+# The start of a reply that may still turn into a speaker label once more tokens arrive
+PARTIAL_SPEAKER_PREFIX = re.compile(r"^\[?(?:[A-Za-z][\w'-]*(?: [A-Za-z][\w'-]*){0,2} ?)?\]?$")
+# Role labels the model sometimes repeats inside its reply
+INLINE_LABELS = ("Agent:", "Operator:")
+
+def clean_response(response: str) -> str:
+    """Clean up model response by removing prefixes and system messages.
+
+    Drops a leading <think>...</think> block, then a leading speaker label,
+    then any inline role labels. StreamCleaner applies the same rules to streams.
+    """
+    response = response.strip()
+    if response.startswith("<think>") and "</think>" in response:
+        response = response.split("</think>", 1)[1].strip()
+    response = SPEAKER_PREFIX.sub("", response, count=1)
+    for label in INLINE_LABELS:
+        response = response.replace(label, "")
+    return response.strip()
+
+def _label_start_length(text: str) -> int:
+    """Length of the longest end of ``text`` that could be the start of an inline label."""
+    for length in range(min(len(text), max(len(label) for label in INLINE_LABELS) - 1), 0, -1):
+        if any(label.startswith(text[-length:]) for label in INLINE_LABELS):
+            return length
+    return 0
+
+class StreamCleaner:
+    """Incremental counterpart of clean_response for streamed replies.
+
+    Holds back the start of the stream until it can tell whether the model
+    began with a <think> block or a speaker label ("Bob: ..."), drops them, then
+    passes tokens through with inline role labels removed (holding back a few
+    characters that may be the start of one). The tokens add up to clean_response
+    of the whole reply, up to surrounding whitespace.
+    """
+    PREFIX_WINDOW = 40
+
+    def __init__(self):
+        self.buffer = ""
+        self.pending = ""
+        self.started = False
+        self.emitted = False
+
+    def feed(self, token: str) -> str:
+        if self.started:
+            return self._body(token)
+        self.buffer += token
+        text = self.buffer.lstrip()
+        if text.startswith("<think>"):
+            if "</think>" not in text:
+                return ""
+            text = self.buffer = text.split("</think>", 1)[1].lstrip()
+        elif text and "<think>".startswith(text):
+            return ""
+        match = SPEAKER_PREFIX.match(text)
+        if match:
+            self.started = True
+            return self._body(text[match.end():])
+        if PARTIAL_SPEAKER_PREFIX.match(text) and len(text) < self.PREFIX_WINDOW:
+            return ""
+        self.started = True
+        return self._body(text)
+
+    def _body(self, token: str) -> str:
+        text = self.pending + token
+        for label in INLINE_LABELS:
+            text = text.replace(label, "")
+        if not self.emitted:
+            text = text.lstrip()
+        held = _label_start_length(text)
+        self.pending = text[len(text) - held:] if held else ""
+        text = text[:len(text) - held]
+        if text:
+            self.emitted = True
+        return text
+
+    def flush(self) -> str:
+        if self.started:
+            text, self.pending = self.pending, ""
+            return text.rstrip() if self.emitted else text.strip()
+        self.started = True
+        return clean_response(self.buffer)
+
+def simulate_dual_role_conversation(
+    persona: str,
+    name: str,
+    session_id: Optional[str] = None
+) -> str:
+    """
+    Simulate a conversation using LLM while following a specific conversation flow structure.
+    """
+    if session_id is None:
+        session_id = f"{name}_{int(time.time())}"
+        
+    # Convert name to lowercase for character matching
+    character = name.lower()
+        
+    # Auto mode: generate responses following conversation flow structure
+    history = ""
+    retrieved_info_list = []
+    
+    # Initial operator greeting
+    greeting_prompt = prompt_rag.format(
+        name=name,
+        persona=persona,
+        context="Example greeting: Hello hi, this is Fire Department dispatcher Tanay. Are you okay?",
+        history="",
+        speaker="Agent"
+    )
+    initial_response = clean_response(send_prompt(greeting_prompt))
+    conversation_manager.add_message(session_id, "Agent", initial_response)
+    
+    history = f"Agent: {initial_response}\n"
+    
+    # Add retrieved info for initial greeting
+    operator_greetings = vector_store.operator_responses.get('greetings', [])
+    retrieved_info_list.append({
+        'speaker': 'Agent',
+        'category': 'greetings',
+        'examples': operator_greetings,
+        'context': f"Category: Greetings\nSpeaker: Agent\n\nExample responses:\n" + "\n".join([f"- {greeting}" for greeting in operator_greetings])
+    })
+    
+    # Conversation flow structure with prompts
+    if character == "bob":
+        conversation_structure = [
+            {
+                "speaker": name,
+            "prompt": """System: You are {name} responding to a Fire Department Agent during an emergency.
+            Based on your background: {persona}
+            
+            Relevant examples:
+            {context}
+            
+            Generate a single-sentence response showing initial resistance to evacuation.
+            Keep your response to one brief sentence that reflects your character's background.
+            
+            Current conversation:
+            {history}
+            
+            Format your output as a direct response without any prefix.""",
+            "category": "response_to_operator_greetings"
+        },
+        {
+            "speaker": "Agent",
+            "prompt": """System: You are a Fire Department Agent responding to {name}'s reluctance to evacuate.
+            Based on these example responses:
+            {context}
+            
+            Generate a single-sentence urgent warning about the fire danger.
+            Keep your response to one brief sentence that matches the professional and authoritative tone of the examples.
+            
+            Current conversation:
+            {history}
+            
+            Format your output as a direct response without any prefix.""",
+            "category": "emphasize_danger"
+        },
+        {
+            "speaker": name,
+            "prompt": """System: You are {name} still showing resistance to evacuation.
+            Based on your background: {persona}
+            
+            Relevant examples:
+            {context}
+            
+            Generate a single-sentence response expressing specific concerns based on your background.
+            Keep your response to one brief sentence that reflects your character's background.
+            
+            Current conversation:
+            {history}
+            
+            Format your output as a direct response without any prefix.""",
+            "category": "response_to_operator_greetings"
+        },
+        {
+            "speaker": "Agent",
+            "prompt": """System: You are a Fire Department Agent making a final plea about life safety.
+            Based on these example responses:
+            {context}
+            
+            Generate a single-sentence response emphasizing life over property.
+            Keep your response to one brief sentence that matches the professional and authoritative tone of the examples.
+            
+            Current conversation:
+            {history}
+            
+            Format your output as a direct response without any prefix.""",
+            "category": "emphasize_value_of_life"
+        },
+        {
+            "speaker": name,
+            "prompt": """System: You are {name} starting to agree to evacuate.
+            Based on your background: {persona}
+            
+            Relevant examples:
+            {context}
+            
+            Generate a single-sentence response showing your agreement to evacuate.
+            Keep your response to one brief sentence that reflects your character's background.
+            
+            Current conversation:
+            {history}
+            
+            Format your output as a direct response without any prefix.""",
+            "category": "progression"
+        },
+        {
+            "speaker": "Agent",
+            "prompt": """System: You are a Fire Department Agent responding to {name}'s agreement to evacuate.
+            Based on these example responses:
+            {context}
+            
+            Generate a single-sentence response about the importance of evacuating.
+            Keep your response to one brief sentence that matches the professional and authoritative tone of the examples.
+            
+            Current conversation:
+            {history}
+            
+            Format your output as a direct response without any prefix.""",
+            "category": "progression"
+        },
+        {
+            "speaker": name,
+            "prompt": """System: You are {name} finally agreeing to evacuate.
+            Based on your background: {persona}
+            
+            Relevant examples:
+            {context}
+            
+            Generate a single-sentence response showing your agreement to evacuate.
+            Keep your response a few words.
+            
+            Current conversation:
+            {history}
+            
+            Format your output as a direct response without any prefix.""",
+            "category": "closing"
+        }
+        ]
+        
+        
+    
+    elif character == "niki":
+        conversation_structure = [
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} responding to a Fire Department Agent during an emergency.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to the operator's greeting.  
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "response_to_operator_greetings"
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s response to your greeting.
+                Based on these example responses:
+                {context}
+                
+                Generate a single-sentence response to previous message.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "emphasize_danger"
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} showing agreement to evacuation.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to the operator's message.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "progression"
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s agreement to evacuate.
+                Based on these example responses:
+                {context}
+                
+                Generate a single-sentence response to previous message.
+                Keep your response to one brief sentence that matches the professional and authoritative tone of the examples.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "closing"
+            },
+            {   
+                "speaker": name,
+                "prompt": """System: You are {name} finally agreeing to evacuate.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to the operator's message.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "closing"
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s agreement to evacuate.
+                Based on these example responses:
+                {context}
+                
+                Generate a single-sentence response to previous message.
+                Keep your response to one brief sentence that matches the professional and authoritative tone of the examples.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "closing"
+            }
+        ]  
+    elif character == "lindsay":
+        conversation_structure = [
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} responding to a Fire Department Agent during an emergency.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+
+                Generate a single-sentence response to the operator's greeting.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "response_to_operator_greetings"
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s response to your greeting.
+                Based on these example responses:
+                {context}
+                
+                Generate a single-sentence response to previous message and emphasize the danger.
+                Keep your response to one brief sentence.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "emphasize_danger"
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} showing agreement to evacuation.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to the operator's or julie's message.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "progression"
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s agreement to evacuate.
+                Based on these example responses:
+                {context}
+                
+                Generate a single-sentence response to previous message.
+                Keep your response to one brief sentence that matches the professional and authoritative tone of the examples.
+                
+                Current conversation:
+                {history}
+
+                Format your output as a direct response without any prefix.""",
+                "category": "closing"
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} finally agreeing to evacuate.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to the operator's message.   
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "closing"   
+            }
+        ]  
+    elif character == "ross":
+        conversation_structure = [
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} responding to a Fire Department Agent during an emergency.
+                Based on your background: {persona}
+
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to the operator's greeting.
+                Keep your response to one brief sentence that reflects your character's background. 
+                
+                Current conversation:   
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "response_to_operator_greetings"
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s response to your greeting.
+                Based on these example responses:
+                {context}
+                
+                Generate a single-sentence response to previous message, mention to send the tWransportation vehicle.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "emphasize_danger"
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} showing agreement to evacuation.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to the operator's message.   
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""", 
+                "category": "progression"   
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s agreement to evacuate.
+                Based on these example responses:
+                {context}
+                
+                Generate a single-sentence response to previous message and try to close the conversation.
+                Keep your response to one brief sentence that matches the professional and authoritative tone of the examples.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "closing"
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} finally agreeing to evacuate.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to appreciate the operator's support and close the conversation.   
+                Keep your response to one brief sentence.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "closing"
+            }
+        ]
+    elif character == "michelle":
+        conversation_structure = [
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} responding to a Fire Department Agent during an emergency.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to the operator's greeting.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:   
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "response_to_operator_greetings"
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s response to your greeting.
+                Based on these example responses:
+                {context}
+                
+                Generate a single-sentence response to previous message.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "emphasize_danger"
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} showing resistance to evacuation.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+
+                Generate a single-sentence response to the operator's message.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "resistance"
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s resistance to evacuation.
+                Based on these example responses:
+                {context}
+                
+                Generate a single-sentence response to previous message and emphasize the value of her life.
+                Keep your response to one brief sentence that matches the professional and authoritative tone of the examples.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "emphasize_value_of_life"
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} showing agreement to evacuation.
+                Based on your background: {persona} 
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to the operator's message and agree to evacuate.
+                Keep your response to one brief sentence that reflects your character's background. 
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "progression"
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s agreement to evacuate.
+                Based on these example responses:
+                {context}
+                
+                Generate a single-sentence response to previous message and try to close the conversation.
+                Keep your response to one brief sentence that matches the professional and authoritative tone of the examples.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "closing"
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} finally agreeing to evacuate.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to show agreeing to evacuate and close the conversation.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "closing"
+            }
+        ]
+    elif character == "mary" or character == "ben" or character == "ana" or character == "tom" or character == "mia":
+        conversation_structure = [
+            {
+                "speaker": name,
+                "prompt": """System: You are {name} responding to a Fire Department Agent during an emergency.
+                Based on your background: {persona}
+                
+                Relevant examples:
+                {context}
+                
+                Generate a single-sentence response to the operator's greeting.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:   
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+                "category": "response_to_operator_greetings"
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s response.
+                
+                Generate a single-sentence response to previous message.
+                Keep your response to one brief sentence that reflects your character's background.
+                
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix."""
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name}.
+                Based on your background: {persona},
+                Generate a single-sentence response to the operator's message.
+                Keep your response to one brief sentence that reflects your character's background.
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s response.
+                Generate a single-sentence response to previous message.
+                Keep your response to one brief sentence that reflects your character's background.
+                Current conversation:
+                {history}
+                
+                Format your output as a direct response without any prefix.""",
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name}.
+                Based on your background: {persona},
+                Generate a single-sentence response to the operator's message.
+                Keep your response to one brief sentence that reflects your character's background.
+                Current conversation:
+                {history}"""
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s response.
+                Generate a single-sentence response to previous message.
+                Keep your response to one brief sentence that reflects your character's background.
+                Current conversation:
+                {history}"""
+            },
+            {
+                "speaker": name,
+                "prompt": """System: You are {name}.
+                Based on your background: {persona},
+                Generate a single-sentence response to the operator's message and make the final decision to determine whether you want to be evacuated or not.
+                Keep your response to one brief sentence that reflects your character's background.
+                Current conversation:
+                {history}"""
+            },
+            {
+                "speaker": "Agent",
+                "prompt": """System: You are a Fire Department Agent responding to {name}'s response.
+                Generate a single-sentence response to previous message and end the conversation.
+                Keep your response to one brief sentence that reflects your character's background.
+                Current conversation:
+                {history}"""
+            }
+            ]
+    for turn in conversation_structure:
+        context = ''
+        # The local model gets the category's example lines; the larger models do without
+        if local_model_prompts():
+            # Get relevant examples based on the category
+            if turn["speaker"] == name:
+                # Get character-specific examples
+                responses = vector_store.character_responses.get(character, {}).get(turn["category"], [])
+                context = f"Category: {turn['category']}\nSpeaker: {name}\n\nExample responses:\n" + "\n".join([f"- {response}" for response in responses])
+                retrieved_info_list.append({
+                    'speaker': name,
+                    'category': turn["category"],
+                    'examples': responses,
+                    'context': context
+                })
+            else:
+                # Get operator examples
+                responses = vector_store.operator_responses.get(turn["category"], [])
+                context = f"Category: {turn['category']}\nSpeaker: Agent\n\nExample responses:\n" + "\n".join([f"- {response}" for response in responses])
+                retrieved_info_list.append({
+                    'speaker': 'Agent',
+                    'category': turn["category"],
+                    'examples': responses,
+                    'context': context
+                })
+            
+        # Generate response using the original prompt
+        prompt = turn["prompt"].format(
+            name=name,
+            persona=persona,
+            context=context,
+            history=history
+        )
+        
+        # print(f"\nGenerating response for {turn['speaker']}...")
+        response = clean_response(send_prompt(prompt))
+        # print(f"Generated response: {response}")
+        logger.debug(f"Generated {turn['speaker']} turn for {name}")
+        
+        conversation_manager.add_message(session_id, turn["speaker"], response)
+        history += f"{turn['speaker']}: {response}\n"
+        
+    
+        
+    log_dump(logger, "Final conversation", character=name, history=history)
+    decision_response = decision_making(history, name)
+    if "yes" in decision_response.lower():
+        decision = "Evacuate"
+    else:
+        decision = "Do not evacuate"
+    logger.info(f"Decision for {name}: {decision}", extra={"fields": {"decision_response": decision_response}})
+
+    return history, retrieved_info_list, decision
+
+
+def _build_interactive_prompt(town_person, speaker, turn, persona, session_id):
+    """Build the prompt for one interactive turn from the current session history."""
+    name = town_person.lower()
+    character = town_person.lower()
+
+    # Then get the complete history INCLUDING the just-added message
+    history = conversation_manager.get_history(session_id)
+    log_dump(logger, "History after adding user input", session_id=session_id, history=history)
+   
+    # Only templates that still have a {context} slot need the example lines
+    context = ""
+    if "{context}" in turn["prompt"]:
+        # Get responses based on speaker
+        if speaker == "Operator" or speaker == "Julie":
+            source = "operator"
+            responses = vector_store.operator_responses.get(turn["category"], [])
+        else:
+            source = character
+            responses = vector_store.character_responses[character].get(turn["category"], [])
+        latest = conversation_manager.last_message(session_id)
+        responses, turn["context_selection"] = context_selector.select(
+            source, turn["category"], responses, latest.content if latest else ""
+        )
+        context = f"Category: {turn['category']}\nSpeaker: {name}\n\nExample responses:\n" + "\n".join([f"- {response}" for response in responses])
+    #print(f'category: {turn["category"]}, session_id: {session_id}, history lines: {(history.count("\n")+1) if history else 0}')
+    return turn["prompt"].format(
+            name=name,
+            persona=persona,
+            context=context,
+            history=history
+        )
+
+def _record_interactive_response(town_person, turn, response, session_id):
+    """Add the generated response to the session and build its retrieved_info."""
+    # Determine the response speaker (opposite of input speaker)
+    response_speaker = town_person.lower()  # In interactive mode, response always comes from town person
+    
+    retrieved_info = {
+        "full_prompt": turn["prompt"],
+        "speaker": town_person.lower()
+    }
+    if "context_selection" in turn:
+        retrieved_info["context_selection"] = turn["context_selection"]
+    
+    # Add the response to conversation history
+    conversation_manager.add_message(session_id, response_speaker, response)
+    logger.debug(f"Added {response_speaker} response to session {session_id}")
+
+    # Only rebuild the history when this turn is actually being dumped
+    if should_dump(logger):
+        logger.debug("History after adding response", extra={"fields": {
+            "session_id": session_id, "history": conversation_manager.get_history(session_id)
+        }})
+    #print(f'Total messages in conversation: {updated_history.count("\n")+1 if updated_history else 0}')
+
+    return retrieved_info
+
+def _retrieved_interactive_response(town_person, user_input, turn, session_id):
+    """(response, retrieved_info) for "retrieve" transitions, or None when the model has to answer."""
+    retrieve = turn.get("retrieve")
+    if retrieve is None:
+        return None
+    name = town_person.lower()
+    said = [msg.content for msg in conversation_manager.iter_turns(session_id) if msg.speaker.lower() == name]
+    degraded = turn.get("degraded", False)
+    picked = retrieval_responder.respond(retrieve["lines"], user_input or "", exclude=said,
+                                         min_score=retrieve["min_score"], fallback=degraded)
+    if picked is None:
+        return None
+    response, score = picked
+    logger.debug(f"Retrieved {town_person}'s reply from {turn['category']} (score {score})")
+    retrieved_info = _record_interactive_response(town_person, turn, response, session_id)
+    retrieved_info["responder"] = "retrieval"
+    retrieved_info["retrieval_score"] = score
+    if degraded:
+        retrieved_info["degraded"] = True
+    return response, retrieved_info
+
+def _cached_interactive_response(town_person, user_input, turn, session_id):
+    """(response, retrieved_info) from the response cache, or None when the model has to answer."""
+    response = response_cache.get(town_person.lower(), turn.get("category", ""), user_input or "")
+    if response is None:
+        return None
+    logger.debug(f"Response cache hit for {town_person} ({turn['category']})")
+    retrieved_info = _record_interactive_response(town_person, turn, response, session_id)
+    retrieved_info["response_cache"] = "hit"
+    return response, retrieved_info
+
+def _local_interactive_response(town_person, user_input, turn, session_id):
+    """(response, retrieved_info) from the category lines or the response cache, or None.
+
+    Degraded turns (the model is unavailable) are only answered from their lines
+    and raise when there are none, so they never reach the model.
+    """
+    retrieved = _retrieved_interactive_response(town_person, user_input, turn, session_id)
+    if retrieved is None and turn.get("degraded"):
+        raise RuntimeError(f"No lines to answer {town_person}'s {turn.get('category')} turn without the model")
+    return retrieved or _cached_interactive_response(town_person, user_input, turn, session_id)
+
+def simulate_interactive_single_turn(town_person, user_input, speaker, persona, turn, session_id=None):
+    """Handle interactive conversation mode."""
+    logger.debug(f"simulate_interactive_single_turn called for {town_person} with speaker={speaker}")
+    
+    # Use provided session_id or create a new one
+    if session_id is None:
+        session_id = f"{town_person.lower()}_{int(time.time())}"
+
+    cached = _local_interactive_response(town_person, user_input, turn, session_id)
+    if cached is not None:
+        return cached
+
+    prompt = _build_interactive_prompt(town_person, speaker, turn, persona, session_id)
+    response = clean_response(send_prompt(prompt))
+    response_cache.put(town_person.lower(), turn.get("category", ""), user_input or "", response)
+    retrieved_info = _record_interactive_response(town_person, turn, response, session_id)
+
+    return response, retrieved_info
+
+async def simulate_interactive_single_turn_async(town_person, user_input, speaker, persona, turn, session_id=None):
+    """Async variant of simulate_interactive_single_turn for the /chat hot path."""
+    logger.debug(f"simulate_interactive_single_turn_async called for {town_person} with speaker={speaker}")
+
+    if session_id is None:
+        session_id = f"{town_person.lower()}_{int(time.time())}"
+
+    # Embedding and searching run the encoder, so they stay off the event loop
+    cached = await asyncio.to_thread(_local_interactive_response, town_person, user_input, turn, session_id)
+    if cached is not None:
+        return cached
+
+    prompt = await asyncio.to_thread(_build_interactive_prompt, town_person, speaker, turn, persona, session_id)
+    response = clean_response(await send_prompt_async(prompt))
+    await asyncio.to_thread(response_cache.put, town_person.lower(), turn.get("category", ""), user_input or "", response)
+    retrieved_info = _record_interactive_response(town_person, turn, response, session_id)
+
+    return response, retrieved_info
+
+async def simulate_interactive_single_turn_stream(town_person, user_input, speaker, persona, turn, session_id=None):
+    """Streaming variant of simulate_interactive_single_turn.
+
+    Yields ``{"type": "token", "text": ...}`` events while the reply is generated,
+    then one ``{"type": "response", "response": ..., "retrieved_info": ...}`` event
+    once the cleaned reply has been added to the conversation history.
+    """
+    if session_id is None:
+        session_id = f"{town_person.lower()}_{int(time.time())}"
+
+    cached = await asyncio.to_thread(_local_interactive_response, town_person, user_input, turn, session_id)
+    if cached is not None:
+        response, retrieved_info = cached
+        yield {"type": "token", "text": response}
+        yield {"type": "response", "response": response, "retrieved_info": retrieved_info}
+        return
+
+    prompt = await asyncio.to_thread(_build_interactive_prompt, town_person, speaker, turn, persona, session_id)
+    cleaner = StreamCleaner()
+    chunks = []
+    async for token in stream_prompt_async(prompt):
+        chunks.append(token)
+        text = cleaner.feed(token)
+        if text:
+            yield {"type": "token", "text": text}
+    text = cleaner.flush()
+    if text:
+        yield {"type": "token", "text": text}
+
+    response = clean_response("".join(chunks))
+    await asyncio.to_thread(response_cache.put, town_person.lower(), turn.get("category", ""), user_input or "", response)
+    retrieved_info = _record_interactive_response(town_person, turn, response, session_id)
+    yield {"type": "response", "response": response, "retrieved_info": retrieved_info}
+
+
+def _decision_prompt(history, name):
+    if local_model_prompts():
+        return _local_decision_prompt(history, name)
+    recent_history = history
+    return f"Based on the previous conversation {recent_history}, determine if {name} is leaving/going/being evacuated or not. If {name} is leaving/going/being evacuated, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'."
+
+def _local_decision_prompt(history, name):
+    """Decision prompt for the local model, judged on the town person's last lines only."""
+    if name =='ross' or name == 'niki':
+        num = 1
+    else:
+        num = 2
+    messages = history.split('\n')
+    town_person_messages = []
+    for message in messages:
+        message = message.lower()
+        if message.startswith(f'{name}'):
+            message = message.split(':')[-1].strip()
+            town_person_messages.append(message)
+    last_messages = town_person_messages[-num:]
+    recent_history = '  '.join(last_messages)
+    logger.debug(f"recent_history: {recent_history}")
+    return f"{name} says:{recent_history}, determine if {name} is leaving/going/being evacuated or not. If {name} is leaving/going/being evacuated, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'."
+
+def decision_making(history, name):
+    prompt = _decision_prompt(history, name)
+    response = clean_response(send_prompt(prompt))
+    return response
+
+async def decision_making_async(history, name):
+    prompt = _decision_prompt(history, name)
+    response = clean_response(await send_prompt_async(prompt))
+    return response
+
+# Yes/no classifier prompts, keyed by check name. Each is formatted with the
+# utterance (or conversation) being classified.
+CHECK_PROMPTS = {
+    "emphasize_danger": "Based on the previous utterance {history}, determine if this utterance is emphasizing danger. If so, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'.",
+    "emphasize_value_of_life": "Based on the previous utterance {history}, determine if this utterance is emphasizing the value of life. If so, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'.",
+    "mentions_fire": "Based on the previous utterance {history}, determine if this utterance mentions fire. If so, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'.",
+    "keep_asking_questions": "Based on the previous utterance {history}, determine if this utterance is asking about the fire conditions. If so, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'.",
+    "ending_conversation": "Based on the previous conversation {history}, determine if the last message is the end of the conversation, for example, if the speaker says thanks or goodbye or something similar, it means the conversation is ending. If the conversation is ending, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'.",
+    "ask_about_children": "Based on the previous utterance {history}, determine if this utterance asks about children. If so, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'.",
+    "ask_about_parents": "Based on the previous utterance {history}, determine if this utterance asks about parents. If so, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'.",
+    "engagement": "Based on this utterance {history}, determine if the operator expresses he would like to leave if he is in the situation. If the operator expresses he would like to leave, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'.",
+}
+
+# The local model reads the ending check as a question about the latest utterance
+LOCAL_CHECK_PROMPTS = dict(
+    CHECK_PROMPTS,
+    ending_conversation="Based on the previous utterance {history}, determine if the current message is the end of the conversation, for example, if the operator says thanks or goodbye or something similar, it means the conversation is ending. If the conversation is ending, respond with 'yes', if not, respond with 'no', only respond with 'yes' or 'no'."
+)
+
+CHECK_PROMPT_VERSIONS = {name: prompt_version(template) for name, template in CHECK_PROMPTS.items()}
+LOCAL_CHECK_PROMPT_VERSIONS = {name: prompt_version(template) for name, template in LOCAL_CHECK_PROMPTS.items()}
+
+def _check_prompt(check_name):
+    """(template, version) of a check for the configured backend."""
+    if local_model_prompts():
+        return LOCAL_CHECK_PROMPTS[check_name], LOCAL_CHECK_PROMPT_VERSIONS[check_name]
+    return CHECK_PROMPTS[check_name], CHECK_PROMPT_VERSIONS[check_name]
+
+def run_check(check_name, history):
+    """Run a yes/no classifier check locally, from the classifier cache, or against the LLM."""
+    local_answer = local_classifier.classify(check_name, history)
+    if local_answer is not None:
+        return "yes" if local_answer else "no"
+    template, version = _check_prompt(check_name)
+    cached = classifier_cache.get(check_name, history, generator.model, version)
+    if cached is not None:
+        return cached
+    prompt = template.format(history=history)
+    response = clean_response(send_prompt(prompt))
+    classifier_cache.put(check_name, history, generator.model, version, response)
+    local_classifier.record(check_name, history, "yes" in response.lower())
+    return response
+
+async def run_check_async(check_name, history):
+    """Async variant of run_check."""
+    local_answer = local_classifier.classify(check_name, history)
+    if local_answer is not None:
+        return "yes" if local_answer else "no"
+    template, version = _check_prompt(check_name)
+    cached = classifier_cache.get(check_name, history, generator.model, version)
+    if cached is not None:
+        return cached
+    prompt = template.format(history=history)
+    response = clean_response(await send_prompt_async(prompt))
+    classifier_cache.put(check_name, history, generator.model, version, response)
+    local_classifier.record(check_name, history, "yes" in response.lower())
+    return response
+
+def emphasize_danger_check(history):
+    return run_check("emphasize_danger", history)
+
+def emphasize_value_of_life_check(history):
+    return run_check("emphasize_value_of_life", history)
+
+def mentions_fire_check(history):
+    return run_check("mentions_fire", history)
+
+def keep_asking_questions_check(history):
+    return run_check("keep_asking_questions", history)
+
+def ending_conversation_check(history):
+    return run_check("ending_conversation", history)
+
+def ask_about_children_check(history):
+    return run_check("ask_about_children", history)
+
+def ask_about_parents_check(history):
+    return run_check("ask_about_parents", history)
+
+def engagement_check(history):
+    return run_check("engagement", history)
+
+async def emphasize_danger_check_async(history):
+    return await run_check_async("emphasize_danger", history)
+
+async def emphasize_value_of_life_check_async(history):
+    return await run_check_async("emphasize_value_of_life", history)
+
+async def mentions_fire_check_async(history):
+    return await run_check_async("mentions_fire", history)
+
+async def keep_asking_questions_check_async(history):
+    return await run_check_async("keep_asking_questions", history)
+
+async def ending_conversation_check_async(history):
+    return await run_check_async("ending_conversation", history)
+
+async def ask_about_children_check_async(history):
+    return await run_check_async("ask_about_children", history)
+
+async def ask_about_parents_check_async(history):
+    return await run_check_async("ask_about_parents", history)
+
+async def engagement_check_async(history):
+    return await run_check_async("engagement", history)
+
+# Flags returned by the combined turn classifier, with the question asked for each.
+# One structured call answers every flag the router needs for a turn instead of
+# one yes/no round-trip per check.
+TURN_CLASSIFIER_QUESTIONS = {
+    "danger": "Is the latest utterance emphasizing danger?",
+    "value_of_life": "Is the latest utterance emphasizing the value of life?",
+    "mentions_fire": "Does the latest utterance mention fire?",
+    "asking_questions": "Is the latest utterance asking about the fire conditions?",
+    "children": "Does the latest utterance ask about children?",
+    "parents": "Does the latest utterance ask about parents?",
+    "engagement": "Does the operator express he would like to leave if he is in the situation?",
+    "ending": "Is the latest message the end of the conversation, for example the speaker says thanks or goodbye or something similar?",
+    "decision": "Based on the whole conversation, is {name} leaving/going/being evacuated?",
+}
+
+TURN_CLASSIFIER_PROMPT = """You are labelling a turn of a conversation between a Fire Department operator and {name} during a fire emergency.
+
+Previous conversation:
+{history}
+
+Latest utterance:
+{utterance}
+
+Answer each question with true or false:
+{questions}
+
+Respond with only a JSON object whose keys are {keys} and whose values are true or false."""
+
+def _turn_classifier_prompt(utterance, history, name, flags):
+    questions = "\n".join(
+        f"- {flag}: {TURN_CLASSIFIER_QUESTIONS[flag].format(name=name)}" for flag in flags
+    )
+    return TURN_CLASSIFIER_PROMPT.format(
+        name=name,
+        history=history,
+        utterance=utterance,
+        questions=questions,
+        keys=", ".join(flags)
+    )
+
+# Local classifier check answering each turn flag
+TURN_FLAG_CHECKS = {
+    "danger": "emphasize_danger",
+    "value_of_life": "emphasize_value_of_life",
+    "mentions_fire": "mentions_fire",
+    "asking_questions": "keep_asking_questions",
+    "children": "ask_about_children",
+    "parents": "ask_about_parents",
+    "engagement": "engagement",
+    "ending": "ending_conversation",
+    "decision": "decision",
+}
+
+def _turn_flag_text(flag, utterance, history, name):
+    """Text a flag is judged on: the town person's latest line for the decision, else the utterance."""
+    if flag == "decision":
+        for line in reversed(history.split('\n')):
+            if line.lower().startswith(f"{name.lower()}:"):
+                return line.split(':', 1)[1]
+        return ""
+    return utterance
+
+def _local_turn_flags(utterance, history, name, flags):
+    """Flags the local classifier is confident about."""
+    known = {}
+    for flag in flags:
+        answer = local_classifier.classify(TURN_FLAG_CHECKS[flag], _turn_flag_text(flag, utterance, history, name))
+        if answer is not None:
+            known[flag] = answer
+    return known
+
+def _record_turn_flags(utterance, history, name, llm_flags):
+    """Feed the LLM's answers back to the local classifier's calibration samples."""
+    for flag, value in llm_flags.items():
+        local_classifier.record(TURN_FLAG_CHECKS[flag], _turn_flag_text(flag, utterance, history, name), value)
+
+TURN_CLASSIFIER_VERSION = prompt_version(TURN_CLASSIFIER_PROMPT + json.dumps(TURN_CLASSIFIER_QUESTIONS, sort_keys=True))
+
+# Flags judged on the conversation as well as the latest utterance. Every other
+# flag is cached by the utterance alone, so stock phrases hit in any session.
+TURN_CONTEXT_FLAGS = ("decision",)
+
+def _turn_cache_key(flag, utterance, history, name):
+    """(check name, text) used to cache one turn flag."""
+    if flag in TURN_CONTEXT_FLAGS:
+        return f"turn:{flag}", f"{name}\n{utterance}\n{history}"
+    return f"turn:{flag}", utterance
+
+def _cached_turn_flags(utterance, history, name, flags):
+    """Flags answered by the classifier cache."""
+    known = {}
+    for flag in flags:
+        check_name, text = _turn_cache_key(flag, utterance, history, name)
+        cached = classifier_cache.get(check_name, text, generator.model, TURN_CLASSIFIER_VERSION)
+        if cached is not None:
+            known[flag] = cached == "true"
+    return known
+
+def _store_turn_flags(utterance, history, name, raw, flags):
+    """Parse the LLM's answer; cache it flag by flag and feed it to the local classifier when it is valid JSON."""
+    parsed = _parse_turn_flags(raw, flags)
+    if _load_turn_answer(raw) is not None:
+        for flag, value in parsed.items():
+            check_name, text = _turn_cache_key(flag, utterance, history, name)
+            classifier_cache.put(check_name, text, generator.model, TURN_CLASSIFIER_VERSION, "true" if value else "false")
+        _record_turn_flags(utterance, history, name, parsed)
+    return parsed
+
+def _load_turn_answer(raw):
+    """Extract the JSON object from the classifier's answer, or None if there isn't one."""
+    try:
+        answer = json.loads(raw[raw.index("{"):raw.rindex("}") + 1])
+    except ValueError:
+        return None
+    return answer if isinstance(answer, dict) else None
+
+def _parse_turn_flags(raw, flags):
+    """Parse the classifier's JSON answer into a flag -> bool dict, defaulting to False."""
+    answer = _load_turn_answer(raw)
+    if answer is None:
+        logging.warning(f"Turn classifier returned invalid JSON: {raw!r}")
+        answer = {}
+    result = {}
+    for flag in flags:
+        value = answer.get(flag, False)
+        if isinstance(value, str):
+            value = value.strip().lower() in ("true", "yes")
+        result[flag] = bool(value)
+    return result
+
+def classify_turn(utterance, history, name, flags=None):
+    """Classify the latest utterance for every routing flag, using at most one LLM call."""
+    flags = list(flags) if flags is not None else list(TURN_CLASSIFIER_QUESTIONS)
+    result = _local_turn_flags(utterance, history, name, flags)
+    remaining = [flag for flag in flags if flag not in result]
+    if remaining:
+        result.update(_cached_turn_flags(utterance, history, name, remaining))
+        remaining = [flag for flag in remaining if flag not in result]
+    if remaining:
+        prompt = _turn_classifier_prompt(utterance, history, name, remaining)
+        raw = send_prompt(prompt, json_mode=True)
+        result.update(_store_turn_flags(utterance, history, name, raw, remaining))
+    return {flag: result[flag] for flag in flags}
+
+async def classify_turn_async(utterance, history, name, flags=None, local_only=False):
+    """Async variant of classify_turn.
+
+    With ``local_only`` (the model is unavailable) flags that neither the local
+    classifier nor the cache can answer are decided by their keyword score
+    instead of the model.
+    """
+    flags = list(flags) if flags is not None else list(TURN_CLASSIFIER_QUESTIONS)
+    result = _local_turn_flags(utterance, history, name, flags)
+    remaining = [flag for flag in flags if flag not in result]
+    if remaining:
+        result.update(_cached_turn_flags(utterance, history, name, remaining))
+        remaining = [flag for flag in remaining if flag not in result]
+    if remaining and local_only:
+        for flag in remaining:
+            # Only matched keywords count as evidence, so a turn with none of them is a "no"
+            probability = local_classifier.evidence(TURN_FLAG_CHECKS[flag], _turn_flag_text(flag, utterance, history, name))
+            result[flag] = probability is not None and probability > 0.5
+    elif remaining:
+        prompt = _turn_classifier_prompt(utterance, history, name, remaining)
+        raw = await send_prompt_async(prompt, json_mode=True)
+        result.update(_store_turn_flags(utterance, history, name, raw, remaining))
+    return {flag: result[flag] for flag in flags}
+
+def setup_logging(output_file):
+    # Create a logger
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    
+    # Create file handler
+    file_handler = logging.FileHandler(output_file)
+    file_handler.setLevel(logging.INFO)
+    
+    # Create console handler
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.INFO)
+    
+    # Create formatter
+    formatter = logging.Formatter('%(message)s')
+    file_handler.setFormatter(formatter)
+    console_handler.setFormatter(formatter)
+    
+    # Add handlers to logger
+    logger.addHandler(file_handler)
+    logger.addHandler(console_handler)
+    
+    return logger
@@ -0,0 +1,264 @@
+import argparse
+import json
+import logging
+import os
+from typing import Callable, Dict, List, Optional
+
+# Signal definitions in character_states.json read one of three sources:
+#   {"flag": name}              turn classifier flag of the current message
+#   {"keywords": [...]}         substring match on the lowercased current message
+#   {"history_flag": name}      classifier flag stored on earlier messages
+#                               (optional "speaker", "max_turns", "skip")
+# Any signal can be gated with "from_count" (false below that message count)
+# and "operator_only" (false unless the Operator sent the message).
+SIGNAL_SOURCES = ("flag", "keywords", "history_flag")
+
+# How a transition's reply is produced, set per character ("respond" next to
+# "states") or per transition: "generate" asks the model, "retrieve" answers with
+# the category line closest to the message (see retrieval_responder) and only asks
+# the model when that line scores below "min_score".
+RESPOND_MODES = ("generate", "retrieve")
+
+# "fallback_lines" (next to "turn_prompt") holds generic lines per category for
+# turns answered while the model is unavailable, when the character has no lines
+# of its own in that category; "general" covers every other category.
+FALLBACK_CATEGORY = "general"
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledCharacter:
+    """Transition tables for one character, indexed by message count."""
+
+    def __init__(self, name: str, spec: Dict, lines: Optional[Dict] = None):
+        self.name = spec.get("name", name.capitalize())
+        self.signals = spec.get("signals", {})
+        self.lines = lines or {}
+        self.respond = spec.get("respond", "generate")
+        self.min_score = float(spec.get("min_score", 0.0))
+        for signal_name, signal in self.signals.items():
+            if not any(source in signal for source in SIGNAL_SOURCES):
+                raise ValueError(f"Signal '{signal_name}' of {name} has no source ({', '.join(SIGNAL_SOURCES)})")
+
+        states = spec["states"]
+        counts = sorted(int(count) for count in states if count != "otherwise")
+        self.max_count = counts[-1] if counts else 0
+        otherwise = states.get("otherwise", [])
+
+        # One row per message count up to max_count, plus a final row that covers
+        # every later count, so routing is a single list lookup.
+        self.table: List[List[Dict]] = []
+        for count in range(self.max_count + 2):
+            transitions = states.get(str(count), otherwise)
+            self.table.append([self._compile_transition(name, transition) for transition in transitions])
+
+        # Flags to classify at each count: the flags read by that row, plus flags a
+        # later row scans in the stored history, which must be recorded beforehand.
+        self.required: List[List[str]] = []
+        for count, transitions in enumerate(self.table):
+            flags = []
+            for transition in transitions:
+                for flag in transition["requires"]:
+                    signal = self._signal_for_flag(transition, flag)
+                    if count >= signal.get("from_count", 0) and flag not in flags:
+                        flags.append(flag)
+            self.required.append(flags)
+        for count, transitions in enumerate(self.table):
+            for transition in transitions:
+                for signal_name in transition["signals"]:
+                    signal = self.signals[signal_name]
+                    if "history_flag" not in signal:
+                        continue
+                    # The last row stands for every later count, so a scan there needs every row
+                    last = count if count <= self.max_count else len(self.table) - 1
+                    for earlier in range(signal.get("skip", 0) + 1, last + 1):
+                        if signal["history_flag"] not in self.required[earlier]:
+                            self.required[earlier].append(signal["history_flag"])
+
+    def _compile_transition(self, name: str, transition: Dict) -> Dict:
+        signals = list(transition.get("when", [])) + list(transition.get("when_any", []))
+        for signal_name in signals:
+            if signal_name not in self.signals:
+                raise ValueError(f"Transition to '{transition['category']}' of {name} uses unknown signal '{signal_name}'")
+        if self.lines and transition["category"] not in self.lines:
+            logger.warning(f"Category '{transition['category']}' of {name} has no lines in character_lines.jsonl")
+        respond = transition.get("respond", self.respond)
+        if respond not in RESPOND_MODES:
+            raise ValueError(f"Transition to '{transition['category']}' of {name} has unknown respond mode '{respond}'")
+        requires = []
+        for signal_name in signals:
+            signal = self.signals[signal_name]
+            flag = signal.get("flag") or signal.get("history_flag")
+            if flag and flag not in requires:
+                requires.append(flag)
+        return {
+            "when": list(transition.get("when", [])),
+            "when_any": list(transition.get("when_any", [])),
+            "signals": signals,
+            "requires": requires,
+            "category": transition["category"],
+            "prompt": transition["prompt"],
+            "respond": respond,
+            "min_score": float(transition.get("min_score", self.min_score))
+        }
+
+    def _signal_for_flag(self, transition: Dict, flag: str) -> Dict:
+        for signal_name in transition["signals"]:
+            signal = self.signals[signal_name]
+            if flag in (signal.get("flag"), signal.get("history_flag")):
+                return signal
+        return {}
+
+    def row(self, message_count: int) -> int:
+        return min(max(message_count, 0), len(self.table) - 1)
+
+
+class DialogueStateMachine:
+    """Routes a town person's turn from the compiled character_states.json tables."""
+
+    def __init__(self, spec: Dict, character_lines: Optional[Dict[str, Dict]] = None):
+        character_lines = character_lines or {}
+        self.turn_prompt = spec["turn_prompt"]
+        self.fallback_lines = spec.get("fallback_lines", {})
+        if not self.fallback_lines.get(FALLBACK_CATEGORY):
+            raise ValueError(f"fallback_lines needs a non-empty '{FALLBACK_CATEGORY}' category")
+        self.characters = {
+            name: CompiledCharacter(name, character_spec, character_lines.get(name))
+            for name, character_spec in spec["characters"].items()
+        }
+
+    @classmethod
+    def from_file(cls, file_path: str, character_lines: Optional[Dict[str, Dict]] = None) -> "DialogueStateMachine":
+        with open(file_path, 'r') as f:
+            return cls(json.load(f), character_lines)
+
+    def has_character(self, name: str) -> bool:
+        return name in self.characters
+
+    def required_flags(self, name: str, message_count: int) -> List[str]:
+        """Turn classifier flags that must be evaluated for this character at this count."""
+        character = self.characters.get(name)
+        if character is None:
+            return []
+        return character.required[character.row(message_count)]
+
+    def build_turn(self, name: str, message_count: int, history: str, persona: str, user_input: str,
+                   speaker: str, turn_flags: Dict[str, bool], history_flagged: Callable[..., bool],
+                   select_context: Optional[Callable] = None) -> Dict:
+        """Pick the first transition whose signals hold and build the turn dict.
+
+        ``history_flagged(flag, speaker=None, max_turns=None, skip=0)`` answers
+        history signals; signals are only evaluated when a transition reads them.
+        ``select_context(name, category, lines)`` may narrow the category's lines
+        shown in the prompt; it returns the lines and stats stored on the turn.
+        """
+        character = self.characters[name]
+        values = {}
+
+        def signal_value(signal_name):
+            if signal_name not in values:
+                values[signal_name] = self._evaluate_signal(
+                    character.signals[signal_name], message_count, user_input, speaker, turn_flags, history_flagged
+                )
+            return values[signal_name]
+
+        for transition in character.table[character.row(message_count)]:
+            if not all(signal_value(signal_name) for signal_name in transition["when"]):
+                continue
+            if transition["when_any"] and not any(signal_value(signal_name) for signal_name in transition["when_any"]):
+                continue
+            category = transition["category"]
+            context = character.lines.get(category, '')
+            selection = None
+            if select_context and context and "{context}" in transition["prompt"]:
+                context, selection = select_context(name, category, context)
+            prompt_content = transition["prompt"].format(category=category, context=context)
+            logger.debug(f"State machine: {name} at message {message_count} -> {category} (signals: {values})")
+            turn = {
+                "speaker": name,
+                "prompt": self.turn_prompt.format(
+                    name=character.name, persona=persona, history=history, prompt_content=prompt_content
+                ),
+                "category": category
+            }
+            if selection is not None:
+                turn["context_selection"] = selection
+            if transition["respond"] == "retrieve":
+                turn["retrieve"] = {"lines": character.lines.get(category, []), "min_score": transition["min_score"]}
+            return turn
+        raise ValueError(f"No transition for {name} at message {message_count}")
+
+    def category_lines(self, name: str, category: str) -> List[str]:
+        """The character's lines of ``category`` from character_lines.jsonl."""
+        return self.characters[name].lines.get(category, [])
+
+    def degraded_lines(self, name: str, category: str) -> List[str]:
+        """Lines to answer from while the model is unavailable; never empty.
+
+        The character's own lines of ``category`` when there are any, otherwise the
+        generic fallback lines of the category (or of the general category).
+        """
+        character = self.characters.get(name)
+        lines = character.lines.get(category) if character is not None else None
+        return lines or self.fallback_lines.get(category) or self.fallback_lines[FALLBACK_CATEGORY]
+
+    @staticmethod
+    def _evaluate_signal(signal, message_count, user_input, speaker, turn_flags, history_flagged) -> bool:
+        if message_count < signal.get("from_count", 0):
+            return False
+        if signal.get("operator_only") and speaker != "Operator":
+            return False
+        if "flag" in signal:
+            return bool(turn_flags.get(signal["flag"]))
+        if "keywords" in signal:
+            message = user_input.lower()
+            return any(keyword in message for keyword in signal["keywords"])
+        return history_flagged(
+            signal["history_flag"],
+            speaker=signal.get("speaker"),
+            max_turns=signal.get("max_turns"),
+            skip=signal.get("skip", 0)
+        )
+
+    def transition_report(self) -> Dict:
+        """Every state's transitions with the classifier flags each one requires."""
+        report = {}
+        for name, character in self.characters.items():
+            states = {}
+            for count, transitions in enumerate(character.table):
+                if count == 0:
+                    continue
+                label = str(count) if count <= character.max_count else f"{count}+"
+                states[label] = {
+                    "classify": character.required[count],
+                    "transitions": [
+                        {
+                            "category": transition["category"],
+                            "when": transition["when"],
+                            "when_any": transition["when_any"],
+                            "requires": transition["requires"],
+                            "respond": transition["respond"]
+                        }
+                        for transition in transitions
+                    ]
+                }
+            report[name] = states
+        return report
+
+
+def default_states_path() -> str:
+    return os.path.join("data_for_train", "character_states.json")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the compiled character state machine.")
+    parser.add_argument("-states", "--statesfile", default=default_states_path(),
+                        help="JSON file with each character's states and transitions")
+    parser.add_argument("--character", help="Only show this character")
+    args = parser.parse_args()
+
+    machine = DialogueStateMachine.from_file(args.statesfile)
+    report = machine.transition_report()
+    if args.character:
+        report = {args.character: report[args.character]}
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,296 @@
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+# Lexical scoring rules for the yes/no checks. Each check has a bias (log-odds
+# of "yes" when nothing matches) and weighted patterns whose weights are added
+# to the bias when they match. The summed log-odds are squashed into a
+# probability. An answer is only trusted when some pattern matched and the
+# probability is far enough from 0.5: a missing keyword is not evidence, so the
+# bias alone never answers a check (it is only the best guess in degraded mode).
+RULES = {
+    "emphasize_danger": {
+        "bias": -1.5,
+        "patterns": [
+            (r"\b(danger|dangerous|unsafe|deadly|lethal|life[- ]threatening)\b", 3.5),
+            (r"\b(fire|flames?|smoke|blaze)\b.*\b(close|closer|near|coming|spreading|approaching|moving|here)\b", 3.0),
+            (r"\b(evacuate|leave|get out)\b.*\b(now|immediately|right away|asap)\b", 2.5),
+            (r"\b(urgent|hurry|quickly|rapid|rapidly|faster|trapped|immediately|right now|as soon as possible|asap)\b", 2.0),
+            (r"\b(no|don't have|do not have|running out of) time\b", 2.5),
+            (r"\b(risk|threat|serious|bad|worse)\b", 1.0),
+        ],
+    },
+    "emphasize_value_of_life": {
+        "bias": -2.0,
+        "patterns": [
+            (r"\b(your|my|our|their) (life|lives|safety)\b", 4.5),
+            (r"\b(can|could)( not|n't) (be )?replace|irreplaceable\b", 3.0),
+            (r"\b(work|things|stuff|property|collection|house|home|art(work)?)\b.*\b(replace|rebuild|recover|later|not worth)\b", 3.0),
+            (r"\b(not worth|more important than|matters? more)\b", 2.5),
+            (r"\b(die|dying|alive|survive|hurt|family|loved ones)\b", 1.5),
+        ],
+    },
+    "mentions_fire": {
+        "bias": -3.0,
+        "patterns": [
+            (r"\b(fires?|wildfires?|flames?|blaze|burning|burn)\b", 6.0),
+            (r"\b(smoke|smoky|embers?|ash)\b", 4.0),
+        ],
+    },
+    "keep_asking_questions": {
+        "bias": -2.5,
+        "patterns": [
+            (r"\b(how|where|what|when|is|are|can|should)\b.*\b(fire|smoke|flames?|close|far|bad|spread|road|way out)\b.*\?", 5.0),
+            (r"\b(how (close|far|bad|big|fast)|where is|what('s| is) (happening|going on))\b", 4.0),
+            (r"\?", 1.0),
+        ],
+    },
+    "ending_conversation": {
+        "bias": -3.0,
+        "patterns": [
+            (r"\b(bye|goodbye|see you|take care|stay safe|good luck)\b", 6.0),
+            (r"\b(thanks|thank you)\b", 4.5),
+        ],
+    },
+    "ask_about_children": {
+        "bias": -3.0,
+        "patterns": [
+            (r"\b(child|children|kids?|son|sons|daughters?|baby|babies|toddlers?)\b", 6.0),
+        ],
+    },
+    "ask_about_parents": {
+        "bias": -3.0,
+        "patterns": [
+            (r"\b(parents?|mom|mum|mother|dad|father|grand(ma|pa|mother|father|parents?))\b", 6.0),
+        ],
+    },
+    "engagement": {
+        "bias": -2.5,
+        "patterns": [
+            (r"\b(i would|i'd|i will|i'll|i am going to|i'm going to)\b.*\b(leave|go|evacuate|get out|head out)\b", 5.0),
+            (r"\bif i (were|was) (you|in your (shoes|situation|position))\b", 4.0),
+            (r"\bi (wouldn't|would not) (stay|risk)\b", 4.0),
+        ],
+    },
+    # A "yes" ends the scenario, so one matching phrase is not enough to answer it locally
+    "decision": {
+        "bias": -3.0,
+        "patterns": [
+            (r"\b(i'll|i will|we'll|we will|let me|let's|i'm|we're)\b.*\b(head out|leave|go|evacuate|follow|grab my|make our way|get going|on my way)\b", 4.0),
+            (r"\b(okay|ok|alright|fine)\b.*\b(leave|go|head out|evacuate)\b", 2.0),
+            (r"\b(not leaving|won't leave|will not leave|not going|can't (just )?leave|cannot leave|staying|not happening)\b", -6.0),
+        ],
+    },
+}
+
+DEFAULT_THRESHOLD = 0.9
+DEFAULT_MIN_ACCURACY = 0.95
+# Fewer weakly labelled samples than this leave a check at the default threshold
+MIN_CALIBRATION_SAMPLES = 20
+CONFIDENCE_BUCKETS = (0.6, 0.7, 0.8, 0.9, 0.95, 0.99)
+DEFAULT_DIALOGUE_FILE = os.path.join("data_for_train", "character_lines.jsonl")
+
+
+class LocalClassifier:
+    """CPU-only keyword/regex scorer for the yes/no checks.
+
+    ``classify`` returns True/False when the score is confident enough and None
+    otherwise, in which case the caller falls back to the LLM and reports the
+    LLM's answer through ``record`` so the threshold can be calibrated.
+    ``thresholds`` overrides ``threshold`` per check; a check mapped to None is
+    never answered locally.
+    """
+
+    def __init__(self, rules: Dict = RULES, threshold: float = DEFAULT_THRESHOLD, max_samples: int = 5000,
+                 thresholds: Optional[Dict[str, Optional[float]]] = None):
+        self.threshold = threshold
+        self.thresholds = dict(thresholds or {})
+        self._rules = {
+            check: (rule["bias"], [(re.compile(pattern, re.IGNORECASE), weight) for pattern, weight in rule["patterns"]])
+            for check, rule in rules.items()
+        }
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {check: deque(maxlen=max_samples) for check in self._rules}
+        self.local_answers = 0
+        self.llm_fallbacks = 0
+
+    def has_rules(self, check: str) -> bool:
+        return check in self._rules
+
+    def _log_odds(self, check: str, text: str) -> Tuple[float, bool]:
+        # (summed log-odds, whether any pattern matched)
+        bias, patterns = self._rules[check]
+        weights = [weight for pattern, weight in patterns if pattern.search(text)]
+        return bias + sum(weights), bool(weights)
+
+    def score(self, check: str, text: str) -> Optional[float]:
+        """Probability that the answer is "yes", or None if the check has no rules."""
+        if check not in self._rules:
+            return None
+        log_odds, _ = self._log_odds(check, text)
+        return 1.0 / (1.0 + math.exp(-log_odds))
+
+    def evidence(self, check: str, text: str) -> Optional[float]:
+        """Like ``score``, but 0.5 (no evidence either way) when no pattern matched."""
+        if check not in self._rules:
+            return None
+        log_odds, matched = self._log_odds(check, text)
+        return 1.0 / (1.0 + math.exp(-log_odds)) if matched else 0.5
+
+    def threshold_for(self, check: str) -> Optional[float]:
+        return self.thresholds.get(check, self.threshold)
+
+    def classify(self, check: str, text: str) -> Optional[bool]:
+        """Answer the check locally, or return None when the LLM should decide."""
+        probability = self.evidence(check, text)
+        threshold = self.threshold_for(check)
+        if probability is None or threshold is None or max(probability, 1.0 - probability) < threshold:
+            with self._lock:
+                self.llm_fallbacks += 1
+            return None
+        with self._lock:
+            self.local_answers += 1
+        return probability >= 0.5
+
+    def record(self, check: str, text: str, llm_answer: bool):
+        """Remember the LLM's answer next to the local score for calibration."""
+        probability = self.evidence(check, text)
+        if probability is None:
+            return
+        with self._lock:
+            self._samples[check].append((probability, bool(llm_answer)))
+
+    def calibration_report(self, samples: Optional[Dict[str, List[Tuple[float, bool]]]] = None) -> Dict:
+        """Coverage and agreement with the reference answers at each confidence threshold.
+
+        ``coverage`` is the share of inputs that would be answered locally at that
+        threshold (LLM calls saved) and ``accuracy`` is how often those local
+        answers agree with the reference (LLM) answer.
+        """
+        if samples is None:
+            with self._lock:
+                samples = {check: list(values) for check, values in self._samples.items()}
+        report = {}
+        for check, values in samples.items():
+            if not values:
+                continue
+            buckets = {}
+            for threshold in CONFIDENCE_BUCKETS:
+                covered = [(p, label) for p, label in values if max(p, 1.0 - p) >= threshold]
+                correct = sum(1 for p, label in covered if (p >= 0.5) == label)
+                buckets[str(threshold)] = {
+                    "coverage": round(len(covered) / len(values), 4),
+                    "accuracy": round(correct / len(covered), 4) if covered else None
+                }
+            report[check] = {"samples": len(values), "thresholds": buckets}
+        return report
+
+    def calibrate(self, labelled: Dict[str, List[Tuple[str, bool]]], min_accuracy: float = DEFAULT_MIN_ACCURACY):
+        """Set per-check thresholds from reference-labelled texts, see ``calibrated_thresholds``."""
+        scored = {
+            check: [(self.evidence(check, text), label) for text, label in values]
+            for check, values in labelled.items() if check in self._rules
+        }
+        self.thresholds.update(calibrated_thresholds(self.calibration_report(scored), min_accuracy))
+        return self.thresholds
+
+    def stats(self) -> Dict:
+        total = self.local_answers + self.llm_fallbacks
+        return {
+            "threshold": self.threshold,
+            "thresholds": dict(self.thresholds),
+            "local_answers": self.local_answers,
+            "llm_fallbacks": self.llm_fallbacks,
+            "local_rate": round(self.local_answers / total, 4) if total else 0.0,
+            "calibration": self.calibration_report()
+        }
+
+
+def calibrated_thresholds(report: Dict, min_accuracy: float = DEFAULT_MIN_ACCURACY) -> Dict[str, Optional[float]]:
+    """Lowest confidence threshold per check whose local answers reach ``min_accuracy``.
+
+    Checks with too few samples are left out (they keep the default threshold);
+    checks where no threshold is accurate enough map to None and always go to the LLM.
+    """
+    thresholds = {}
+    for check, entry in report.items():
+        if entry["samples"] < MIN_CALIBRATION_SAMPLES:
+            continue
+        thresholds[check] = None
+        for threshold in CONFIDENCE_BUCKETS:
+            bucket = entry["thresholds"][str(threshold)]
+            if bucket["coverage"] and bucket["accuracy"] >= min_accuracy:
+                thresholds[check] = threshold
+                break
+    return thresholds
+
+
+def weak_labels_from_dialogue(file_path: str) -> Dict[str, List[Tuple[str, bool]]]:
+    """Build weakly labelled samples from the operator/Julie lines in character_lines.jsonl.
+
+    A line is a positive example for a check when it comes from the matching
+    category (e.g. ``emphasize_danger``) and a negative example otherwise.
+    """
+    category_checks = {
+        "emphasize_danger": "emphasize_danger",
+        "emphasize_value_of_life": "emphasize_value_of_life",
+        "closing": "ending_conversation",
+    }
+    samples = {check: [] for check in category_checks.values()}
+    with open(file_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            if data.get('character') not in ('operator', 'julie'):
+                continue
+            for category, lines in data.items():
+                if not isinstance(lines, list):
+                    continue
+                for text in lines:
+                    for source_category, check in category_checks.items():
+                        samples[check].append((text, category == source_category))
+    return samples
+
+
+def local_classifier_from_env(dialogue_file: str = DEFAULT_DIALOGUE_FILE) -> LocalClassifier:
+    """LocalClassifier with per-check thresholds calibrated on ``dialogue_file``.
+
+    A2I2_LOCAL_CLASSIFIER_THRESHOLD sets one fixed threshold for every check
+    instead; A2I2_LOCAL_CLASSIFIER_MIN_ACCURACY is the accuracy calibration aims for.
+    """
+    threshold = os.getenv("A2I2_LOCAL_CLASSIFIER_THRESHOLD")
+    if threshold:
+        return LocalClassifier(threshold=float(threshold))
+    classifier = LocalClassifier()
+    if os.path.exists(dialogue_file):
+        min_accuracy = float(os.getenv("A2I2_LOCAL_CLASSIFIER_MIN_ACCURACY", str(DEFAULT_MIN_ACCURACY)))
+        thresholds = classifier.calibrate(weak_labels_from_dialogue(dialogue_file), min_accuracy)
+        logging.info(f"Local classifier thresholds calibrated on {dialogue_file}: {thresholds}")
+    return classifier
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibration report for the local classifier.")
+    parser.add_argument("-dialogue", "--dialoguefile", default=DEFAULT_DIALOGUE_FILE,
+                        help="JSONL file with operator/julie lines used as weak labels")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--min-accuracy", type=float, default=DEFAULT_MIN_ACCURACY,
+                        help="Accuracy the calibrated per-check thresholds must reach")
+    args = parser.parse_args()
+
+    classifier = LocalClassifier(threshold=args.threshold)
+    labelled = weak_labels_from_dialogue(args.dialoguefile)
+    scored = {
+        check: [(classifier.evidence(check, text), label) for text, label in values]
+        for check, values in labelled.items()
+    }
+    report = classifier.calibration_report(scored)
+    print(json.dumps({"report": report, "thresholds": calibrated_thresholds(report, args.min_accuracy)}, indent=2))
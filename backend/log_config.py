@@ -0,0 +1,107 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from typing import Dict, Optional
+
+# Per-turn dumps (prompts, histories, retrieved info) are logged at DEBUG, and
+# only a sample of them even then, so production logs stay small.
+DEFAULT_LEVEL = "INFO"
+DEFAULT_DUMP_SAMPLE_RATE = 0.1
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_dump_sample_rate = DEFAULT_DUMP_SAMPLE_RATE
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, message and any ``fields``."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            payload.update(fields)
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """Parse "server=DEBUG,conversation=WARNING" into {logger name: level}."""
+    levels = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        name, level = item.split("=", 1)
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level: Optional[str] = None, module_levels: Optional[str] = None,
+                      fmt: Optional[str] = None, dump_sample_rate: Optional[float] = None):
+    """Route all logging through a queue to a single background writer thread.
+
+    Request handlers only enqueue records; formatting and the stdout write
+    happen on the listener thread. Settings default to the environment:
+    A2I2_LOG_LEVEL, A2I2_LOG_LEVELS (per-module overrides), A2I2_LOG_FORMAT
+    (json or text) and A2I2_LOG_DUMP_SAMPLE_RATE. Safe to call more than once.
+    """
+    global _listener, _dump_sample_rate
+    level = (level or os.getenv("A2I2_LOG_LEVEL", DEFAULT_LEVEL)).upper()
+    module_levels = module_levels if module_levels is not None else os.getenv("A2I2_LOG_LEVELS", "")
+    fmt = (fmt or os.getenv("A2I2_LOG_FORMAT", "json")).lower()
+    if dump_sample_rate is None:
+        dump_sample_rate = float(os.getenv("A2I2_LOG_DUMP_SAMPLE_RATE", str(DEFAULT_DUMP_SAMPLE_RATE)))
+    _dump_sample_rate = dump_sample_rate
+
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    records = queue.Queue(-1)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    for name, module_level in parse_levels(module_levels).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+atexit.register(_stop_listener)
+
+
+def should_dump(logger: logging.Logger) -> bool:
+    """Whether to emit a verbose per-turn dump: DEBUG must be on and the sample must hit.
+
+    Check this before building expensive dump fields.
+    """
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < _dump_sample_rate
+
+
+def log_dump(logger: logging.Logger, message: str, **fields):
+    """Log a sampled DEBUG dump with structured fields."""
+    if should_dump(logger):
+        logger.debug(message, extra={"fields": fields})
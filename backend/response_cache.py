@@ -0,0 +1,156 @@
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from classifier_cache import normalize_text
+
+
+class _Entry:
+    __slots__ = ("bucket", "vector", "replies", "created")
+
+    def __init__(self, bucket: tuple, vector: List[float], reply: str, created: float):
+        self.bucket = bucket
+        self.vector = vector
+        self.replies = [reply]
+        self.created = created
+
+
+class ResponseCache:
+    """In-character replies keyed by (character, category, embedding of the operator's utterance).
+
+    A lookup serves a stored reply when an utterance in the same character and
+    category is at least ``threshold`` cosine-similar to the new one. Each entry
+    keeps a pool of up to ``pool_size`` replies: the first similar utterances
+    still go to the model and add their reply to the pool, later ones are served
+    a random reply from it. Entries expire after ``ttl`` seconds, and the least
+    recently used go first beyond ``max_entries``.
+
+    Embeddings come from the dialogue index (see semantic_index), so matching is
+    semantic when the encoder is installed and word-overlap otherwise.
+    """
+
+    def __init__(self, index: Callable, threshold: float = 0.9, ttl: float = 3600.0,
+                 max_entries: int = 2048, pool_size: int = 1, enabled: bool = True):
+        self._index = index
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.pool_size = max(1, pool_size)
+        self.enabled = enabled
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._buckets: Dict[tuple, List[int]] = {}
+        self._vectors: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._counts: Dict[str, List[int]] = {}
+
+    def get(self, character: str, category: str, utterance: str) -> Optional[str]:
+        """A stored reply for a similar utterance, or None when the model should answer."""
+        if not self._cacheable(category, utterance):
+            return None
+        vector = self._embed(utterance)
+        with self._lock:
+            entry = self._match((character, category), vector)
+            hit = entry is not None and len(entry.replies) >= self.pool_size
+            counts = self._counts.setdefault(character, [0, 0])
+            counts[0 if hit else 1] += 1
+            return random.choice(entry.replies) if hit else None
+
+    def put(self, character: str, category: str, utterance: str, reply: str):
+        """Remember the model's reply, in the pool of a similar utterance if there is one."""
+        if not reply or not self._cacheable(category, utterance):
+            return
+        vector = self._embed(utterance)
+        bucket = (character, category)
+        with self._lock:
+            entry = self._match(bucket, vector)
+            if entry is not None:
+                if len(entry.replies) < self.pool_size and reply not in entry.replies:
+                    entry.replies.append(reply)
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _Entry(bucket, vector, reply, time.monotonic())
+            self._buckets.setdefault(bucket, []).append(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def _cacheable(self, category: str, utterance: str) -> bool:
+        return self.enabled and bool(category) and bool(utterance.strip())
+
+    def _embed(self, utterance: str) -> List[float]:
+        # get() and put() of one turn embed the same utterance; keep the last few vectors
+        key = normalize_text(utterance)
+        with self._lock:
+            if key in self._vectors:
+                self._vectors.move_to_end(key)
+                return self._vectors[key]
+        vector = self._index().embed(key)
+        with self._lock:
+            self._vectors[key] = vector
+            while len(self._vectors) > 256:
+                self._vectors.popitem(last=False)
+        return vector
+
+    def _match(self, bucket: tuple, vector: List[float]) -> Optional[_Entry]:
+        # Callers hold the lock. Buckets are small (one character and category), so they are scanned
+        now = time.monotonic()
+        best, best_score = None, self.threshold
+        for entry_id in list(self._buckets.get(bucket, ())):
+            entry = self._entries[entry_id]
+            if now - entry.created > self.ttl:
+                self._drop(entry_id)
+                continue
+            score = sum(a * b for a, b in zip(vector, entry.vector))
+            if score >= best_score:
+                best, best_score = entry_id, score
+        if best is None:
+            return None
+        self._entries.move_to_end(best)
+        return self._entries[best]
+
+    def _drop(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        bucket = self._buckets[entry.bucket]
+        bucket.remove(entry_id)
+        if not bucket:
+            del self._buckets[entry.bucket]
+
+    def stats(self) -> Dict:
+        """Hit/miss counters, overall and per character, for the metrics endpoint."""
+        with self._lock:
+            hits = sum(counts[0] for counts in self._counts.values())
+            misses = sum(counts[1] for counts in self._counts.values())
+            return {
+                "enabled": self.enabled,
+                "threshold": self.threshold,
+                "pool_size": self.pool_size,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "by_character": {
+                    character: {
+                        "hits": counts[0],
+                        "misses": counts[1],
+                        "hit_rate": round(counts[0] / sum(counts), 4)
+                    }
+                    for character, counts in sorted(self._counts.items())
+                }
+            }
+
+
+def response_cache_from_env(index: Callable) -> ResponseCache:
+    """ResponseCache configured by the A2I2_RESPONSE_CACHE* variables."""
+    return ResponseCache(
+        index,
+        threshold=float(os.getenv("A2I2_RESPONSE_CACHE_THRESHOLD", "0.9")),
+        ttl=float(os.getenv("A2I2_RESPONSE_CACHE_TTL", "3600")),
+        max_entries=int(os.getenv("A2I2_RESPONSE_CACHE_SIZE", "2048")),
+        pool_size=int(os.getenv("A2I2_RESPONSE_CACHE_POOL", "1")),
+        enabled=os.getenv("A2I2_RESPONSE_CACHE", "1").lower() not in ("0", "false", "no", "off")
+    )
@@ -0,0 +1,77 @@
+import os
+import random
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class RetrievalResponder:
+    """Answers "pick a line" turns with the category line closest to the operator's utterance.
+
+    Transitions marked ``"respond": "retrieve"`` in character_states.json only ask
+    the model to choose one of the category's lines, so the line is picked here
+    instead: lines are ranked by cosine similarity of their embeddings (semantic or
+    hashed bag of words, from the dialogue index) to the utterance, lines the
+    character already said are skipped, and ties are broken at random. When the
+    best score is below the transition's ``min_score`` the turn goes to the model.
+    """
+
+    def __init__(self, index: Callable, enabled: bool = True):
+        self._index = index
+        self.enabled = enabled
+        self._vectors: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+        self.answered = 0
+        self.fallbacks = 0
+
+    def respond(self, lines: List[str], utterance: str, exclude: Iterable[str] = (),
+                min_score: float = 0.0, fallback: bool = False) -> Optional[Tuple[str, float]]:
+        """(line, score) for the best line, or None when the model should answer.
+
+        ``fallback`` turns (the model is unavailable) are always answered when
+        there are lines, even when the responder is switched off or the best
+        line scores below ``min_score``.
+        """
+        if not (self.enabled or fallback) or not lines:
+            return None
+        said = set(exclude)
+        candidates = [line for line in lines if line not in said] or list(lines)
+        if utterance.strip():
+            query = self._index().embed(utterance)
+            scored = [(self._score(query, line), line) for line in candidates]
+        else:
+            scored = [(0.0, line) for line in candidates]
+        best = max(score for score, _ in scored)
+        with self._lock:
+            if best < min_score and not fallback:
+                self.fallbacks += 1
+                return None
+            self.answered += 1
+        return random.choice([line for score, line in scored if score >= best - 1e-6]), round(best, 4)
+
+    def _score(self, query: List[float], line: str) -> float:
+        vector = self._vectors.get(line)
+        if vector is None:
+            # Character lines are a fixed, small set, so their vectors are kept for the process lifetime
+            vector = self._index().embed(line)
+            with self._lock:
+                self._vectors[line] = vector
+        return sum(a * b for a, b in zip(query, vector))
+
+    def stats(self) -> Dict:
+        """Turns answered without the model, for the metrics endpoint."""
+        with self._lock:
+            turns = self.answered + self.fallbacks
+            return {
+                "enabled": self.enabled,
+                "answered": self.answered,
+                "fallbacks": self.fallbacks,
+                "answer_rate": round(self.answered / turns, 4) if turns else 0.0
+            }
+
+
+def retrieval_responder_from_env(index: Callable) -> RetrievalResponder:
+    """RetrievalResponder, switched off for every transition with A2I2_RETRIEVAL_FIRST=0."""
+    return RetrievalResponder(
+        index,
+        enabled=os.getenv("A2I2_RETRIEVAL_FIRST", "1").lower() not in ("0", "false", "no", "off")
+    )
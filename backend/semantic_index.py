@@ -0,0 +1,349 @@
+import argparse
+import hashlib
+import importlib.util
+import json
+import logging
+import math
+import os
+import re
+import zlib
+from typing import Callable, Dict, List, Optional
+
+# The one file the dialogue index is built from, by the server and by the CLI below
+DEFAULT_DIALOGUE_FILE = os.path.join("data_for_train", "character_lines.jsonl")
+ENCODER_MODEL = os.getenv("A2I2_ENCODER_MODEL", "all-MiniLM-L6-v2")
+INDEX_FILE = "dialogue_lines.faiss"
+META_FILE = "dialogue_lines.json"
+EMBEDDINGS_FILE = "embeddings.{encoder}.json"
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+# Dimensions of the hashed bag-of-words vectors KeywordIndex.embed returns
+HASHED_DIM = 512
+
+logger = logging.getLogger(__name__)
+
+
+def dialogue_lines(character_responses: Dict[str, Dict], operator_responses: Dict[str, List[str]]) -> List[Dict]:
+    """Flatten the loaded character_lines.jsonl data into {"character", "category", "text"} entries."""
+    lines = []
+    for character, data in character_responses.items():
+        for category, texts in data.items():
+            if category == "character" or not isinstance(texts, list):
+                continue
+            lines.extend({"character": character, "category": category, "text": text} for text in texts)
+    for category, texts in operator_responses.items():
+        lines.extend({"character": "operator", "category": category, "text": text} for text in texts)
+    return lines
+
+
+def load_encoder(name: str = ENCODER_MODEL):
+    """SentenceTransformer model (imported here, since torch is slow to import)."""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(name)
+
+
+def _result(line: Dict, score: float) -> Dict:
+    # Same keys as the old keyword search, plus the similarity score
+    return {
+        "speaker": line["character"],
+        "content": line["text"],
+        "character": line["character"],
+        "context": line["category"],
+        "score": round(float(score), 4)
+    }
+
+
+def _matches(line: Dict, character: Optional[str], category: Optional[str]) -> bool:
+    return (character is None or line["character"] == character) and (category is None or line["category"] == category)
+
+
+def line_key(text: str) -> str:
+    """Content hash identifying a line in the embedding cache."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Line embeddings keyed by content hash, saved per encoder as a float16 ``.npy``.
+
+    The vectors are memory-mapped, so workers on one machine share the page-cached
+    file, and only lines whose hash is not in the cache yet are encoded. A small
+    JSON file lists the hashes in row order and names the current vectors file;
+    it is replaced last, so readers never pair it with a partially written array.
+    """
+
+    def __init__(self, cache_dir: str, encoder_name: str = ENCODER_MODEL):
+        self.cache_dir = cache_dir
+        self.encoder_name = encoder_name
+        slug = re.sub(r"[^A-Za-z0-9._-]+", "_", encoder_name)
+        self.keys_path = os.path.join(cache_dir, EMBEDDINGS_FILE.format(encoder=slug))
+        self.encoded = 0
+        self.reused = 0
+
+    def _load(self):
+        import numpy as np
+        try:
+            with open(self.keys_path, "r") as f:
+                saved = json.load(f)
+            if saved.get("encoder") != self.encoder_name:
+                return {}, None
+            vectors = np.load(os.path.join(self.cache_dir, saved["vectors"]), mmap_mode="r")
+            if vectors.shape[0] != len(saved["keys"]):
+                return {}, None
+            return {key: row for row, key in enumerate(saved["keys"])}, vectors
+        except (OSError, ValueError, KeyError):
+            return {}, None
+
+    def embed(self, texts: List[str], encoder: Callable):
+        """Normalized float32 vectors for ``texts``, encoding only the ones not cached.
+
+        ``encoder`` is called to get the SentenceTransformer only when something is missing.
+        The cache is then rewritten to hold exactly the lines of ``texts``.
+        """
+        import numpy as np
+        keys = [line_key(text) for text in texts]
+        rows, cached = self._load()
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in rows:
+                missing.setdefault(key, text)
+        fresh = {}
+        if missing:
+            vectors = encoder().encode(list(missing.values()), normalize_embeddings=True, convert_to_numpy=True)
+            fresh = dict(zip(missing, vectors.astype("float16")))
+        self.encoded += len(fresh)
+        self.reused += len(keys) - sum(1 for key in keys if key in fresh)
+        if not keys:
+            return np.zeros((0, cached.shape[1] if cached is not None else 0), dtype="float32")
+
+        unique = list(dict.fromkeys(keys))
+        if fresh or len(unique) != len(rows):
+            stored = np.stack([fresh[key] if key in fresh else cached[rows[key]] for key in unique])
+            self._save(unique, stored)
+            rows = {key: row for row, key in enumerate(unique)}
+            cached = stored
+        return np.asarray(cached[[rows[key] for key in keys]], dtype="float32")
+
+    def _save(self, keys: List[str], vectors) -> None:
+        import numpy as np
+        os.makedirs(self.cache_dir, exist_ok=True)
+        base = os.path.splitext(os.path.basename(self.keys_path))[0]
+        # The vectors file is named after its content, so a new cache never overwrites one being read
+        name = f"{base}.{hashlib.sha1(''.join(keys).encode('ascii')).hexdigest()[:16]}.npy"
+        suffix = f".{os.getpid()}.tmp"
+        with open(os.path.join(self.cache_dir, name + suffix), "wb") as f:
+            np.save(f, vectors)
+        os.replace(os.path.join(self.cache_dir, name + suffix), os.path.join(self.cache_dir, name))
+        previous = None
+        try:
+            with open(self.keys_path, "r") as f:
+                previous = json.load(f).get("vectors")
+        except (OSError, ValueError):
+            pass
+        with open(self.keys_path + suffix, "w") as f:
+            json.dump({"encoder": self.encoder_name, "vectors": name, "keys": keys}, f)
+        os.replace(self.keys_path + suffix, self.keys_path)
+        # Processes that mapped the old file keep their mapping after it is unlinked
+        if previous and previous != name:
+            try:
+                os.remove(os.path.join(self.cache_dir, previous))
+            except OSError:
+                pass
+
+
+class SemanticIndex:
+    """Embedding search over dialogue lines, backed by a FAISS inner-product index on disk.
+
+    The index is built once per set of lines and encoder and saved under
+    ``index_dir``; later starts memory-map it instead of re-encoding every line.
+    Vectors are normalized, so scores are cosine similarities.
+    """
+    kind = "semantic"
+
+    def __init__(self, lines: List[Dict], index, encoder: Callable, model=None):
+        self.lines = lines
+        self.index = index
+        self._encoder = encoder
+        self._model = model
+
+    @staticmethod
+    def fingerprint(lines: List[Dict], encoder_name: str) -> str:
+        payload = json.dumps([encoder_name, lines], sort_keys=True).encode("utf-8")
+        return hashlib.sha1(payload).hexdigest()
+
+    @classmethod
+    def open(cls, lines: List[Dict], encoder: Callable, index_dir: str,
+             encoder_name: str = ENCODER_MODEL) -> "SemanticIndex":
+        """Memory-map the saved index if it matches ``lines``, otherwise build and save it.
+
+        ``encoder`` is called (at most once) to get the SentenceTransformer. Builds
+        take the vectors from the EmbeddingCache in ``index_dir``, so only lines
+        that were added or changed since the last build are encoded.
+        """
+        import faiss
+        fingerprint = cls.fingerprint(lines, encoder_name)
+        index_path = os.path.join(index_dir, INDEX_FILE)
+        meta_path = os.path.join(index_dir, META_FILE)
+        try:
+            with open(meta_path, "r") as f:
+                saved = json.load(f)
+            if saved.get("fingerprint") == fingerprint:
+                index = cls._read(faiss, index_path)
+                logger.info(f"Loaded dialogue index with {index.ntotal} lines from {index_dir}")
+                return cls(lines, index, encoder)
+        except (OSError, ValueError, RuntimeError):
+            pass
+
+        models = []
+
+        def load_model():
+            if not models:
+                models.append(encoder())
+            return models[0]
+
+        cache = EmbeddingCache(index_dir, encoder_name)
+        vectors = cache.embed([line["text"] for line in lines], load_model)
+        index = faiss.IndexFlatIP(vectors.shape[1] if len(lines) else load_model().get_sentence_embedding_dimension())
+        index.add(vectors)
+        os.makedirs(index_dir, exist_ok=True)
+        # Write to temporary files and rename, so other workers never read a partial index
+        suffix = f".{os.getpid()}.tmp"
+        faiss.write_index(index, index_path + suffix)
+        os.replace(index_path + suffix, index_path)
+        with open(meta_path + suffix, "w") as f:
+            json.dump({"fingerprint": fingerprint, "encoder": encoder_name, "lines": len(lines)}, f)
+        os.replace(meta_path + suffix, meta_path)
+        logger.info(f"Built dialogue index with {index.ntotal} lines in {index_dir} ({cache.encoded} newly encoded)")
+        return cls(lines, cls._read(faiss, index_path), encoder, models[0] if models else None)
+
+    @staticmethod
+    def _read(faiss, index_path: str):
+        # IO_FLAG_MMAP maps the file instead of copying it into memory; newer faiss
+        # versions also need IO_FLAG_MMAP_IFC to map flat (IndexFlat) codes
+        flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        try:
+            return faiss.read_index(index_path, flags)
+        except RuntimeError:
+            return faiss.read_index(index_path)
+
+    def search(self, query: str, character: Optional[str] = None, category: Optional[str] = None,
+               k: int = 3) -> List[Dict]:
+        """The ``k`` lines most similar to ``query``, optionally from one character and category."""
+        if not query.strip() or self.index.ntotal == 0:
+            return []
+        if self._model is None:
+            self._model = self._encoder()
+        vector = self._model.encode([query], normalize_embeddings=True, convert_to_numpy=True).astype("float32")
+        # The corpus is small, so filtered searches rank every line and filter afterwards
+        limit = self.index.ntotal if character or category else min(k, self.index.ntotal)
+        scores, ids = self.index.search(vector, limit)
+        results = []
+        for score, line_id in zip(scores[0], ids[0]):
+            if line_id < 0:
+                continue
+            line = self.lines[line_id]
+            if _matches(line, character, category):
+                results.append(_result(line, score))
+                if len(results) >= k:
+                    break
+        return results
+
+    def embed(self, text: str) -> List[float]:
+        """Normalized encoder vector of ``text``, for callers comparing utterances."""
+        if self._model is None:
+            self._model = self._encoder()
+        vector = self._model.encode([text], normalize_embeddings=True, convert_to_numpy=True)[0]
+        return [float(value) for value in vector]
+
+
+class KeywordIndex:
+    """Word-overlap ranking with the same interface, for when FAISS or the encoder is unavailable."""
+    kind = "keyword"
+
+    def __init__(self, lines: List[Dict]):
+        self.lines = lines
+        self._words = [set(WORD_PATTERN.findall(line["text"].lower())) for line in lines]
+
+    def search(self, query: str, character: Optional[str] = None, category: Optional[str] = None,
+               k: int = 3) -> List[Dict]:
+        query_words = set(WORD_PATTERN.findall(query.lower()))
+        scored = []
+        for position, (line, words) in enumerate(zip(self.lines, self._words)):
+            if not _matches(line, character, category):
+                continue
+            overlap = len(query_words & words)
+            score = overlap / math.sqrt(len(query_words) * len(words)) if overlap else 0.0
+            # Ties keep file order, so a query with no overlap gets the category's first lines
+            scored.append((-score, position, line))
+        scored.sort(key=lambda item: (item[0], item[1]))
+        return [_result(line, -score) for score, _, line in scored[:k]]
+
+    def embed(self, text: str) -> List[float]:
+        """Normalized hashed bag of words: the same vocabulary gives cosine 1, no shared words 0."""
+        vector = [0.0] * HASHED_DIM
+        words = set(WORD_PATTERN.findall(text.lower()))
+        for word in words:
+            # crc32 rather than hash(), which differs between processes
+            vector[zlib.crc32(word.encode("utf-8")) % HASHED_DIM] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector] if norm else vector
+
+
+def default_index_dir() -> str:
+    """Where the FAISS index is saved: A2I2_DIALOGUE_INDEX_DIR, or results/dialogue_index."""
+    base_dir = os.getenv('A2I2_BASE_DIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return os.getenv("A2I2_DIALOGUE_INDEX_DIR", os.path.join(base_dir, "results", "dialogue_index"))
+
+
+def open_dialogue_index(lines: List[Dict], encoder: Optional[Callable] = None, index_dir: Optional[str] = None):
+    """SemanticIndex when faiss and sentence_transformers are installed, else KeywordIndex.
+
+    Set A2I2_DIALOGUE_INDEX=keyword to always use word overlap.
+    """
+    if os.getenv("A2I2_DIALOGUE_INDEX", "semantic").lower() == "keyword":
+        return KeywordIndex(lines)
+    try:
+        # Checked without importing it: a saved index would load fine and then fail at the first query
+        if importlib.util.find_spec("sentence_transformers") is None:
+            raise ImportError("No module named 'sentence_transformers'")
+        return SemanticIndex.open(lines, encoder or load_encoder, index_dir or default_index_dir())
+    except ImportError as e:
+        logger.info(f"Semantic dialogue search unavailable ({str(e)}), using keyword search")
+    except Exception as e:
+        logger.warning(f"Could not open the dialogue index, using keyword search: {str(e)}")
+    return KeywordIndex(lines)
+
+
+def load_dialogue_file(file_path: str) -> List[Dict]:
+    """Read character_lines.jsonl into the flattened form ``dialogue_lines`` returns."""
+    characters, operator = {}, {}
+    with open(file_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            if data.get("character") == "operator":
+                for category, texts in data.items():
+                    if isinstance(texts, list):
+                        operator.setdefault(category, []).extend(texts)
+            else:
+                characters[data["character"]] = data
+    return dialogue_lines(characters, operator)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the dialogue line index ahead of time, or query it.")
+    parser.add_argument("-dialogue", "--dialoguefile", default=DEFAULT_DIALOGUE_FILE,
+                        help="character_lines.jsonl to index")
+    parser.add_argument("--index-dir", default=None, help="Where to save the index (default: results/dialogue_index)")
+    parser.add_argument("--query", help="Print the best matches for this utterance")
+    parser.add_argument("--character", help="Only match this character's lines")
+    parser.add_argument("--category", help="Only match lines of this category")
+    parser.add_argument("-k", type=int, default=5, help="Number of matches to print")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    index = open_dialogue_index(load_dialogue_file(args.dialoguefile), index_dir=args.index_dir)
+    print(f"{index.kind} index over {len(index.lines)} lines")
+    if args.query:
+        for match in index.search(args.query, character=args.character, category=args.category, k=args.k):
+            print(f"{match['score']:.3f}  {match['character']}/{match['context']}: {match['content']}")
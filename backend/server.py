@@ -1,15 +1,26 @@
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from ollama_0220_openai import simulate_interactive_single_turn, conversation_manager, decision_making, emphasize_danger_check, emphasize_value_of_life_check, ending_conversation_check, mentions_fire_check, keep_asking_questions_check, simulate_dual_role_conversation, ask_about_children_check, ask_about_parents_check, engagement_check
+from ollama_0220_openai import simulate_interactive_single_turn_async, simulate_interactive_single_turn_stream, conversation_manager, decision_making_async, simulate_dual_role_conversation, classify_turn_async, TURN_CLASSIFIER_QUESTIONS, classifier_cache, local_classifier, close_async_client, context_selector, response_cache, retrieval_responder, degradation, generator, vector_store
+from starlette.concurrency import run_in_threadpool
+from dialogue_state_machine import DialogueStateMachine
+from log_config import configure_logging, log_dump
+from state_token import DEFAULT_STATE_MESSAGES, decode_state, encode_state, state_secret
+import logging
+import asyncio
 import subprocess
 import os
 import json
-import traceback
 from pathlib import Path
+from typing import Optional
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 import time
 
+# Queue-based JSON logging; per-turn dumps only at DEBUG and sampled (see log_config)
+configure_logging()
+logger = logging.getLogger("server")
+
 app = FastAPI()
 
 # Enable CORS with proper configuration for production
@@ -40,6 +51,7 @@ BASE_DIR = os.getenv('A2I2_BASE_DIR', os.path.dirname(os.path.dirname(os.path.ab
 OUTPUT_FILE_PATH = os.path.join(BASE_DIR, "results/answer_80.jsonl")
 PERSONA_FILE_PATH = os.path.join("data_for_train/persona.json")
 DIAL_FILE_PATH = os.path.join("data_for_train/character_lines.jsonl")
+STATES_FILE_PATH = os.path.join("data_for_train/character_states.json")
 PYTHON_SCRIPT = os.path.join("backend/ollama_0220.py")
 
 # Load persona and dialogue data
@@ -49,7 +61,7 @@ def load_json_file(file_path):
             return json.load(f)
     except Exception as e:
         import pdb; pdb.set_trace()
-        print(f"Error loading {file_path}: {str(e)}")
+        logger.error(f"Error loading {file_path}: {str(e)}")
         return {}
 
 # Function to load JSONL file
@@ -63,9 +75,11 @@ ben_data = None
 ana_data = None
 tom_data = None
 mia_data = None
+character_lines = {}
 with open(DIAL_FILE_PATH, 'r') as f:
     for line in f:
         dialogue_data_line = json.loads(line)
+        character_lines[dialogue_data_line['character']] = dialogue_data_line
         #import pdb; pdb.set_trace()
         if dialogue_data_line ['character'] == 'bob':
             bob_data = dialogue_data_line
@@ -96,18 +110,76 @@ with open(DIAL_FILE_PATH, 'r') as f:
 persona_data = load_json_file(PERSONA_FILE_PATH)
 dialogue_data = bob_data
 
+# Each character's states, transitions and prompts, compiled once into lookup tables
+state_machine = DialogueStateMachine.from_file(STATES_FILE_PATH, character_lines)
+
 # Request body model
 class ChatRequest(BaseModel):
     townPerson: str
     userInput: str
     mode: str  # "interactive" or "auto"
 
+# How often idle and over-budget sessions are evicted
+SESSION_SWEEP_INTERVAL = float(os.getenv("A2I2_SESSION_SWEEP_INTERVAL", "60"))
+
+# Stateless mode: with A2I2_STATE_SECRET set, /chat returns the conversation as a signed
+# ``state`` token that the client sends back, and no session outlives its request
+STATE_SECRET = state_secret()
+STATE_MAX_MESSAGES = int(os.getenv("A2I2_STATE_MAX_MESSAGES", str(DEFAULT_STATE_MESSAGES)))
+STATE_MAX_AGE = float(os.getenv("A2I2_STATE_MAX_AGE", os.getenv("A2I2_SESSION_TTL", "3600")))
+
+async def sweep_sessions():
+    """Background loop evicting expired sessions from the conversation store."""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            conversation_manager.evict_expired()
+        except Exception as e:
+            logger.exception(f"Error evicting sessions: {str(e)}")
+
+async def warm_dialogue_index():
+    """Open the dialogue index in a worker thread, so the first turns do not wait for the encoder."""
+    try:
+        await run_in_threadpool(vector_store.warm_index)
+    except Exception as e:
+        # Turns open the index themselves (and report the error) if warming failed
+        logger.exception(f"Error opening the dialogue index: {str(e)}")
+
+@app.on_event("startup")
+async def startup():
+    """Start the session eviction loop and open the dialogue index in the background."""
+    app.state.session_sweeper = asyncio.ensure_future(sweep_sessions())
+    app.state.index_warmup = asyncio.ensure_future(warm_dialogue_index())
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Stop the session eviction loop, flush stored sessions and close the pooled LLM client connections."""
+    sweeper = getattr(app.state, "session_sweeper", None)
+    if sweeper is not None:
+        sweeper.cancel()
+    conversation_manager.close()
+    await close_async_client()
+
 @app.get("/")
 @app.head("/")
 async def root():
     """Health check endpoint"""
     return {"status": "ok", "message": "Emergency Response Chatbot Backend is running"}
 
+@app.get("/metrics")
+async def metrics():
+    """Runtime counters for caches and sessions."""
+    return {
+        "classifier_cache": classifier_cache.stats(),
+        "local_classifier": local_classifier.stats(),
+        "context_selection": context_selector.stats(),
+        "response_cache": response_cache.stats(),
+        "retrieval_responder": retrieval_responder.stats(),
+        "degradation": degradation.stats(),
+        "llm": generator.stats(),
+        "sessions": conversation_manager.stats()
+    }
+
 @app.get("/persona/{town_person}")
 async def get_persona(town_person: str):
     """Get persona data for a specific town person."""
@@ -124,27 +196,155 @@ async def get_persona(town_person: str):
         return {"persona": persona_data[town_person_lower]}
     except Exception as e:
         import pdb; pdb.set_trace()
-        print(f"Error in get_persona: {str(e)}")
+        logger.error(f"Error in get_persona: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/clear-session/{town_person}")
-async def clear_session(town_person: str):
-    """Clear conversation history for a specific town person."""
+async def clear_session(town_person: str, sessionId: Optional[str] = None):
+    """Clear the conversation history of a session (``?sessionId=...``)."""
+    if sessionId is None or not conversation_manager.is_valid_session_id(sessionId):
+        raise HTTPException(status_code=400, detail="A valid sessionId is required")
     try:
-        town_person_lower = town_person.lower()
-        session_id = f"{town_person_lower}_session"
+        # Unknown IDs are not locked or stored, so they cannot leave anything behind
+        if not conversation_manager.has_session(sessionId):
+            return {"status": "ok", "message": f"No conversation history found for {town_person}"}
         
-        # Clear the conversation history
-        cleared = conversation_manager.clear_session(session_id)
+        # Clear the conversation history once any turn in progress has finished
+        async with conversation_manager.session_lock(sessionId):
+            cleared = conversation_manager.clear_session(sessionId)
         
         if cleared:
             return {"status": "ok", "message": f"Conversation history cleared for {town_person}"}
         else:
             return {"status": "ok", "message": f"No conversation history found for {town_person}"}
     except Exception as e:
-        print(f"Error in clear_session: {str(e)}")
+        logger.error(f"Error in clear_session: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Flags that pick the town person's next turn; "decision" never does, so it is
+# evaluated separately and concurrently with the reply.
+ROUTING_FLAGS = [flag for flag in TURN_CLASSIFIER_QUESTIONS if flag != "decision"]
+
+async def evaluate_decision(user_input, history, town_person_lower, local_only=False):
+    """Whether the town person has decided to evacuate, as 'yes'/'no'."""
+    flags = await classify_turn_async(user_input, history, town_person_lower, flags=["decision"], local_only=local_only)
+    decision_response = "yes" if flags["decision"] else "no"
+    logger.debug(f"Decision response: {decision_response}")
+    return decision_response
+
+async def await_decision(decision_task):
+    """Result of the decision task started by prepare_interactive_turn (None without history)."""
+    if decision_task is None:
+        return None
+    return await decision_task
+
+def cancel_decision(decision_task):
+    """Stop a decision task whose result is no longer needed, without leaving its exception unretrieved."""
+    if decision_task is None:
+        return
+    if not decision_task.done():
+        decision_task.cancel()
+    decision_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+async def prepare_interactive_turn(town_person, user_input, speaker, session_id):
+    """Record the operator's message, classify it and build the town person's turn.
+
+    Returns the turn (speaker, prompt, category) and a task resolving to the
+    decision response, which runs while the caller generates the reply. While the
+    model is degraded the turn is marked ``degraded`` and answered locally.
+    """
+    town_person_lower = town_person.lower()
+    decision_task = None
+    use_model = degradation.use_model()
+
+    # First, add the user's message to the conversation history
+    if user_input:
+       
+        conversation_manager.add_message(session_id, speaker, user_input)
+        log_dump(logger, "Added user input to history", session_id=session_id, speaker=speaker, content=user_input)
+    
+    # Get the conversation history to determine stage
+    history = conversation_manager.get_history(session_id, max_turns=11)
+    message_count = conversation_manager.message_count(session_id, max_turns=11)
+    
+    logger.debug(f"Interactive mode: message count = {message_count}")
+    
+    # Classify the latest turn once; the state machine reads its flags from this result.
+    # The decision does not affect the turn, so it runs alongside classification and the reply.
+    # Only the flags this character's transitions read at this stage are classified; the rest stay False.
+    turn_flags = {flag: False for flag in ROUTING_FLAGS}
+    if history and message_count >= 0:
+        decision_task = asyncio.ensure_future(evaluate_decision(user_input, history, town_person_lower, local_only=not use_model))
+    try:
+        needed_flags = state_machine.required_flags(town_person_lower, message_count) if decision_task is not None else []
+        if needed_flags:
+            classified = await classify_turn_async(user_input, history, town_person_lower, flags=needed_flags, local_only=not use_model)
+            turn_flags.update(classified)
+            logger.debug(f"Turn flags: {classified}")
+            # Store the flags on the operator's message so later turns never re-classify it
+            if user_input:
+                conversation_manager.annotate_message(session_id, classified)
+
+        # Route through the character's compiled state machine; picking context lines searches
+        # the dialogue index, so the turn is built in a worker thread
+        turn = await run_in_threadpool(
+            state_machine.build_turn,
+            town_person_lower,
+            message_count,
+            history,
+            persona_data[town_person_lower],
+            user_input,
+            speaker,
+            turn_flags,
+            lambda flag, **scan: conversation_manager.any_message_flagged(session_id, flag, **scan),
+            select_context=lambda name, category, lines: context_selector.select(name, category, lines, user_input)
+        )
+    except BaseException:
+        # Nobody will await the decision if the turn cannot be built (or the request is cancelled)
+        cancel_decision(decision_task)
+        raise
+    if not use_model:
+        # Keyword checks above, and the best-matching line of the category as the reply
+        turn["degraded"] = True
+        turn["retrieve"] = {"lines": state_machine.degraded_lines(town_person_lower, turn["category"]), "min_score": 0.0}
+    return turn, decision_task
+
+
+def request_session(data):
+    """Session for a /chat request, as (session_id, client state).
+
+    Normally this is the client's ``sessionId`` and no state. In stateless mode it is
+    a throwaway session plus the verified contents of the client's ``state`` token
+    (None on the first turn). Raises ValueError on an unknown ``townPerson``, an
+    invalid or unknown session ID or an invalid token; nothing is created then.
+    """
+    town_person = data.get("townPerson")
+    if not isinstance(town_person, str) or town_person.lower() not in persona_data:
+        raise ValueError(f"Unknown townPerson: {town_person}")
+    if STATE_SECRET is not None:
+        token = data.get("state")
+        state = decode_state(token, STATE_SECRET, STATE_MAX_AGE) if token else None
+        return conversation_manager.create_session(), state
+    # Sessions are issued by the server; a request without one starts a new conversation
+    session_id = data.get("sessionId")
+    if not session_id:
+        return conversation_manager.create_session(), None
+    if not conversation_manager.is_valid_session_id(session_id):
+        raise ValueError("Invalid sessionId")
+    # Client-chosen IDs (e.g. "bob_session") would let users share a conversation
+    if not conversation_manager.has_session(session_id):
+        raise ValueError("Unknown sessionId")
+    return session_id, None
+
+def client_state(session_id):
+    """Stateless mode: the conversation after this turn as a signed token."""
+    return encode_state(conversation_manager.export_session(session_id, STATE_MAX_MESSAGES), STATE_SECRET)
+
+@app.post("/session")
+async def create_session():
+    """Issue a new session ID; send it as ``sessionId`` on /chat and /clear-session."""
+    return {"sessionId": conversation_manager.create_session()}
+
 @app.post("/chat")
 async def chat(request: Request):
     try:
@@ -154,882 +354,462 @@ async def chat(request: Request):
         mode = data.get("mode", "interactive")
         speaker = data.get("speaker", "")
         auto_julie = data.get("autoJulie", False)
-        town_person_lower = town_person.lower()
         
         # Debug print to verify parameters
-        print(f"REQUEST: town_person={town_person}, mode={mode}, speaker={speaker}, auto_julie={auto_julie}")
+        logger.info("Chat request", extra={"fields": {
+            "town_person": town_person, "mode": mode, "speaker": speaker, "auto_julie": auto_julie
+        }})
         
-        # Simulating session tracking on the server side
-        session_id = f"{town_person_lower}_session"
-        decision_response = None  # Initialize decision_response for all town people
+        stateless = STATE_SECRET is not None
+        try:
+            session_id, state = request_session(data)
+        except ValueError as e:
+            return {"error": str(e)}
+
+        try:
+            # Turns of one session run one at a time, different sessions in parallel
+            async with conversation_manager.session_lock(session_id):
+                if state is not None:
+                    conversation_manager.import_session(session_id, state)
+                result = await chat_turn(town_person, user_input, mode, speaker, auto_julie, session_id)
+                if stateless:
+                    result["state"] = client_state(session_id)
+        finally:
+            if stateless:
+                conversation_manager.discard_session(session_id)
+        if not stateless:
+            result["sessionId"] = session_id
+        return result
+    except Exception as e:
+        logger.exception(f"Error in chat endpoint: {str(e)}")
+        return {"error": str(e)}
 
-        # If in interactive mode, the session ID is stable across requests
-        if mode == "interactive":
-            print(f"Interactive mode: session_id = {session_id}")
+async def chat_turn(town_person, user_input, mode, speaker, auto_julie, session_id):
+    """Run one /chat request against the given session."""
+    town_person_lower = town_person.lower()
+    decision_response = None  # Initialize decision_response for all town people
+
+    # If in interactive mode, the session ID is stable across requests
+    if mode == "interactive":
+        logger.debug(f"Interactive mode: session_id = {session_id}")
+        
+        if auto_julie:
+            # Get the conversation history
+            history = conversation_manager.get_history(session_id, max_turns=11)
             
-            if auto_julie:
-                # Get the conversation history
-                history = conversation_manager.get_history(session_id, max_turns=11)
-                
-                # Count messages to determine conversation stage
-                message_count = 0
-                if history:
-                    message_count = len(history.split('\n'))
-                
-                print(f"Auto Julie mode: message count = {message_count}")
+            # Count messages to determine conversation stage
+            message_count = conversation_manager.message_count(session_id, max_turns=11)
+            
+            logger.debug(f"Auto Julie mode: message count = {message_count}")
+            
+            # Check if conversation has ended due to message count
+            conversation_ended = message_count > 10
+            
+            # If conversation has ended, return early with indication
+            if conversation_ended:
+                logger.info("Conversation has ended due to message count exceeding limit")
+                return {
+                    "julieResponse": "Thank you for your time. Stay safe!",
+                    "response": "Goodbye, thank you for your help.",
+                    "conversation_ended": True,
+                    "message": "Conversation has ended."
+                }
+            
+            # Determine which category to use for Julie based on conversation stage
+            if message_count <= 1:
+                julie_category = "greetings"
+            elif message_count <= 5:
+                if town_person_lower == "bob" or town_person_lower == "michelle":
+                    julie_category = "emphasize_danger"
+                else:
+                    julie_category = "progression"
+            elif message_count <= 7:
+                julie_category = "progression"
+            elif message_count <= 9:
+                julie_category = "closing"
+            else:
+                logger.info("Conversation has ended due to message count exceeding limit")
+                return {
+                    "julieResponse": "Thank you for your time. Stay safe!",
+                    "response": "Goodbye, thank you for your help.",
+                    "conversation_ended": True,
+                    "message": "Conversation has ended."
+                }
+            
+            logger.debug(f"Selected Julie category: {julie_category}")
+            
+            # Get Julie's dialogue lines for the selected category
+            # Get the lines for Julie from operator_data
+            julie_context = julie_data.get(julie_category, [])
+            
+            # If category doesn't exist or is empty, use general as fallback
+            if not julie_context:
+                julie_category = "general"
+                julie_context = julie_data.get("general", [])
+                logger.debug(f"Fallback to Julie category: {julie_category}")
+
+            # Only the lines closest to what the town person last said go into Julie's prompt
+            last_reply = conversation_manager.last_message(session_id)
+            julie_context, julie_selection = await run_in_threadpool(
+                context_selector.select, "julie", julie_category, julie_context, last_reply.content if last_reply else ""
+            )
+            
+            # # Ensure we have context
+            # if not julie_context:
+            #     julie_context = ["Hi, I'm Julie. I'm here to help you evacuate safely."]
+            #     print("Using default Julie context")
+            
+            # Tailor the persuasion approach based on town person
+            if town_person_lower == "bob":
+                persuasion_focus = "Focus on how his work can be continued later or recovered, but his life cannot be replaced."
+            elif town_person_lower == "niki":
+                persuasion_focus = "Explain the fire danger clearly and directly to address her confusion and uncertainty."
+            elif town_person_lower == "lindsay":
+                persuasion_focus = "Emphasize the safety of her family and children, offer specific help with evacuating them."
+            elif town_person_lower == "ross":
+                persuasion_focus = "Use logical arguments about the fire's trajectory and timing to appeal to his practical nature."
+            elif town_person_lower == "michelle":
+                persuasion_focus = "Be respectful of her independence, provide factual information about the fire rather than giving commands."
+            else:
+                persuasion_focus = "Emphasize the imminent danger and the need to evacuate immediately."
+            
+            # Create the prompt for Julie's response
+            if julie_category == "closing":
+                # Make the closing instruction much more explicit when the category is "closing"
+                julie_prompt_content = f"This conversation is now ending. Generate ONLY a brief goodbye message to {town_person} that clearly ends the conversation. Choose from these closing lines: {julie_context}. Do not ask any questions or continue the conversation."
+            else:
+                julie_prompt_content = f"Generate a message to respond {town_person}. Use or adapt lines from this category: {julie_category}: {julie_context}."
+            
+            # Configure Julie's turn
+            julie_turn = {
+                "speaker": "julie",
+                "prompt": f"You are roleplaying as Julie, an emergency evacuation virtual assistant.\nPrevious conversation:\n{history}\n{julie_prompt_content}\nKeep your response in one short sentence. Only generate utterances, no system messages.",
+                "category": julie_category,
+                "context_selection": julie_selection
+            }
+            # While the model is degraded both replies are picked from their lines, like regular turns
+            use_model = degradation.use_model()
+            if not use_model:
+                julie_turn["degraded"] = True
+                julie_turn["retrieve"] = {
+                    "lines": julie_context or [vector_store.get_operator_response(julie_category)], "min_score": 0.0
+                }
+            
+            try:
+                logger.debug("Generating Julie's response")
+                # Generate Julie's persuasive message
+                julie_response, julie_retrieved_info = await simulate_interactive_single_turn_async(
+                    "julie",
+                    "",
+                    speaker="Julie",
+                    persona=persona_data.get("julie", "A virtual assistant specializing in emergency evacuations"),
+                    turn=julie_turn,
+                    session_id=session_id
+                )
                 
-                # Check if conversation has ended due to message count
-                conversation_ended = message_count > 10
+                log_dump(logger, "Julie's response generated", response=julie_response, retrieved_info=julie_retrieved_info)
                 
-                # If conversation has ended, return early with indication
-                if conversation_ended:
-                    print("Conversation has ended due to message count exceeding limit")
-                    return {
-                        "julieResponse": "Thank you for your time. Stay safe!",
-                        "response": "Goodbye, thank you for your help.",
-                        "conversation_ended": True,
-                        "message": "Conversation has ended."
-                    }
+                # Add Julie's message to conversation history
+                # conversation_manager.add_message(session_id, "Julie", julie_response)
                 
-                # Determine which category to use for Julie based on conversation stage
-                if message_count <= 1:
-                    julie_category = "greetings"
-                elif message_count <= 5:
-                    if town_person_lower == "bob" or town_person_lower == "michelle":
-                        julie_category = "emphasize_danger"
-                    else:
-                        julie_category = "progression"
-                elif message_count <= 7:
-                    julie_category = "progression"
-                elif message_count <= 9:
-                    julie_category = "closing"
+                # Prepare Julie's retrieved info with full prompt
+                if isinstance(julie_retrieved_info, dict):
+                    julie_retrieved_info["full_prompt"] = julie_turn["prompt"]
+                    julie_retrieved_info["speaker"] = "julie"
                 else:
-                    print(f"Conversation has ended due to message count exceeding limit")
-                    return {
-                        "julieResponse": "Thank you for your time. Stay safe!",
-                        "response": "Goodbye, thank you for your help.",
-                        "conversation_ended": True,
-                        "message": "Conversation has ended."
+                    julie_retrieved_info = {
+                        "full_prompt": julie_turn["prompt"],
+                        "speaker": "julie"
                     }
                 
-                print(f"Selected Julie category: {julie_category}")
-                
-                # Get Julie's dialogue lines for the selected category
-                # Get the lines for Julie from operator_data
-                julie_context = julie_data.get(julie_category, [])
-                
-                # If category doesn't exist or is empty, use general as fallback
-                if not julie_context:
-                    julie_category = "general"
-                    julie_context = julie_data.get("general", [])
-                    print(f"Fallback to Julie category: {julie_category}")
+                # Now generate town person's response to Julie
+                # Create appropriate turn for town person based on their character
+                town_person_category = ""
+                context = []
                 
-                # # Ensure we have context
-                # if not julie_context:
-                #     julie_context = ["Hi, I'm Julie. I'm here to help you evacuate safely."]
-                #     print("Using default Julie context")
-                
-                # Tailor the persuasion approach based on town person
+                # Select appropriate category for town person's response
                 if town_person_lower == "bob":
-                    persuasion_focus = "Focus on how his work can be continued later or recovered, but his life cannot be replaced."
+                    if message_count <= 2:
+                        town_person_category = "greetings"
+                    elif message_count <= 5:
+                        town_person_category = "work_resistance"
+                    else:
+                        town_person_category = "minimal_engagement"
+                    context = bob_data[town_person_category]
                 elif town_person_lower == "niki":
-                    persuasion_focus = "Explain the fire danger clearly and directly to address her confusion and uncertainty."
+                    if message_count <= 2:
+                        town_person_category = "greetings"
+                    elif message_count <= 5:
+                        town_person_category = "observations"
+                    else:
+                        town_person_category = "progression"
+                    context = niki_data[town_person_category]
                 elif town_person_lower == "lindsay":
-                    persuasion_focus = "Emphasize the safety of her family and children, offer specific help with evacuating them."
+                    if message_count <= 2:
+                        town_person_category = "greetings"
+                    elif message_count <= 5:
+                        town_person_category = "observations"
+                    else:
+                        town_person_category = "progression"
+                    context = lindsay_data[town_person_category]
                 elif town_person_lower == "ross":
-                    persuasion_focus = "Use logical arguments about the fire's trajectory and timing to appeal to his practical nature."
+                    if message_count <= 2:
+                        town_person_category = "greetings"
+                    elif message_count <= 5:
+                        town_person_category = "response_to_operator_greetings"
+                    else:
+                        town_person_category = "progression"
+                    context = ross_data[town_person_category]
                 elif town_person_lower == "michelle":
-                    persuasion_focus = "Be respectful of her independence, provide factual information about the fire rather than giving commands."
-                else:
-                    persuasion_focus = "Emphasize the imminent danger and the need to evacuate immediately."
+                    if message_count <= 2:
+                        town_person_category = "greetings"
+                    elif message_count <= 5:
+                        town_person_category = "response_to_operator_greetings"
+                    else:
+                        town_person_category = "refuse_assistance"
+                    context = michelle_data[town_person_category]
+                
+                logger.debug(f"Selected town person category: {town_person_category}")
+                
+                prompt_content = f"Generate a response to Julie's persuasive message. Use or adapt lines from this {town_person_category}: {context}."
+                
+                # Create turn for town person
+                town_person_turn = {
+                    "speaker": town_person_lower,
+                    "prompt": f"You are roleplaying as {town_person}, \n{town_person}'s background: {persona_data[town_person_lower]}\nPrevious conversation:\n{history}\n{prompt_content}\nJulie just said: {julie_response}\nPlease generate a response based on this message and keep your response natural and brief. Only generate utterances, no system messages.",
+                    "category": town_person_category
+                }
+                if not use_model:
+                    town_person_turn["degraded"] = True
+                    town_person_turn["retrieve"] = {
+                        "lines": state_machine.degraded_lines(town_person_lower, town_person_category), "min_score": 0.0
+                    }
+                
+                logger.debug("Generating town person's response")
+                # Generate town person's response to Julie
+                response, retrieved_info = await simulate_interactive_single_turn_async(
+                    town_person_lower,
+                    julie_response,  # Using Julie's message as the input
+                    speaker="Julie",
+                    persona=persona_data[town_person_lower],
+                    turn=town_person_turn,
+                    session_id=session_id
+                )
+                
+                log_dump(logger, "Town person's response generated", town_person=town_person_lower, response=response)
+                
+                # Add town person's response to history
+                # conversation_manager.add_message(session_id, town_person, response)
                 
-                # Create the prompt for Julie's response
-                if julie_category == "closing":
-                    # Make the closing instruction much more explicit when the category is "closing"
-                    julie_prompt_content = f"This conversation is now ending. Generate ONLY a brief goodbye message to {town_person} that clearly ends the conversation. Choose from these closing lines: {julie_context}. Do not ask any questions or continue the conversation."
+                # Prepare retrieved info
+                if isinstance(retrieved_info, dict):
+                    retrieved_info["full_prompt"] = town_person_turn["prompt"]
+                    retrieved_info["speaker"] = town_person_lower
                 else:
-                    julie_prompt_content = f"Generate a message to respond {town_person}. Use or adapt lines from this category: {julie_category}: {julie_context}."
+                    retrieved_info = {
+                        "full_prompt": town_person_turn["prompt"],
+                        "speaker": town_person_lower
+                    }
+                
+                # Get decision response if appropriate
+                if conversation_manager.message_count(session_id):
+                    updated_history = conversation_manager.get_history(session_id, max_turns=11)
+                    if use_model:
+                        decision_response = await decision_making_async(updated_history,town_person_lower)
+                    else:
+                        decision_response = await evaluate_decision(julie_response, updated_history, town_person_lower, local_only=True)
                 
-                # Configure Julie's turn
-                julie_turn = {
-                    "speaker": "julie",
-                    "prompt": f"You are roleplaying as Julie, an emergency evacuation virtual assistant.\nPrevious conversation:\n{history}\n{julie_prompt_content}\nKeep your response in one short sentence. Only generate utterances, no system messages.",
-                    "category": julie_category
+                logger.debug("Returning Auto Julie response")
+                # Return both Julie's message, retrieved info, and town person's response
+                result = {
+                    "julieResponse": julie_response,
+                    "julieRetrievedInfo": julie_retrieved_info,
+                    "response": response,
+                    "retrieved_info": retrieved_info,
+                    "category": town_person_turn["category"],
+                    "decision_response": decision_response,
+                    "conversation_ended": message_count > 10
                 }
+                if not use_model:
+                    result["degraded"] = True
+                return result
                 
-                try:
-                    print("Generating Julie's response...")
-                    # Generate Julie's persuasive message
-                    julie_response, julie_retrieved_info = simulate_interactive_single_turn(
-                        "julie",
-                        "",
-                        speaker="Julie",
-                        persona=persona_data.get("julie", "A virtual assistant specializing in emergency evacuations"),
-                        turn=julie_turn,
+            except Exception as e:
+                logger.exception(f"Error in 'Auto Julie' mode: {str(e)}")
+                return {"error": f"Error processing Julie's persuasion: {str(e)}"}
+        
+        else:
+            # Handle regular interactive mode (not auto Julie)
+            turn, decision_task = await prepare_interactive_turn(
+                town_person, user_input, speaker, session_id
+            )
+            try:
+                # Generate town person's response while the decision is evaluated
+                (response, retrieved_info), decision_response = await asyncio.gather(
+                    simulate_interactive_single_turn_async(
+                        town_person_lower,
+                        user_input,
+                        speaker=speaker,
+                        persona=persona_data[town_person_lower],
+                        turn=turn,
                         session_id=session_id
-                    )
-                    
-                    print(f"Julie's response generated: {julie_response}")
-                    print(f"Julie's retrieved info: {julie_retrieved_info}")
-                    
-                    # Add Julie's message to conversation history
-                    # conversation_manager.add_message(session_id, "Julie", julie_response)
-                    
-                    # Prepare Julie's retrieved info with full prompt
-                    if isinstance(julie_retrieved_info, dict):
-                        julie_retrieved_info["full_prompt"] = julie_turn["prompt"]
-                        julie_retrieved_info["speaker"] = "julie"
-                    else:
-                        julie_retrieved_info = {
-                            "full_prompt": julie_turn["prompt"],
-                            "speaker": "julie"
-                        }
-                    
-                    # Now generate town person's response to Julie
-                    # Create appropriate turn for town person based on their character
-                    town_person_category = ""
+                    ),
+                    await_decision(decision_task)
+                )
+                
+                # Check if response is in history and add it if not
+                last_reply = conversation_manager.last_message(session_id, speaker=town_person)
+                if last_reply is None or last_reply.content != response:
+                    # If response isn't in history already, add it explicitly
+                    conversation_manager.add_message(session_id, town_person, response)
+                    logger.debug(f"Explicitly added {town_person}'s response to history")
+                
+                # Return town person's response
+                if isinstance(retrieved_info, dict):
+                    # Include the full prompt in the retrieved info for all characters
+                    full_prompt = turn["prompt"]
+                    retrieved_info["full_prompt"] = full_prompt
                     
-                    # Select appropriate category for town person's response
-                    if town_person_lower == "bob":
-                        if message_count <= 2:
-                            town_person_category = "greetings"
-                        elif message_count <= 5:
-                            town_person_category = "work_resistance"
-                        else:
-                            town_person_category = "minimal_engagement"
-                        context = bob_data[town_person_category]
-                    elif town_person_lower == "niki":
-                        if message_count <= 2:
-                            town_person_category = "greetings"
-                        elif message_count <= 5:
-                            town_person_category = "observations"
-                        else:
-                            town_person_category = "progression"
-                        context = niki_data[town_person_category]
+                    # Make sure speaker is set correctly
+                    if town_person_lower == "niki":
+                        retrieved_info["speaker"] = "niki"
                     elif town_person_lower == "lindsay":
-                        if message_count <= 2:
-                            town_person_category = "greetings"
-                        elif message_count <= 5:
-                            town_person_category = "observations"
-                        else:
-                            town_person_category = "progression"
-                        context = lindsay_data[town_person_category]
+                        retrieved_info["speaker"] = "lindsay"
                     elif town_person_lower == "ross":
-                        if message_count <= 2:
-                            town_person_category = "greetings"
-                        elif message_count <= 5:
-                            town_person_category = "response_to_operator_greetings"
-                        else:
-                            town_person_category = "progression"
-                        context = ross_data[town_person_category]
+                        retrieved_info["speaker"] = "ross"
                     elif town_person_lower == "michelle":
-                        if message_count <= 2:
-                            town_person_category = "greetings"
-                        elif message_count <= 5:
-                            town_person_category = "response_to_operator_greetings"
-                        else:
-                            town_person_category = "refuse_assistance"
-                        context = michelle_data[town_person_category]
-                    
-                    print(f"Selected town person category: {town_person_category}")
-                    
-                    prompt_content = f"Generate a response to Julie's persuasive message. Use or adapt lines from this {town_person_category}: {context}."
-                    
-                    # Create turn for town person
-                    town_person_turn = {
-                        "speaker": town_person_lower,
-                        "prompt": f"You are roleplaying as {town_person}, \n{town_person}'s background: {persona_data[town_person_lower]}\nPrevious conversation:\n{history}\n{prompt_content}\nJulie just said: {julie_response}\nPlease generate a response based on this message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": town_person_category
-                    }
-                    
-                    print("Generating town person's response...")
-                    # Generate town person's response to Julie
-                    response, retrieved_info = simulate_interactive_single_turn(
-                        town_person_lower,
-                        julie_response,  # Using Julie's message as the input
-                        speaker="Julie",
-                        persona=persona_data[town_person_lower],
-                        turn=town_person_turn,
-                        session_id=session_id
-                    )
-                    
-                    print(f"Town person's response generated: {response}")
-                    
-                    # Add town person's response to history
-                    # conversation_manager.add_message(session_id, town_person, response)
-                    
-                    # Prepare retrieved info
-                    if isinstance(retrieved_info, dict):
-                        retrieved_info["full_prompt"] = town_person_turn["prompt"]
-                        retrieved_info["speaker"] = town_person_lower
-                    else:
-                        retrieved_info = {
-                            "full_prompt": town_person_turn["prompt"],
-                            "speaker": town_person_lower
-                        }
-                    
-                    # Get decision response if appropriate
-                    updated_history = conversation_manager.get_history(session_id, max_turns=11)
-                    if updated_history and len(updated_history.split('\n')) >= 0:
-                        decision_response = decision_making(updated_history,town_person_lower)
-                    
-                    print("Returning Auto Julie response")
-                    # Return both Julie's message, retrieved info, and town person's response
-                    return {
-                        "julieResponse": julie_response,
-                        "julieRetrievedInfo": julie_retrieved_info,
-                        "response": response,
-                        "retrieved_info": retrieved_info,
-                        "category": town_person_turn["category"],
-                        "decision_response": decision_response,
-                        "conversation_ended": message_count > 10
+                        retrieved_info["speaker"] = "michelle"
+                else:
+                    # If retrieved_info is not a dict, create a new one
+                    retrieved_info = {
+                        "full_prompt": turn["prompt"],
+                        "speaker": town_person_lower
                     }
-                    
-                except Exception as e:
-                    print(f"Error in 'Auto Julie' mode: {str(e)}")
-                    traceback.print_exc()
-                    return {"error": f"Error processing Julie's persuasion: {str(e)}"}
-            
-            else:
-                # Handle regular interactive mode (not auto Julie)
-                # First, add the user's message to the conversation history
-                if user_input:
-                   
-                    conversation_manager.add_message(session_id, speaker, user_input)
-                    print(f"Added user input to history: {speaker}: {user_input}")
                 
-                # Get the conversation history to determine stage
-                history = conversation_manager.get_history(session_id, max_turns=11)
-                message_count = 0
-                if history:
-                    message_count = len(history.split('\n'))
-                
-                print(f"Interactive mode: message count = {message_count}")
-                
-                # Get decision response if we have enough messages
-                if history and message_count >= 0:
-                    decision_response = decision_making(history,town_person_lower)
-                    print(f"Decision response: {decision_response}")
+                logger.debug(f"Decision response: {decision_response}")
+                result = {
+                    "response": response,
+                    "retrieved_info": retrieved_info,
+                    "category": turn["category"],
+                    "decision_response": decision_response
+                }
+                if turn.get("degraded"):
+                    result["degraded"] = True
+                return result
                 
-                # Special structure for Bob with branching logic
-                if town_person_lower == "bob":
-                    # Check if the operator is speaking personally
-                    is_operator_personal = False
-                    emphasizes_danger = False
-                    emphasizes_value_of_life = False
-                    ending_conversation = False
-                    emphasizes_danger_final = False
-                    if history and message_count >= 5:
-                        i=0
-                        for line in history.split('\n'):
-                            i+=1
-                            if i >=4:
-                                ##check if the current line is from operator
-                                if "operator" == line.split(':')[0].lower():
-                                    if "yes" in emphasize_danger_check(line).lower():
-                                        emphasizes_danger_final = True
+            except Exception as e:
+                logger.exception(f"Error in interactive mode: {str(e)}")
+                return {"error": f"Error generating response: {str(e)}"}
+            finally:
+                cancel_decision(decision_task)
+        
+    elif mode == "auto":
+        try:
+            logger.info(f"Starting auto mode generation for {town_person}")
+            # Generate the entire conversation at once
+            # The full auto conversation is a long synchronous run, keep it off the event loop
+            transcript, retrieved_info, decision = await run_in_threadpool(
+                simulate_dual_role_conversation,
+                persona_data[town_person_lower],
+                town_person # Keep original case for display
+            )
             
-                                        break
-                        
-                    if history and message_count >= 0:
-                        decision_response = decision_making(history,town_person_lower)
-                        print(f"Decision response: {decision_response}")
-                        
-                        last_message = user_input.lower()
-                        # Check if message emphasizes fire danger
-                        emphasizes_danger_response = emphasize_danger_check(last_message)
-                        print(f"emphasize_danger_response: {emphasizes_danger_response}")
-                        emphasizes_value_of_life_response = emphasize_value_of_life_check(last_message)
-                        print(f"emphasize_value_of_life_response: {emphasizes_value_of_life_response}")
-                        # if emphasizes_danger == "yes":
-                        #     emphasizes_danger = True
-                        if "yes" in emphasizes_danger_response.lower():
-                            emphasizes_danger = True
-                        if "yes" in emphasizes_value_of_life_response.lower():  
-                            emphasizes_value_of_life = True
-                        # 
-                        if any(keyword in last_message for keyword in ["fine", "alright", "sure", "ok","sounds good","thank",'thanks',"bye","goodbye","see you"]):
-                            ending_conversation = True
-                        # If both conditions are met, the operator is being personally persuasive
-                        is_operator_personal = emphasizes_danger or emphasizes_value_of_life
-                    
-                    # Determine conversation stage based on message count and operator interaction
-                    category = ""
-                    if message_count == 1:
-                        # Initial dismissal - Bob ignores evacuation warnings
-                        category = "greetings"
-                        # Find Bob's responses in the dialogue data
-                        context = bob_data[category]
-                        
-                        prompt_content = f"Generate an initial response to the operator's or julie's greeting. Use or adapt lines from this {category}:{context}. If the message came from Julie, show reluctance to even acknowledge her. If the message came from the Operator, be slightly more responsive but still resistant."
-                    
-                    elif message_count ==3 :
-                        # Work-focused resistance - Bob emphasizes his work is too important
-                        category = "work_resistance"
-                        # Find Bob's responses in the dialogue data
-                        context = bob_data[category]
-                        
-                        prompt_content = f"Generate a response focusing heavily on your work being too important to leave behind. Use or adapt lines from this {category}: {context}. If the previous message tried to emphasize danger, respond with skepticism. If the previous message tried to be empathetic, still refuse but with slightly less hostility."
-                    
-                    elif message_count == 5:
-                        print(f"emphasizes_danger_response: {emphasizes_danger_response}")
-                        # Decision point - Either minimal engagement or beginning to consider evacuation
-                        # category = "decision_point" if is_operator_personal else "minimal_engagement"
-                        # print(f"Category: {category}")
-                        
-                        # # Find Bob's responses in the dialogue data
-                        # context = bob_data[category]
-                        
-                        if emphasizes_danger:
-                            category = "decision_point"
-                            context = bob_data[category]
-                            prompt_content = f"Generate a response showing that you're beginning to consider the evacuation warning. The operator has personally emphasized the danger of the fire. Choose from: {context} to show that you're starting to take the threat seriously."
-                        else:
-                            
-                            category = "minimal_engagement"
-                            context = bob_data[category]
-                            prompt_content = f"Generate a response with minimal engagement. Showing frustration at continued persuasion attempts. Use lines from this {category}: {context} that show resistance. Keep your response very brief and show you're disengaging from the conversation."
-                    
-                    elif message_count == 7:
-                        # Final resolution - Either evacuation agreement or final refusal
-                        print(f"emphasizes_value_of_life_response: {emphasizes_value_of_life_response}")
-                        print(f"emphasizes_danger_final: {emphasizes_danger_final}")
-                        if emphasizes_value_of_life or emphasizes_danger_final:
-                            category = "progression"
-                            print(f"Category: {category}")
-                            # Find Bob's responses in the dialogue data
-                            context = bob_data[category]
-                            
-                            prompt_content = f"Generate a response agreeing to evacuate. Please be flexible based on the previous message. The operator has personally convinced you that the danger is real and no work is worth risking your life. Choose from this {category}: {context} like \"Okay, I'm not stupid. Let me just grab my bag and I'll head out.\" Show that you've been convinced to prioritize your safety."
-                        else:
-                            category = "final_refusal"
-                            print(f"Category: {category}")
-                            context = bob_data[category]
-                            
-                            prompt_content = f"Generate your final response refusing to evacuate. Please be flexible based on the previous message. Choose from this {category}: {context} to emphasize that you will not leave your work behind. This is your final decision and nothing will change your mind."
-                    else:
-                        if ending_conversation:
-                            category = "closing"
-                            context = bob_data[category]
-                            prompt_content = f"Generate a response ending the conversation. Choose from this {category}: {context} to show that you're done talking."
-                            print(f"Ending conversation")
-                        else:
-                            category = "closing"
-                            context = bob_data[category]
-                            prompt_content = f"Generate a response ending the conversation. Please be flexible based on the previous message. Choose from this {category}: {context} "
-                            # category = "ending_conversation"
-                            # print(f"Category: {category}")
-                            # context = bob_data[category]
-                
-                            # prompt_content = f"Generate a response ending the conversation. Choose from this {category}: {context} to show that you're done talking."
-                
-                    # Create turn object with the selected category and prompt - fix formatting to avoid string format issues
-                    turn = {
-                        "speaker": "bob",
-                        "prompt": f"You are roleplaying as Bob, \nBob's background: {persona_data['bob']}\nPrevious conversation:\n{history}\n{prompt_content}\n please generate a response based on the last message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": category
-                    }
-                elif town_person_lower == "niki":
-                    keep_asking_questions = False
-                    mentions_fire = False
-                    ending_conversation = False
-                    if history and message_count > 2 and speaker == "Operator":
-                        last_message = history
-                        # Check if message emphasizes fire danger
-                        keep_asking_questions_response = keep_asking_questions_check(history)
-                        if "yes" in keep_asking_questions_response.lower():
-                            keep_asking_questions = True
-                        if ending_conversation_check(history):
-                            if "yes" in ending_conversation_check(history).lower():
-                                ending_conversation = True
-                            else:
-                                ending_conversation = False
-                    category = ""
-                    if message_count == 1:
-                        category = "greetings"
-                        context = niki_data[category]
-                        prompt_content = f"Generate an initial response to the operator's or julie's greeting. Use or adapt lines from this {category}:{context}. If the message came from Julie, show reluctance to even acknowledge her. If the message came from the Operator, be slightly more responsive but shows uncertainty and unware of the danger."
-                    elif message_count == 3:
-                        if mentions_fire:
-                            category = "progression"
-                            context = niki_data[category]
-                            prompt_content = f"Generate a response acknowledging the danger and agreeing to evacuate. Please be flexible based on the previous message. Choose from this {category}: {context}"
+            log_dump(logger, "Generated transcript", transcript=transcript, retrieved_info=retrieved_info, decision=decision)
             
-                        else:
-                            category = "response_to_operator_greetings"
-                            context = niki_data[category]
-                            prompt_content = f"Generate a response to the operator's greeting or answer the operator's question. Use or adapt lines from this {category}:{context}. If the message came from Julie, show reluctance to even acknowledge her. If the message came from the Operator, be slightly more responsive but try to confirm the danger."
-                    elif message_count == 5:
-                        print(f"mentions_fire_response: {mentions_fire_response}")
-                        if mentions_fire:
-                            category = "progression"
-                            context = niki_data[category]
-                            prompt_content = f"Generate a final response acknowledging the danger and agreeing to evacuate. Please be flexible based on the previous message. Choose from this {category}: {context}"
-                        elif ending_conversation:
-                            category = "closing"
-                            context = niki_data[category]
-                            prompt_content = f"Generate a final response to the operator or julie that agrees to evacuate. Please be flexible based on the previous message. Choose from this {category}: {context}"
-                        elif keep_asking_questions:
-                            category = "observation"
-                            context = niki_data[category]
-                            prompt_content = f"Generate a response to answer the operator's or julie's question. Use or adapt lines from this {category}:{context}. "
-                        else:
-                            category = "progression"
-                            context = niki_data[category]
-                        prompt_content = f"Generate a response agreeing to evacuate. Use or adapt lines from this {category}:{context}. "
-                    elif message_count == 7:
-                        if mentions_fire:
-                            category = "progression"
-                            context = niki_data[category]
-                            prompt_content = f"Generate your response acknowledging the danger and agreeing to evacuate. Please be flexible based on the previous message. Choose from this {category}: {context}"
-                        elif keep_asking_questions:
-                            print(f"keep_asking_questions_response: {keep_asking_questions_response}")
-                            category = "observation_2"
-                            context = niki_data[category]
-                            prompt_content = f"Generate your response to answer the operator's or julie's question. Please be flexible based on the previous message. Choose from this {category}: {context} "
-                        elif ending_conversation:
-                            category = "closing"
-                            context = niki_data[category]
-                            prompt_content = f"Generate your response ending the conversation. Please be flexible based on the previous message. Choose from this {category}: {context} "
-                        else:
-                            category = "progression"
-                            context = niki_data[category]
-                            prompt_content = f"Generate your final response finally agreeing to evacuate. Choose from this {category}: {context} "
+            return {
+                "transcript": transcript,
+                "retrieved_info": retrieved_info,
+                "is_complete": True,
+                "decision": decision}
+             
+        except Exception as e:
+            logger.exception(f"Error in auto mode generation: {str(e)}")
+            return {"error": f"Error generating conversation: {str(e)}"}
+    return {"error": f"Unknown mode: {mode}"}
 
-                    else:
-                        if ending_conversation:
-                            category = "closing"
-                            context = niki_data[category]
-                            prompt_content = f"Generate your response ending the conversation. Choose from this {category}: {context} "
+def sse_event(event, data):
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-                        else:
-                            category = "progression"
-                            context = niki_data[category]
-                            prompt_content = f"Generate your final response finally agreeing to evacuate. Choose from this {category}: {context} "
-                    turn = {
-                        "speaker": "niki",
-                        "prompt": f"You are roleplaying as Niki, \nNiki's background: {persona_data['niki']}\nPrevious conversation:\n{history}\n{prompt_content}\n please generate a response based on the last message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": category
-                    }
-                elif town_person_lower == "lindsay":
-                    mentions_children = False
-                    mentions_parents = False
-                    ending_conversation = False
-                    mentions_fire = False
-                    mentions_fire_final=False
-                    if history and message_count >= 3:
-                        for line in history.split('\n'):
-                            if "yes" in mentions_fire_check(line).lower():
-                                mentions_fire_final = True
-                                break
-                    if history and message_count > 0 and speaker == "Operator":
-                        last_message = user_input.lower()
-                        ask_about_children_response = ask_about_children_check(last_message)
-                        if "yes" in ask_about_children_response.lower():
-                            mentions_children = True
-                        ask_about_parents_response = ask_about_parents_check(last_message)
-                        if "yes" in ask_about_parents_response.lower():
-                            mentions_parents = True
-                        if any(keyword in last_message for keyword in ["fine", "alright", "sure", "ok","sounds good","thank",'thanks',"bye","goodbye","see you"]):
-                            ending_conversation = True
-                        mentions_fire_response = mentions_fire_check(last_message)
-                        if "yes" in mentions_fire_response.lower():
-                            mentions_fire = True
-                            mentions_fire_final = True
-                    category = ""
-                    if message_count == 1:
-                        category = "greetings"
-                        context = lindsay_data[category]
-                        prompt_content = f"Generate an initial response to the operator's or julie's greeting. Use or adapt lines from this {category}:{context}. "
-                    elif message_count == 3:
-                        if mentions_fire:
-                            category = "progression"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a response acknowledging the danger and agreeing to evacuate. Please be flexible based on the previous message. Choose from this {category}: {context}"
-                            mentions_fire_final = True
-                        else:
-                            category = "response_to_operator_greetings"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a response to the operator's greeting or answer the operator's question. Use or adapt lines from this {category}:{context}. "
-                    elif message_count == 5:
-                        
-                        if mentions_children:
-                            category = "children"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a response to answer the operator's or julie's question about the children. Use or adapt lines from this {category}:{context}. "
-                        elif mentions_parents:
-                            category = "parents"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a response to answer the operator's or julie's question about the parents. Use or adapt lines from this {category}:{context}. "
-                        elif mentions_fire or mentions_fire_final:
-                            category = "progression"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a response agreeing to evacuate. Use or adapt lines from this {category}:{context}. "
-                        elif ending_conversation:
-                            category = "closing"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a final response to operator or julie. Use or adapt lines from this {category}:{context}. "
-            
-                        else:
-                            category = "observations"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a response to answer the operator's or julie's question about the fire. Use or adapt lines from this {category}:{context}. "
-                    elif message_count == 7:
-                        if mentions_children:
-                            category = "children"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a response to answer the operator's or julie's question. Use or adapt lines from this {category}:{context}. "   
-                        elif mentions_parents:
-                            category = "parents"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a response to answer the operator's or julie's question. Use or adapt lines from this {category}:{context}. "
-                        elif mentions_fire or mentions_fire_final:
-                            category = "progression"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a final response agreeing to evacuate. Use or adapt lines from this {category}:{context}. "
-                        elif ending_conversation:
-                            category = "closing"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a final response to operator or julie. Use or adapt lines from this {category}:{context}. "
-                        else:
-                            category = "progression"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a response agreeing to evacuate. Use or adapt lines from this {category}:{context}. "
-                    else:
-                        if ending_conversation:
-                            category = "closing"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate a final response to operator or julie. Use or adapt lines from this {category}:{context}. "
-                        else:
-                            category = "progression"
-                            context = lindsay_data[category]
-                            prompt_content = f"Generate your final response finally agreeing to evacuate. Use or adapt lines from this {category}:{context}. "
-                    turn = {
-                        "speaker": "lindsay",
-                        "prompt": f"You are roleplaying as Lindsay, \nLindsay's background: {persona_data['lindsay']}\nPrevious conversation:\n{history}\n{prompt_content}\n please generate a response based on the last message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": category
-                    }
-                elif town_person_lower == "ross":
-                    ending_conversation = False
-                    if history and message_count > 5 and speaker == "Operator":
-                        last_message = user_input.lower()
-                        if any(keyword in last_message for keyword in ["fine", "alright", "sure", "ok","sounds good","thank",'thanks',"bye","goodbye","see you"]):
-                            ending_conversation = True
-                    category = ""
-                    if message_count == 1:
-                        category = "greetings"
-                        context = ross_data[category]
-                        prompt_content = f"Generate an initial response to the operator's or julie's greeting. Use or adapt lines from this {category}:{context}. "
-                    elif message_count == 3:
-                        category = "response_to_operator_greetings"
-                        context = ross_data[category]
-                        prompt_content = f"Generate a response to the operator's greeting or answer the operator's question. Use or adapt lines from this {category}:{context}. "
-                    elif message_count == 5:
-                        category = "progression"
-                        context = ross_data[category]
-                        prompt_content = f"Generate a response agreeing to evacuate. Use or adapt lines from this {category}:{context}. "
-                    elif message_count == 7:
-                        if ending_conversation:
-                            category = "closing"
-                            context = ross_data[category]
-                            prompt_content = f"Generate a final response to operator or julie. Use or adapt lines from this {category}:{context}. "
-                        else:
-                            category = "progression"
-                            context = ross_data[category]
-                            prompt_content = f"Generate a response agreeing to evacuate. Use or adapt lines from this {category}:{context}. "
-                    else:
-                        if ending_conversation:
-                            category = "closing"
-                            context = ross_data[category]
-                            prompt_content = f"Generate a final response to operator or julie. Use or adapt lines from this {category}:{context}. "
-                        else:
-                            category = "progression"
-                            context = ross_data[category]
-                            prompt_content = f"Generate a final response finally agreeing to evacuate. Use or adapt lines from this {category}:{context}. "
-                    turn = {
-                        "speaker": "ross",
-                        "prompt": f"You are roleplaying as Ross, \nRoss's background: {persona_data['ross']}\nPrevious conversation:\n{history}\n{prompt_content}\n please generate a response based on the last message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": category
-                    }
-                elif town_person_lower == "michelle":
-                    final_engagement=False
-                    engagement=False
-                    if history:
-                        for line in history.split('\n'):
-                            if "yes" in engagement_check(line).lower():
-                                final_engagement = True
-                                break
-                    if history and message_count > 0 and speaker == "Operator":
-                        last_message = user_input.lower()
-                        engagement_response = engagement_check(last_message)
-                        if "yes" in engagement_response.lower():
-                            engagement = True
-                            
-                    ending_conversation = False
-                    if ending_conversation_check(history):
-                        if "yes" in ending_conversation_check(history).lower():
-                            ending_conversation = True
-                        else:
-                            ending_conversation = False
-                    
-                    category = ""
-                    if message_count == 1:
-                        category = "greetings"
-                        context = michelle_data[category]
-                        prompt_content = f"Generate an initial response to the operator's or julie's greeting. Use or adapt lines from this {category}:{context}. "
-                    elif message_count == 3:
-                        category = "response_to_operator_greetings"
-                        context = michelle_data[category]
-                        prompt_content = f"Generate a response to ask the operator if he would like to leave in the situation. Refer to lines from this {category}:{context}."
-                    elif message_count == 5:
-                        print(f'engagement_response: {engagement_response}')
-                        if engagement or final_engagement:
-                            category = "progression"
-                            context = michelle_data[category]
-                            prompt_content = f"Generate a response agreeing to evacuate. Use or adapt lines from this {category}:{context}. "
-                        else:
-                            category = "refuse_assistance"
-                            context = michelle_data[category]
-                            prompt_content = f"Generate a response refusing to evacuate. Use or adapt lines from this {category}:{context}. "
-                    elif message_count == 7:
-                        if ending_conversation or final_engagement:
-                            category = "closing"
-                            context = michelle_data[category]
-                            prompt_content = f"Generate a final response agreeing to evacuate. Use or adapt lines from this {category}:{context}. "
-                        else:
-                            category = "refuse_assistance"
-                            context = michelle_data[category]
-                            prompt_content = f"Generate a final response refusing to evacuate. Use or adapt lines from this {category}:{context}. "
-                    else:
-                        category = "closing"
-                        context = michelle_data[category]
-                        prompt_content = f"Generate a final response to operator or julie. Use or adapt lines from this {category}:{context}. "
-                    
-                    turn = {
-                        "speaker": "michelle",
-                        "prompt": f"You are roleplaying as Michelle, \nMichelle's background: {persona_data['michelle']}\nPrevious conversation:\n{history}\n{prompt_content}\n please generate a response based on the last message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": category
-                    }
-                elif town_person_lower == "mary":
-                    category = ""
-                    if message_count == 1:
-                        category = "greetings"
-                        context = ''
-                        prompt_content = f"Generate an initial response to the operator's or julie's greeting."
-                    elif message_count == 3:
-                        category = "response_to_operator_greetings"
-                        context = ''
-                        prompt_content = f"Generate a response to the operator's greeting or answer the operator's question."
-                    elif message_count == 5:
-                        category = "progression"
-                        context = ''
-                        prompt_content = f"Generate a response to the operator."
-                    elif message_count == 7:
-                        category = "closing"
-                        context = ''
-                        prompt_content = f"Generate a final response to determine whether you want to be evacuated or not."
-                    else:
-                        category = "closing"
-                        context = ''
-                        prompt_content = f"Generate a final response to operator or julie."
-                    turn = {
-                        "speaker": "mary",
-                        "prompt": f"You are roleplaying as Mary, \nMary's background: {persona_data['mary']}\nPrevious conversation:\n{history}\n{prompt_content}\n please generate a response based on the last message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": category
-                    }
-                elif town_person_lower == "ben":
-                    category = ""
-                    if message_count == 1:
-                        category = "greetings"
-                        context = ''
-                        prompt_content = f"Generate an initial response to the operator's or julie's greeting."
-                    elif message_count == 3:
-                        category = "response_to_operator_greetings"
-                        context = ''
-                        prompt_content = f"Generate a response to the operator's greeting or answer the operator's question."
-                    elif message_count == 5:
-                        category = "progression"
-                        context = ''
-                        prompt_content = f"Generate a response to the operator."
-                    elif message_count == 7:
-                        category = "closing"
-                        context = ''
-                        prompt_content = f"Generate a final response to determine whether you want to be evacuated or not."
-                    else:
-                        category = "closing"
-                        context = ''
-                        prompt_content = f"Generate a final response to operator or julie."
-                    turn = {
-                        "speaker": "ben",
-                        "prompt": f"You are roleplaying as Ben, \nBen's background: {persona_data['ben']}\nPrevious conversation:\n{history}\n{prompt_content}\n please generate a response based on the last message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": category
-                    }
-                elif town_person_lower == "ana":
-                    category = ""
-                    if message_count == 1:
-                        category = "greetings"
-                        context = ''
-                        prompt_content = f"Generate an initial response to the operator's or julie's greeting."
-                    elif message_count == 3:
-                        category = "response_to_operator_greetings"
-                        context = ''
-                        prompt_content = f"Generate a response to the operator's greeting or answer the operator's question."
-                    elif message_count == 5:
-                        category = "progression"
-                        context = ''
-                        prompt_content = f"Generate a response to the operator."
-                    elif message_count == 7:
-                        category = "closing"
-                        context = ''
-                        prompt_content = f"Generate a final response to determine whether you want to be evacuated or not."
-                    else:
-                        category = "closing"
-                        context = ''
-                        prompt_content = f"Generate a final response to operator or julie."
-                    turn = {
-                        "speaker": "ana",
-                        "prompt": f"You are roleplaying as Ana, \nAna's background: {persona_data['ana']}\nPrevious conversation:\n{history}\n{prompt_content}\n please generate a response based on the last message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": category
-                    }
-                elif town_person_lower == "tom":
-                    category = ""
-                    if message_count == 1:
-                        category = "greetings"
-                        context = ''
-                        prompt_content = f"Generate an initial response to the operator's or julie's greeting."
-                    elif message_count == 3:
-                        category = "response_to_operator_greetings"
-                        context = ''
-                        prompt_content = f"Generate a response to the operator's greeting or answer the operator's question."
-                    elif message_count == 5:
-                        category = "progression"
-                        context = ''
-                        prompt_content = f"Generate a response to the operator."
-                    elif message_count == 7:
-                        category = "closing"
-                        context = ''
-                        prompt_content = f"Generate a final response to determine whether you want to be evacuated or not."
-                    else:
-                        category = "closing"
-                        context = ''
-                        prompt_content = f"Generate a final response to operator or julie."
-                    turn = {
-                        "speaker": "tom",
-                        "prompt": f"You are roleplaying as Tom, \nTom's background: {persona_data['tom']}\nPrevious conversation:\n{history}\n{prompt_content}\n please generate a response based on the last message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": category
-                    }
-                elif town_person_lower == "mia":
-                    category = ""
-                    if message_count == 1:
-                        category = "greetings"
-                        context = ''
-                        prompt_content = f"Generate an initial response to the operator's or julie's greeting."
-                    elif message_count == 3:
-                        category = "response_to_operator_greetings"
-                        context = ''
-                        prompt_content = f"Generate a response to the operator's greeting or answer the operator's question."
-                    elif message_count == 5:
-                        category = "progression"
-                        context = ''
-                        prompt_content = f"Generate a response to the operator."
-                    elif message_count == 7:
-                        category = "closing"
-                        context = ''
-                        prompt_content = f"Generate a final response to determine whether you want to be evacuated or not."
-                    else:
-                        category = "closing"
-                        context = ''
-                        prompt_content = f"Generate a final response to operator or julie."
-                    turn = {
-                        "speaker": "mia",
-                        "prompt": f"You are roleplaying as Mia, \nMia's background: {persona_data['mia']}\nPrevious conversation:\n{history}\n{prompt_content}\n please generate a response based on the last message and keep your response natural and brief. Only generate utterances, no system messages.",
-                        "category": category
-                    }
+@app.post("/chat/stream")
+async def chat_stream(request: Request):
+    """Interactive /chat that streams the reply as server-sent events.
+
+    Emits ``token`` events while the town person's reply is generated, followed by
+    ``response`` (the cleaned reply), ``category``, ``retrieved_info``,
+    ``decision_response`` and ``done`` (carrying the ``sessionId``, or the
+    ``state`` token in stateless mode). Only the regular interactive mode is supported.
+    """
+    data = await request.json()
+    town_person = data.get("townPerson")
+    user_input = data.get("userInput", "")
+    mode = data.get("mode", "interactive")
+    speaker = data.get("speaker", "")
+    auto_julie = data.get("autoJulie", False)
+    if not town_person or mode != "interactive" or auto_julie:
+        return {"error": "Streaming is only available for interactive mode without Auto Julie"}
+
+    town_person_lower = town_person.lower()
+    stateless = STATE_SECRET is not None
+    try:
+        session_id, state = request_session(data)
+    except ValueError as e:
+        return {"error": str(e)}
+    logger.info("Chat stream request", extra={"fields": {
+        "town_person": town_person, "speaker": speaker, "session_id": session_id
+    }})
+
+    async def events():
+        try:
+            # Held for the whole stream, so the next turn of this session waits for this reply
+            async with conversation_manager.session_lock(session_id):
+                decision_task = None
                 try:
-                    # Generate town person's response
-                    response, retrieved_info = simulate_interactive_single_turn(
+                    if state is not None:
+                        conversation_manager.import_session(session_id, state)
+                    turn, decision_task = await prepare_interactive_turn(
+                        town_person, user_input, speaker, session_id
+                    )
+                    response = ""
+                    retrieved_info = {}
+                    async for event in simulate_interactive_single_turn_stream(
                         town_person_lower,
                         user_input,
                         speaker=speaker,
                         persona=persona_data[town_person_lower],
                         turn=turn,
                         session_id=session_id
-                    )
-                    
-                    # Check if response is in history and add it if not
-                    history_after = conversation_manager.get_history(session_id, max_turns=12)
-                    if not response in history_after:
-                        # If response isn't in history already, add it explicitly
-                        conversation_manager.add_message(session_id, town_person, response)
-                        print(f"Explicitly added response to history: {town_person}: {response}")
-                    
-                    # Return town person's response
-                    if isinstance(retrieved_info, dict):
-                        # Include the full prompt in the retrieved info for all characters
-                        full_prompt = turn["prompt"]
-                        retrieved_info["full_prompt"] = full_prompt
-                        print(f"Added full_prompt to retrieved_info for {town_person_lower}")
-                        
-                        # Make sure speaker is set correctly
-                        if town_person_lower == "niki":
-                            retrieved_info["speaker"] = "niki"
-                            print(f"Set Niki's speaker in retrieved_info: {retrieved_info['speaker']}")
-                        elif town_person_lower == "lindsay":
-                            retrieved_info["speaker"] = "lindsay"
-                            print(f"Set Lindsay's speaker in retrieved_info: {retrieved_info['speaker']}")
-                        elif town_person_lower == "ross":
-                            retrieved_info["speaker"] = "ross"
-                            print(f"Set Ross's speaker in retrieved_info: {retrieved_info['speaker']}")
-                        elif town_person_lower == "michelle":
-                            retrieved_info["speaker"] = "michelle"
-                            print(f"Set Michelle's speaker in retrieved_info: {retrieved_info['speaker']}")
-                    else:
-                        # If retrieved_info is not a dict, create a new one
-                        retrieved_info = {
-                            "full_prompt": turn["prompt"],
-                            "speaker": town_person_lower
-                        }
-                    
-                    print(f"Decision response: {decision_response}")    
-                    return {
-                        "response": response,
-                        "retrieved_info": retrieved_info,
-                        "category": turn["category"],
-                        "decision_response": decision_response
-                    }
-                    
+                    ):
+                        if event["type"] == "token":
+                            yield sse_event("token", {"text": event["text"]})
+                        else:
+                            response = event["response"]
+                            retrieved_info = event["retrieved_info"]
+
+                    retrieved_info["full_prompt"] = turn["prompt"]
+                    retrieved_info["speaker"] = town_person_lower
+                    yield sse_event("response", {"response": response})
+                    yield sse_event("category", {"category": turn["category"]})
+                    yield sse_event("retrieved_info", {"retrieved_info": retrieved_info})
+                    # The decision has been running since the turn was prepared
+                    decision_response = await await_decision(decision_task)
+                    yield sse_event("decision_response", {"decision_response": decision_response})
+                    yield sse_event("done", {"state": client_state(session_id)} if stateless else {"sessionId": session_id})
                 except Exception as e:
-                    print(f"Error in interactive mode: {str(e)}")
-                    traceback.print_exc()
-                    return {"error": f"Error generating response: {str(e)}"}
-            
-        elif mode == "auto":
-            try:
-                print(f"Starting auto mode generation for {town_person}")
-                # Generate the entire conversation at once
-                transcript, retrieved_info, decision = simulate_dual_role_conversation(
-                    persona_data[town_person_lower],
-                    town_person # Keep original case for display
-                )
-                
-                print(f"Generated transcript: {transcript}")
-                print(f"Retrieved info: {retrieved_info}")
-                print(f"Decision: {decision}")
-                
-                return {
-                    "transcript": transcript,
-                    "retrieved_info": retrieved_info,
-                    "is_complete": True,
-                    "decision": decision}
-                 
-            except Exception as e:
-                print(f"Error in auto mode generation: {str(e)}")
-                traceback.print_exc()
-                return {"error": f"Error generating conversation: {str(e)}"}
-    except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}")
-        traceback.print_exc()
-        return {"error": str(e)}
+                    logger.exception(f"Error in streamed interactive mode: {str(e)}")
+                    yield sse_event("error", {"error": f"Error generating response: {str(e)}", "sessionId": session_id})
+                finally:
+                    # Also runs when the client disconnects mid-stream (GeneratorExit)
+                    cancel_decision(decision_task)
+        finally:
+            if stateless:
+                conversation_manager.discard_session(session_id)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 if __name__ == "__main__":
     import uvicorn
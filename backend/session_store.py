@@ -0,0 +1,254 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+# Stored sessions not written to for this long are purged from disk
+DEFAULT_RETENTION = 7 * 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore:
+    """Durable copy of conversation sessions in SQLite (WAL mode), written behind.
+
+    Writes are appended to an in-memory journal and flushed in one transaction
+    by a background thread every ``flush_interval`` seconds, so adding a message
+    never waits on disk. Nothing is read at startup: ``load`` fetches a single
+    session the first time it is touched. Only the last ``max_messages``
+    messages of a session are kept on disk, matching the in-memory ring buffer.
+
+    With ``write_through`` every write is committed immediately instead, so
+    several worker processes can share the file. Each session row carries a
+    ``version`` token that changes on every write, which lets a process tell whether
+    its in-memory copy is stale.
+    """
+
+    def __init__(self, db_path: str, flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 retention: Optional[float] = DEFAULT_RETENTION, write_through: bool = False):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.write_through = write_through
+        self._journal: List[Tuple] = []
+        self._journal_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self.flushes = 0
+        self.written = 0
+        self.loads = 0
+        self.errors = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # Other workers may hold the write lock briefly, so wait for it rather than fail
+        self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, total INTEGER, last_write REAL, version TEXT)"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(sessions)")]
+        if "version" not in columns:
+            self._db.execute("ALTER TABLE sessions ADD COLUMN version TEXT")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "session_id TEXT, seq INTEGER, speaker TEXT, content TEXT, timestamp REAL, flags TEXT, "
+            "PRIMARY KEY (session_id, seq))"
+        )
+        self._db.commit()
+
+        self._stop = threading.Event()
+        self._writer = None
+        if not write_through:
+            self._writer = threading.Thread(target=self._run, name="session-store-writer", daemon=True)
+            self._writer.start()
+        atexit.register(self.close)
+
+    def create(self, session_id: str, timestamp: float, version: str):
+        """Journal a new session that has no messages yet."""
+        self._record(("create", session_id, timestamp, version))
+
+    def append(self, session_id: str, seq: int, speaker: str, content: str, timestamp: float,
+               flags: Dict[str, bool], keep_from: int, version: str):
+        """Journal a new message; messages with ``seq < keep_from`` are trimmed on flush."""
+        self._record(("add", session_id, seq, speaker, content, timestamp, json.dumps(flags), keep_from, version))
+
+    def update_flags(self, session_id: str, seq: int, flags: Dict[str, bool], version: str):
+        """Journal the classifier flags of a stored message."""
+        self._record(("flags", session_id, seq, json.dumps(flags), version))
+
+    def delete(self, session_id: str):
+        """Journal the removal of a session."""
+        self._record(("delete", session_id))
+
+    def version(self, session_id: str) -> Optional[str]:
+        """The stored version of a session, or None if it is not stored."""
+        self.flush()
+        with self._db_lock:
+            try:
+                row = self._db.execute("SELECT version FROM sessions WHERE session_id=?", (session_id,)).fetchone()
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning(f"Could not read version of session {session_id}: {str(e)}")
+                return None
+        return row[0] if row is not None else None
+
+    def _record(self, op: Tuple):
+        with self._journal_lock:
+            self._journal.append(op)
+        if self.write_through:
+            self.flush()
+
+    def expire(self, now: Optional[float] = None):
+        """Journal a purge of sessions not written to within the retention period."""
+        if self.retention is None:
+            return
+        now = time.time() if now is None else now
+        self._record(("purge", now - self.retention))
+
+    def load(self, session_id: str, max_messages: int) -> Optional[Tuple[int, str, List[Tuple]]]:
+        """Read one session as (total messages ever added, version, last rows oldest first), or None.
+
+        Rows are (seq, speaker, content, timestamp, flags). Pending writes are
+        flushed first so a session evicted from memory comes back complete.
+        """
+        self.flush()
+        with self._db_lock:
+            try:
+                row = self._db.execute(
+                    "SELECT total, version FROM sessions WHERE session_id=?", (session_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                rows = self._db.execute(
+                    "SELECT seq, speaker, content, timestamp, flags FROM messages "
+                    "WHERE session_id=? ORDER BY seq DESC LIMIT ?",
+                    (session_id, max_messages)
+                ).fetchall()
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning(f"Could not load session {session_id}: {str(e)}")
+                return None
+        self.loads += 1
+        return row[0], row[1], [(seq, speaker, content, timestamp, json.loads(flags or "{}"))
+                                for seq, speaker, content, timestamp, flags in reversed(rows)]
+
+    def flush(self) -> int:
+        """Write the journal in one transaction. Returns the number of operations written."""
+        # Take the journal while holding the DB lock, so batches are applied in order
+        with self._db_lock:
+            with self._journal_lock:
+                journal, self._journal = self._journal, []
+            if not journal:
+                return 0
+            try:
+                with self._db:
+                    for op in journal:
+                        self._apply(op)
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning(f"Could not flush {len(journal)} session writes: {str(e)}")
+                return 0
+        self.flushes += 1
+        self.written += len(journal)
+        return len(journal)
+
+    def _apply(self, op: Tuple):
+        kind = op[0]
+        if kind == "add":
+            _, session_id, seq, speaker, content, timestamp, flags, keep_from, version = op
+            self._db.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, seq, speaker, content, timestamp, flags)
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, total, last_write, version) VALUES (?, ?, ?, ?)",
+                (session_id, seq, timestamp, version)
+            )
+            self._db.execute("DELETE FROM messages WHERE session_id=? AND seq<?", (session_id, keep_from))
+        elif kind == "create":
+            _, session_id, timestamp, version = op
+            self._db.execute(
+                "INSERT OR IGNORE INTO sessions (session_id, total, last_write, version) VALUES (?, 0, ?, ?)",
+                (session_id, timestamp, version)
+            )
+        elif kind == "flags":
+            _, session_id, seq, flags, version = op
+            self._db.execute("UPDATE messages SET flags=? WHERE session_id=? AND seq=?", (flags, session_id, seq))
+            self._db.execute("UPDATE sessions SET version=? WHERE session_id=?", (version, session_id))
+        elif kind == "delete":
+            self._db.execute("DELETE FROM messages WHERE session_id=?", (op[1],))
+            self._db.execute("DELETE FROM sessions WHERE session_id=?", (op[1],))
+        elif kind == "purge":
+            self._db.execute(
+                "DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE last_write<?)",
+                (op[1],)
+            )
+            self._db.execute("DELETE FROM sessions WHERE last_write<?", (op[1],))
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Stop the writer thread and flush what is left."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join(timeout=5)
+        self.flush()
+
+    def stats(self) -> Dict:
+        """Write-behind counters for the metrics endpoint."""
+        return {
+            "db_path": self.db_path,
+            "write_through": self.write_through,
+            "pending": len(self._journal),
+            "flushes": self.flushes,
+            "written": self.written,
+            "loads": self.loads,
+            "errors": self.errors
+        }
+
+
+def shared_sessions_enabled() -> bool:
+    """Whether A2I2_SESSION_SHARED asks for sessions shared between worker processes."""
+    return os.getenv("A2I2_SESSION_SHARED", "").lower() in ("1", "true", "yes")
+
+
+def default_session_db_path() -> str:
+    base_dir = os.getenv('A2I2_BASE_DIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return os.path.join(base_dir, "results", "sessions.sqlite3")
+
+
+def open_session_store() -> Optional[SessionStore]:
+    """SessionStore at A2I2_SESSION_DB, or None (sessions stay in memory only) when unset.
+
+    Shared mode (A2I2_SESSION_SHARED) always needs a store, so it falls back to
+    results/sessions.sqlite3 and writes through.
+    """
+    shared = shared_sessions_enabled()
+    db_path = os.getenv("A2I2_SESSION_DB", "")
+    if not db_path and shared:
+        db_path = default_session_db_path()
+    if not db_path:
+        return None
+    retention = float(os.getenv("A2I2_SESSION_DB_RETENTION", str(DEFAULT_RETENTION)))
+    try:
+        return SessionStore(
+            db_path,
+            flush_interval=float(os.getenv("A2I2_SESSION_FLUSH_INTERVAL", str(DEFAULT_FLUSH_INTERVAL))),
+            retention=retention if retention > 0 else None,
+            write_through=shared
+        )
+    except (OSError, sqlite3.Error) as e:
+        if shared:
+            raise
+        logger.warning(f"Session store disabled ({db_path}): {str(e)}")
+        return None
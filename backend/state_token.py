@@ -0,0 +1,64 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+import zlib
+from typing import Dict, Optional
+
+# Enough messages for the longest history window a turn reads (11) plus its own input
+DEFAULT_STATE_MESSAGES = 12
+TOKEN_VERSION = 1
+
+
+class InvalidStateToken(ValueError):
+    """The state token is malformed, expired, or its signature does not match."""
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(payload: str, secret: bytes) -> str:
+    return _b64encode(hmac.new(secret, payload.encode("ascii"), hashlib.sha256).digest())
+
+
+def encode_state(state: Dict, secret: bytes) -> str:
+    """Serialize conversation state (as exported by ConversationManager) into a signed token.
+
+    The token is ``<payload>.<signature>``: compact JSON, zlib-compressed and
+    base64url-encoded, followed by its HMAC-SHA256.
+    """
+    body = dict(state, v=TOKEN_VERSION, iat=int(time.time()))
+    payload = _b64encode(zlib.compress(json.dumps(body, separators=(",", ":")).encode("utf-8"), 9))
+    return f"{payload}.{_sign(payload, secret)}"
+
+
+def decode_state(token: str, secret: bytes, max_age: Optional[float] = None) -> Dict:
+    """Verify and unpack a token from ``encode_state``; raises InvalidStateToken."""
+    try:
+        payload, signature = token.split(".")
+    except (AttributeError, ValueError):
+        raise InvalidStateToken("Malformed state token")
+    if not hmac.compare_digest(signature, _sign(payload, secret)):
+        raise InvalidStateToken("State token signature mismatch")
+    try:
+        state = json.loads(zlib.decompress(_b64decode(payload)).decode("utf-8"))
+    except (ValueError, zlib.error):
+        raise InvalidStateToken("Corrupt state token")
+    if state.get("v") != TOKEN_VERSION:
+        raise InvalidStateToken("Unsupported state token version")
+    if max_age is not None and time.time() - state.get("iat", 0) > max_age:
+        raise InvalidStateToken("State token expired")
+    return state
+
+
+def state_secret() -> Optional[bytes]:
+    """A2I2_STATE_SECRET as bytes, or None when stateless mode is off."""
+    secret = os.getenv("A2I2_STATE_SECRET", "")
+    return secret.encode("utf-8") if secret else None
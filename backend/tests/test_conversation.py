@@ -0,0 +1,39 @@
+from conversation import ConversationManager
+from session_store import SessionStore
+
+
+def test_new_session_is_visible_to_other_workers(tmp_path):
+    db_path = str(tmp_path / "sessions.sqlite3")
+    first = ConversationManager(store=SessionStore(db_path, write_through=True), shared=True)
+    second = ConversationManager(store=SessionStore(db_path, write_through=True), shared=True)
+
+    session_id = first.create_session()
+
+    assert second.has_session(session_id)
+    assert second.get_history(session_id) == ""
+    assert not second.has_session("bob_session")
+
+
+def test_new_session_survives_restart(tmp_path):
+    db_path = str(tmp_path / "sessions.sqlite3")
+    store = SessionStore(db_path)
+    session_id = ConversationManager(store=store).create_session()
+    store.close()
+
+    assert ConversationManager(store=SessionStore(db_path)).has_session(session_id)
+
+
+def test_cleared_session_stays_issued(tmp_path):
+    db_path = str(tmp_path / "sessions.sqlite3")
+    manager = ConversationManager(store=SessionStore(db_path, write_through=True))
+    session_id = manager.create_session()
+    manager.add_message(session_id, "Operator", "Hi, are you okay?")
+
+    assert manager.clear_session(session_id)
+
+    assert manager.has_session(session_id)
+    assert manager.get_history(session_id) == ""
+    restarted = ConversationManager(store=SessionStore(db_path, write_through=True))
+    assert restarted.has_session(session_id)
+    assert restarted.get_history(session_id) == ""
+    assert not manager.clear_session("bob_session")
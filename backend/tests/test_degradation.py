@@ -0,0 +1,44 @@
+import time
+
+import pytest
+
+from degradation import DegradationController
+
+
+def fail_call(controller):
+    with pytest.raises(RuntimeError):
+        with controller.track():
+            raise RuntimeError("backend down")
+
+
+def test_degrade_probe_and_recover():
+    controller = DegradationController(p95_threshold=1.0, min_samples=2, probe_interval=0.05)
+    in_flight = time.monotonic()
+    fail_call(controller)
+    fail_call(controller)
+    assert controller.degraded
+    assert not controller.use_model()
+
+    # A call that started before the switch is not a probe
+    controller.record(0.01, True, started=in_flight)
+    assert controller.degraded
+
+    time.sleep(0.06)
+    # Turns answered without calling the model leave the probe for the next turn
+    assert controller.use_model()
+    assert controller.use_model()
+    with controller.track():
+        pass
+    assert not controller.degraded
+    assert controller.stats()["probes"] == 1
+
+
+def test_failed_probe_waits_for_the_next_interval():
+    controller = DegradationController(p95_threshold=1.0, min_samples=2, probe_interval=0.05)
+    fail_call(controller)
+    fail_call(controller)
+    time.sleep(0.06)
+    assert controller.use_model()
+    fail_call(controller)
+    assert controller.degraded
+    assert not controller.use_model()
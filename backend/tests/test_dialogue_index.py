@@ -0,0 +1,25 @@
+import json
+import os
+
+os.environ.setdefault("A2I2_DIALOGUE_INDEX", "keyword")
+os.environ.setdefault("A2I2_CLASSIFIER_CACHE_DB", "")
+
+import dialogue_engine
+from dialogue_state_machine import DialogueStateMachine, default_states_path
+
+
+def test_index_covers_every_state_machine_line():
+    # Loaded the way server.py loads DIAL_FILE_PATH for its state machine
+    with open(os.path.join("data_for_train", "character_lines.jsonl")) as f:
+        character_lines = {data["character"]: data for data in map(json.loads, filter(str.strip, f))}
+    machine = DialogueStateMachine.from_file(default_states_path(), character_lines)
+    indexed = {(line["character"], line["category"], line["text"]) for line in dialogue_engine.vector_store.index.lines}
+
+    missing = [
+        (name, category, text)
+        for name, character in machine.characters.items()
+        for category, texts in character.lines.items() if isinstance(texts, list)
+        for text in texts
+        if (name, category, text) not in indexed
+    ]
+    assert not missing
@@ -0,0 +1,12 @@
+from local_classifier import LocalClassifier
+
+
+def test_decision_near_miss_goes_to_the_llm():
+    classifier = LocalClassifier()
+    assert classifier.classify("decision", "I'm not sure I want to go anywhere yet.") is None
+
+
+def test_decision_needs_two_signals_for_a_local_yes():
+    classifier = LocalClassifier()
+    assert classifier.classify("decision", "Okay, I'll leave now, let me grab my dog.") is True
+    assert classifier.classify("decision", "I'm not leaving my home.") is False
@@ -47,6 +47,29 @@ let lineCounter = 1;
 let currentSpeaker = 'Operator'; // Default speaker
 let isGenerating = false; // Flag to prevent multiple simultaneous Julie responses
 
+// Server-issued conversation ID, kept per tab so each trainee has their own history
+const sessionKey = `sessionId_${selectedPerson}`;
+let sessionId = sessionStorage.getItem(sessionKey);
+// In the backend's stateless mode the conversation comes back as a signed token instead
+const stateKey = `conversationState_${selectedPerson}`;
+let conversationState = sessionStorage.getItem(stateKey);
+
+function rememberSession(data) {
+    // The server no longer knows this session (e.g. it restarted); the next message starts a new one
+    if (data && data.error === 'Unknown sessionId') {
+        sessionId = null;
+        sessionStorage.removeItem(sessionKey);
+    }
+    if (data && data.sessionId && data.sessionId !== sessionId) {
+        sessionId = data.sessionId;
+        sessionStorage.setItem(sessionKey, sessionId);
+    }
+    if (data && data.state) {
+        conversationState = data.state;
+        sessionStorage.setItem(stateKey, conversationState);
+    }
+}
+
 // Add interaction mode toggle
 const interactionModeContainer = document.createElement('div');
 interactionModeContainer.id = 'interaction-mode-container';
@@ -167,11 +190,14 @@ async function generateJulieResponse() {
                 userInput: "",
                 mode: "interactive",
                 speaker: "Julie",
-                autoJulie: true
+                autoJulie: true,
+                sessionId: sessionId,
+                state: conversationState
             })
         });
 
         const data = await response.json();
+        rememberSession(data);
         console.log("Response from auto Julie API:", data);
         
         // Remove loading indicator
@@ -253,6 +279,10 @@ checkBackendConnection();
 function addMessage(text, sender, retrievedInfo) {
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${sender.toLowerCase()}`;
+    if (retrievedInfo && retrievedInfo.degraded) {
+        messageDiv.classList.add('degraded');
+        messageDiv.title = 'Answered from scripted lines while the language model was slow or unavailable';
+    }
     // Add clickable cursor style
     messageDiv.style.cursor = 'pointer';
     
@@ -413,7 +443,9 @@ async function sendMessage() {
                 townPerson: selectedPerson,
                 userInput: userInput,
                 mode: 'interactive',
-                speaker: speaker  // Pass the speaker (Julie or Operator)
+                speaker: speaker,  // Pass the speaker (Julie or Operator)
+                sessionId: sessionId,
+                state: conversationState
             })
         });
         
@@ -423,6 +455,7 @@ async function sendMessage() {
         
         data = await response.json();
         console.log('Received response data:', data);
+        rememberSession(data);
         
         // Check if data is null or undefined before accessing properties
         if (!data) {
@@ -692,21 +725,26 @@ async function restartConversation() {
     speakerToggleBtn.textContent = `Switch to ${selectedPerson}`;
     chatInput.placeholder = 'Type Operator\'s message...';
     
-    // Clear backend conversation history
+    // Drop the stateless-mode token, then clear backend conversation history
+    conversationState = null;
+    sessionStorage.removeItem(stateKey);
     try {
-        console.log('Clearing backend conversation history...');
-        const response = await fetch(`${API_URL}/clear-session/${selectedPerson}`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
+        if (sessionId) {
+            console.log('Clearing backend conversation history...');
+            const clearUrl = `${API_URL}/clear-session/${selectedPerson}?sessionId=${encodeURIComponent(sessionId)}`;
+            const response = await fetch(clearUrl, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                }
+            });
+            
+            if (response.ok) {
+                const data = await response.json();
+                console.log('Backend session cleared:', data.message);
+            } else {
+                console.warn('Failed to clear backend session, but continuing anyway');
             }
-        });
-        
-        if (response.ok) {
-            const data = await response.json();
-            console.log('Backend session cleared:', data.message);
-        } else {
-            console.warn('Failed to clear backend session, but continuing anyway');
         }
     } catch (error) {
         console.error('Error clearing backend session:', error);